@@ -203,6 +203,21 @@ LOGGING = {
     },
 }
 
+# Where InterventionPointInteractions are written; see ab_tool.analytics for
+# the available sinks and their delivery guarantees.  Interactions are the
+# experiment data, so they are written in the request by default.  The
+# buffered sink takes the write off the request but can lose interactions, so
+# it has to be opted into, e.g.
+#     {'BACKEND': 'ab_tool.analytics.BufferedInteractionSink',
+#      'OPTIONS': {'batch_size': 500, 'flush_interval_secs': 5,
+#                  'max_queue_size': 100000}}
+# To use the file sink, set 'BACKEND' to 'ab_tool.analytics.FileInteractionSink'
+# with a 'directory' option and run the drain_interactions management command
+# periodically.
+INTERACTION_SINK = SECURE_SETTINGS.get('interaction_sink', {
+    'BACKEND': 'ab_tool.analytics.DatabaseInteractionSink',
+})
+
 # Currently deployed environment
 ENV_NAME = SECURE_SETTINGS.get('env_name', 'local')
 
@@ -221,7 +236,55 @@ LTI_OAUTH_CREDENTIALS = SECURE_SETTINGS.get('lti_oauth_credentials', None)
 COURSE_ACTIVE_DAYS = 365
 NOTIFICATION_FREQUENCY_HOURS = 24
 
-MAX_FILE_UPLOAD_SIZE = 10 * 1024 * 1024  # 10 MB
+# CSV and XLSX uploads are read a row at a time (and uploads over
+# FILE_UPLOAD_MAX_MEMORY_SIZE are kept on disk), so large uploads don't need
+# much memory
+MAX_FILE_UPLOAD_SIZE = SECURE_SETTINGS.get('max_file_upload_size', 100 * 1024 * 1024)  # 100 MB
+# XLS files are the exception: xlrd loads the whole workbook into memory, so
+# they keep the old limit
+MAX_XLS_FILE_UPLOAD_SIZE = SECURE_SETTINGS.get('max_xls_file_upload_size', 10 * 1024 * 1024)  # 10 MB
+# Parsing an upload stops after this many errors
+MAX_UPLOAD_ERRORS = SECURE_SETTINGS.get('max_upload_errors', 100)
+
+# How long the per-intervention-point deploy plans used for student launches
+# are cached; plans are also invalidated whenever the objects they are built
+# from are saved or deleted
+DEPLOY_PLAN_CACHE_TIMEOUT = SECURE_SETTINGS.get('deploy_plan_cache_timeout_secs', 24 * 60 * 60)
+# Student track assignments never change once made, so they can be cached for
+# much longer than deploy plans
+STUDENT_ASSIGNMENT_CACHE_TIMEOUT = SECURE_SETTINGS.get('student_assignment_cache_timeout_secs', 7 * 24 * 60 * 60)
+# Canvas modules of a course are cached briefly so that consecutive admin pages
+# don't each crawl the course.  Only display pages use the cache; the checks
+# that an intervention point isn't installed before a delete always ask Canvas
+CANVAS_MODULES_CACHE_TIMEOUT = SECURE_SETTINGS.get('canvas_modules_cache_timeout_secs', 60)
+# How old (in seconds) the local copy of a course's roster can get before it is
+# synced with Canvas again
+COURSE_ROSTER_MAX_AGE = SECURE_SETTINGS.get('course_roster_max_age_secs', 15 * 60)
+# Course admins' credentials are only written when they change (see
+# ab_tool.credentials): a fingerprint of each credential written is cached for
+# this long, and changed credentials are written in batches this often (0
+# writes them during the request)
+COURSE_CREDENTIAL_CACHE_TIMEOUT = SECURE_SETTINGS.get('course_credential_cache_timeout_secs', 60 * 60)
+COURSE_CREDENTIAL_FLUSH_INTERVAL_SECS = SECURE_SETTINGS.get('course_credential_flush_interval_secs', 5)
+# Maximum number of concurrent Canvas API requests made for one page
+CANVAS_API_CONCURRENCY = SECURE_SETTINGS.get('canvas_api_concurrency', 8)
+# Keep-alive connections to each Canvas host are pooled per process (see
+# ab_tool.connection_pools); the pool should hold at least as many connections
+# as there are concurrent requests.  Timeouts are in seconds.
+CANVAS_HTTP_POOL_SIZE = SECURE_SETTINGS.get('canvas_http_pool_size', CANVAS_API_CONCURRENCY)
+CANVAS_HTTP_CONNECT_TIMEOUT = SECURE_SETTINGS.get('canvas_http_connect_timeout_secs', 5)
+CANVAS_HTTP_READ_TIMEOUT = SECURE_SETTINGS.get('canvas_http_read_timeout_secs', 30)
+# Canvas rate limiting (see ab_tool.throttling): the full request budget of a
+# token, the remaining budget below which calls are slowed down and made one at
+# a time, and how long a reported budget is trusted without a newer response
+CANVAS_RATE_LIMIT_BUDGET = SECURE_SETTINGS.get('canvas_rate_limit_budget', 700)
+CANVAS_RATE_LIMIT_LOW_BUDGET = SECURE_SETTINGS.get('canvas_rate_limit_low_budget', 150)
+CANVAS_RATE_LIMIT_STATE_TIMEOUT = SECURE_SETTINGS.get('canvas_rate_limit_state_timeout_secs', 60)
+# Retries of calls throttled by Canvas, with backoff doubling from
+# CANVAS_THROTTLE_BACKOFF_SECS up to CANVAS_THROTTLE_MAX_BACKOFF_SECS
+CANVAS_THROTTLE_RETRIES = SECURE_SETTINGS.get('canvas_throttle_retries', 4)
+CANVAS_THROTTLE_BACKOFF_SECS = SECURE_SETTINGS.get('canvas_throttle_backoff_secs', 1.0)
+CANVAS_THROTTLE_MAX_BACKOFF_SECS = SECURE_SETTINGS.get('canvas_throttle_max_backoff_secs', 16.0)
 
 # Email address that error messages come from
 # See Django doc for current default value at:
@@ -21,3 +21,11 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache'
     },
 }
+
+# Write interactions synchronously so tests can see them
+INTERACTION_SINK = {
+    'BACKEND': 'ab_tool.analytics.DatabaseInteractionSink',
+}
+
+# Write course credentials in the request so tests can see them
+COURSE_CREDENTIAL_FLUSH_INTERVAL_SECS = 0
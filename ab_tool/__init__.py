@@ -0,0 +1 @@
+default_app_config = "ab_tool.apps.AbToolConfig"
@@ -1,12 +1,296 @@
-from ab_tool.models import InterventionPointInteraction
-
-def log_intervention_point_interaction(course_id, student, intervention_point,
-                                      experiment, track, intervention_point_url):
-    InterventionPointInteraction.objects.create(
-            course_id=course_id, student=student,
-            intervention_point=intervention_point,
-            experiment=experiment,
-            track=track,
-            url=intervention_point_url.url
-    )
+""" Logging of InterventionPointInteractions.
 
+Interactions are handed to an interaction sink, configured by the
+INTERACTION_SINK setting, so that the student deploy path can be set up not to
+wait on a database write.  The default is DatabaseInteractionSink, as it is the
+only sink that can't lose or duplicate interactions.  The available sinks and
+their delivery guarantees are:
+
+  * DatabaseInteractionSink: writes each interaction in the request that
+    produced it.  Exactly once; the request fails if the write fails.
+  * BufferedInteractionSink: queues interactions in process and writes them
+    with bulk inserts from a background thread once `batch_size` are queued or
+    `flush_interval_secs` have passed.  At most once: queued interactions are
+    lost if the process dies before a flush, and interactions are dropped
+    (and logged) rather than blocking the request when the queue is full.
+  * FileInteractionSink: appends interactions as JSON lines to a file per
+    process in `directory`; the drain_interactions management command loads
+    them into the database.  At least once: a line that has been written is
+    only removed after the transaction loading it has committed, so a crash
+    during a drain can load some interactions twice but loses none.
+
+Interactions are never updated once written.  Interactions of courses that are
+no longer active are moved to InterventionPointInteractionArchive by
+archive_interactions (run by the archive_interactions management command) so
+that the hot table only holds the current terms.
+"""
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import AutoField
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+
+from ab_tool.models import (InterventionPointInteraction,
+    InterventionPointInteractionArchive)
+
+
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH_SIZE = 100
+ARCHIVE_BATCH_SIZE = 1000
+FILE_SINK_SUFFIX = ".jsonl"
+DRAINING_SUFFIX = ".draining"
+
+
+def log_intervention_point_interaction(course_id, student_id, intervention_point_id,
+                                      experiment_id, track_id, url):
+    """ Takes database ids rather than objects so that callers on the
+        student deploy path don't need to load the related objects.  Note that
+        student_id is the id of the ExperimentStudent, not the student's sis id """
+    get_interaction_sink().record({
+            "course_id": course_id, "student_id": student_id,
+            "intervention_point_id": intervention_point_id,
+            "experiment_id": experiment_id, "track_id": track_id, "url": url,
+            "created_on": timezone.now(),
+    })
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_interaction_sink():
+    """ Returns the process-wide sink configured by settings.INTERACTION_SINK """
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                config = settings.INTERACTION_SINK
+                sink_class = import_string(config["BACKEND"])
+                _sink = sink_class(**config.get("OPTIONS", {}))
+    return _sink
+
+
+def insert_interactions(interactions):
+    """ Bulk inserts interaction dicts (as passed to a sink's record method).
+        bulk_create would overwrite created_on with the time of the insert, so
+        the rows are inserted raw (as loaddata does) to keep the time at which
+        the student encountered the intervention point. """
+    fields = [f for f in InterventionPointInteraction._meta.concrete_fields
+              if not isinstance(f, AutoField)]
+    objs = []
+    for interaction in interactions:
+        obj = InterventionPointInteraction(**interaction)
+        obj.updated_on = obj.created_on
+        objs.append(obj)
+    for i in range(0, len(objs), INSERT_BATCH_SIZE):
+        InterventionPointInteraction._base_manager._insert(
+                objs[i:i + INSERT_BATCH_SIZE], fields=fields, raw=True)
+    return len(objs)
+
+
+class DatabaseInteractionSink(object):
+    """ Writes each interaction synchronously """
+    def record(self, interaction):
+        insert_interactions([interaction])
+
+    def flush(self):
+        return 0
+
+
+class BufferedInteractionSink(object):
+    """ Queues interactions in memory and writes them in batches.  If
+        `background` is False no worker thread is started and interactions
+        are only written by calls to flush. """
+    def __init__(self, batch_size=500, flush_interval_secs=5,
+                 max_queue_size=100000, background=True):
+        self.batch_size = batch_size
+        self.flush_interval_secs = flush_interval_secs
+        self.queue = Queue(maxsize=max_queue_size)
+        self.dropped = 0
+        self.background = background
+        self._flush_lock = threading.Lock()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        if background:
+            atexit.register(self.flush)
+
+    def record(self, interaction):
+        try:
+            self.queue.put_nowait(interaction)
+        except Full:
+            self.dropped += 1
+            logger.error("Interaction queue full, dropped interaction: %s", interaction)
+            return
+        if self.background:
+            self._ensure_worker()
+
+    def flush(self):
+        """ Writes everything currently queued and returns the number of
+            interactions written """
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = self._take(self.batch_size)
+                if not batch:
+                    return written
+                written += self._write(batch)
+
+    def _take(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            with transaction.atomic():
+                return insert_interactions(batch)
+        except Exception:
+            logger.exception("Failed to write %s interactions", len(batch))
+            return 0
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run,
+                                                name="interaction-sink")
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = []
+            deadline = time.time() + self.flush_interval_secs
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Empty:
+                    break
+            if batch:
+                with self._flush_lock:
+                    self._write(batch)
+                # Worker threads get their own database connection, which
+                # would otherwise be left open between flushes
+                connection.close()
+
+
+class FileInteractionSink(object):
+    """ Appends interactions as JSON lines to a file per process """
+    def __init__(self, directory):
+        self.directory = directory
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, "interactions.%s%s" % (os.getpid(), FILE_SINK_SUFFIX))
+
+    def record(self, interaction):
+        line = json.dumps(dict(interaction, created_on=interaction["created_on"].isoformat()))
+        # The file is reopened for every write so that a drain, which renames
+        # the file, never races with a writer holding the old file open
+        while True:
+            with open(self.path, "a") as log_file:
+                fcntl.flock(log_file, fcntl.LOCK_EX)
+                if not self._is_current(log_file):
+                    continue
+                log_file.write(line + "\n")
+                log_file.flush()
+                return
+
+    def _is_current(self, log_file):
+        try:
+            return os.fstat(log_file.fileno()).st_ino == os.stat(self.path).st_ino
+        except OSError:
+            return False
+
+    def flush(self):
+        return 0
+
+    def drain(self):
+        """ Loads every interaction log file in the directory into the
+            database and removes it.  Returns the number of interactions loaded. """
+        loaded = 0
+        for path in glob.glob(os.path.join(self.directory, "*" + FILE_SINK_SUFFIX)):
+            # Timestamped so that a file left behind by an earlier failed
+            # drain of the same process's log is never overwritten
+            os.rename(path, "%s.%s%s" % (path, time.time(), DRAINING_SUFFIX))
+        # Also picks up files left behind by a drain that failed part way
+        for draining_path in glob.glob(os.path.join(self.directory, "*" + DRAINING_SUFFIX)):
+            loaded += self._drain_file(draining_path)
+        return loaded
+
+    def _drain_file(self, draining_path):
+        with open(draining_path) as log_file:
+            # Waits for any writer that opened the file before it was renamed
+            fcntl.flock(log_file, fcntl.LOCK_EX)
+            if not os.path.exists(draining_path):
+                # Already loaded by a concurrent drain
+                return 0
+            interactions = []
+            for line in log_file:
+                if not line.strip():
+                    continue
+                interaction = json.loads(line)
+                interaction["created_on"] = parse_datetime(interaction["created_on"])
+                interactions.append(interaction)
+            with transaction.atomic():
+                insert_interactions(interactions)
+            os.remove(draining_path)
+        return len(interactions)
+
+
+ARCHIVE_FIELDS = ("id", "course_id", "created_on", "url", "experiment_id",
+                  "experiment__name", "track_id", "track__name",
+                  "intervention_point_id", "intervention_point__name",
+                  "student__student_id", "student__student_name")
+
+
+def archive_interactions(queryset, batch_size=ARCHIVE_BATCH_SIZE):
+    """ Moves the InterventionPointInteractions in queryset to
+        InterventionPointInteractionArchive, batch_size rows per transaction,
+        and returns the number of interactions moved.  Each batch is read with
+        a single joined query and copied and deleted in the same transaction,
+        so an interrupted run can simply be started again. """
+    moved = 0
+    while True:
+        with transaction.atomic():
+            rows = list(queryset.order_by("id").values(*ARCHIVE_FIELDS)[:batch_size])
+            if not rows:
+                return moved
+            InterventionPointInteractionArchive.objects.bulk_create(
+                    [_archive_row(row) for row in rows])
+            InterventionPointInteraction.objects.filter(
+                    id__in=[row["id"] for row in rows]).delete()
+        moved += len(rows)
+
+
+def _archive_row(row):
+    created_on = row["created_on"]
+    return InterventionPointInteractionArchive(
+            interaction_id=row["id"], course_id=row["course_id"],
+            month=created_on.date().replace(day=1), created_on=created_on,
+            experiment_id=row["experiment_id"], experiment_name=row["experiment__name"],
+            track_id=row["track_id"], track_name=row["track__name"],
+            intervention_point_id=row["intervention_point_id"],
+            intervention_point_name=row["intervention_point__name"],
+            student_id=row["student__student_id"],
+            student_name=row["student__student_name"], url=row["url"])
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class AbToolConfig(AppConfig):
+    name = "ab_tool"
+    verbose_name = "A/B Testing Tool"
+    
+    def ready(self):
+        # Connects the cache invalidation receivers
+        import ab_tool.signals
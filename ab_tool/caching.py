@@ -0,0 +1,161 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.shortcuts import get_object_or_404
+
+from ab_tool.models import Experiment, InterventionPoint, InterventionPointUrl, Track
+
+
+DEPLOY_PLAN_KEY = "deploy_plan_%s"
+STUDENT_ASSIGNMENT_KEY = "student_assignment_%s_%s"
+TRACK_SAMPLER_KEY = "track_sampler_%s"
+COURSE_MODULES_KEY = "course_modules_%s"
+
+
+def deploy_plan_key(intervention_point_id):
+    return DEPLOY_PLAN_KEY % int(intervention_point_id)
+
+
+def get_deploy_plan(intervention_point_id):
+    """ Returns the deploy plan for the intervention point, building and
+        caching it if it is not already in the cache.  Raises a 404 if the
+        intervention point does not exist. """
+    key = deploy_plan_key(intervention_point_id)
+    plan = cache.get(key)
+    if plan is None:
+        plan = build_deploy_plan(intervention_point_id)
+        cache.set(key, plan, settings.DEPLOY_PLAN_CACHE_TIMEOUT)
+    return plan
+
+
+def build_deploy_plan(intervention_point_id):
+    """ Builds a denormalized dict of everything deploy_intervention_point
+        needs to know about an intervention point, so that a student launch
+        doesn't have to touch the InterventionPoint, Experiment or
+        InterventionPointUrl tables.  The dict is of the form:
+            {"course_id": course_id(str),
+             "experiment_id": experiment_id(int),
+             "tracks_finalized": True/False,
+             "assignment_method": assignment_method(int),
+             "track_urls": {track_id(int): {"url": url(str),
+                                            "open_as_tab": True/False,
+                                            "is_canvas_page": True/False,
+                                           }}
+            }
+    """
+    intervention_point = get_object_or_404(
+            InterventionPoint.objects.select_related("experiment"),
+            pk=intervention_point_id)
+    experiment = intervention_point.experiment
+    track_urls = {ip_url.track_id: {"url": ip_url.url,
+                                    "open_as_tab": ip_url.open_as_tab,
+                                    "is_canvas_page": ip_url.is_canvas_page}
+                  for ip_url in InterventionPointUrl.objects.filter(
+                          intervention_point_id=intervention_point.id)}
+    return {"course_id": intervention_point.course_id,
+            "experiment_id": experiment.id,
+            "tracks_finalized": experiment.tracks_finalized,
+            "assignment_method": experiment.assignment_method,
+            "track_urls": track_urls}
+
+
+def invalidate_deploy_plans(intervention_point_ids):
+    keys = [deploy_plan_key(i) for i in intervention_point_ids]
+    if keys:
+        cache.delete_many(keys)
+
+
+def student_assignment_key(experiment_id, student_id):
+    return STUDENT_ASSIGNMENT_KEY % (int(experiment_id), student_id)
+
+
+def get_student_assignment(experiment_id, student_id):
+    """ Returns the cached assignment of the student (by sis id) in the
+        experiment, or None if it isn't cached.  The assignment is a dict of
+        the form {"id": experiment_student_id(int), "track_id": track_id(int)} """
+    return cache.get(student_assignment_key(experiment_id, student_id))
+
+
+def cache_student_assignment(student):
+    """ Writes the assignment of the ExperimentStudent to the cache and returns
+        it.  Assignments never change once they are made, so this should be
+        called wherever students are created. """
+    assignment = {"id": student.id, "track_id": student.track_id}
+    cache.set(student_assignment_key(student.experiment_id, student.student_id),
+              assignment, settings.STUDENT_ASSIGNMENT_CACHE_TIMEOUT)
+    return assignment
+
+
+def cache_student_assignments(students):
+    """ Bulk version of cache_student_assignment """
+    cache.set_many({student_assignment_key(s.experiment_id, s.student_id):
+                    {"id": s.id, "track_id": s.track_id} for s in students},
+                   settings.STUDENT_ASSIGNMENT_CACHE_TIMEOUT)
+
+
+def invalidate_student_assignment(experiment_id, student_id):
+    cache.delete(student_assignment_key(experiment_id, student_id))
+
+
+def track_sampler_key(experiment_id):
+    return TRACK_SAMPLER_KEY % int(experiment_id)
+
+
+def get_track_sampler(experiment):
+    """ Returns the track sampler for the experiment, building and caching it
+        if it is not already in the cache """
+    key = track_sampler_key(experiment.id)
+    sampler = cache.get(key)
+    if sampler is None:
+        sampler = build_track_sampler(experiment)
+        cache.set(key, sampler, settings.DEPLOY_PLAN_CACHE_TIMEOUT)
+    return sampler
+
+
+def build_track_sampler(experiment):
+    """ Builds the data needed to pick a track for a new student with a
+        single query, in the form:
+            {"track_ids": [track_id(int), ...],
+             "cumulative_weights": [cumulative_weight(int), ...],
+            }
+        Uniform random experiments give every track a weight of 1.
+        cumulative_weights is None if a weighted experiment has a track
+        without a weight. """
+    rows = list(Track.objects.filter(experiment_id=experiment.id).order_by("id")
+                .values_list("id", "weight__weighting"))
+    track_ids = [track_id for track_id, _ in rows]
+    if experiment.assignment_method == Experiment.WEIGHTED_PROBABILITY_RANDOM:
+        weights = [weighting for _, weighting in rows]
+    else:
+        weights = [1] * len(rows)
+    if None in weights:
+        return {"track_ids": track_ids, "cumulative_weights": None}
+    cumulative_weights = []
+    total = 0
+    for weighting in weights:
+        total += weighting
+        cumulative_weights.append(total)
+    return {"track_ids": track_ids, "cumulative_weights": cumulative_weights}
+
+
+def invalidate_track_sampler(experiment_id):
+    cache.delete(track_sampler_key(experiment_id))
+
+
+def course_modules_key(course_id):
+    return COURSE_MODULES_KEY % course_id
+
+
+def get_course_modules(course_id):
+    """ Returns the cached list of Canvas modules (with their items) of the
+        course, or None if it isn't cached """
+    return cache.get(course_modules_key(course_id))
+
+
+def cache_course_modules(course_id, modules):
+    """ Canvas doesn't tell us when modules change, so these are only cached
+        for a short time and invalidated when we know an install is coming """
+    cache.set(course_modules_key(course_id), modules, settings.CANVAS_MODULES_CACHE_TIMEOUT)
+
+
+def invalidate_course_modules(course_id):
+    cache.delete(course_modules_key(course_id))
@@ -1,57 +1,109 @@
+from multiprocessing.pool import ThreadPool
+
 from canvas_sdk.methods.courses import list_users_in_course_users
 from canvas_sdk.methods import modules
-from canvas_sdk import RequestContext
 from canvas_sdk.exceptions import CanvasAPIError
-from canvas_sdk.utils import get_all_list_data
 from django.conf import settings
+from django.db import transaction
+from django.db.models import CharField
+from django.utils import timezone
 
 from ab_tool.exceptions import (MISSING_LTI_PARAM, MISSING_LTI_LAUNCH,
-    NO_SDK_RESPONSE, NoValidCredentials, UNAUTHORIZED_ACCESS)
+    NO_SDK_RESPONSE, NoValidCredentials, UNAUTHORIZED_ACCESS, CANVAS_RATE_LIMITED)
 from django_canvas_oauth import get_token
-from ab_tool.controllers import intervention_point_url
-from ab_tool.models import InterventionPoint, Experiment, CourseNotification
+from ab_tool.controllers import intervention_point_url, case_by_id, STUDENT_WRITE_BATCH_SIZE
+from ab_tool.models import (InterventionPoint, Experiment,
+    ExperimentStudent, CourseRoster, CourseRosterStudent)
+from ab_tool.caching import get_course_modules, cache_course_modules
+from ab_tool.throttling import (call_canvas, call_canvas_all_pages,
+    get_canvas_concurrency, is_throttled)
+from ab_tool.connection_pools import PooledRequestContext
+from ab_tool.credentials import record_credential
 from django_canvas_oauth.exceptions import NewTokenNeeded
 
 
 class CanvasModules(object):
-    def __init__(self, request):
+    """ Answers questions about the Canvas modules of the current course.
+        Nothing is fetched from Canvas until a question needs it: module items
+        are then fetched CANVAS_API_CONCURRENCY modules at a time, stopping as
+        soon as the question is answered, and the installed urls found are
+        kept in an index that is reused by every later question.
+        
+        The modules of the course are cached briefly for display pages.  Canvas
+        doesn't tell us when items are installed or removed, so checks that
+        guard a delete pass use_cache=False to always ask Canvas. """
+    def __init__(self, request, use_cache=True):
         self.request_context = get_canvas_request_context(request)
         self.course_id = get_lti_param(request, "custom_canvas_course_id")
         # Only pass this attribute to intervention_point_url
         self.request = request
-        # self.modules is a list of module dicts
-        self.modules = list_modules(self.request_context, self.course_id)
-        for module in self.modules:
-            module["module_items"] = list_module_items(
-                    self.request_context, self.course_id, module["id"])
+        # The complete list of module dicts, once every module's items are known
+        self._modules = get_course_modules(self.course_id) if use_cache else None
+        # Modules whose items have (or have not yet) been fetched by a partial crawl
+        self._fetched_modules = []
+        self._unfetched_modules = None
+        self._installed_urls = set()
+        self._installed_by_id = None
+        self._experiments_with_installed = None
+        self._uninstalled_intervention_points = None
+        if self._modules is not None:
+            self._index(self._modules)
+    
+    @property
+    def modules(self):
+        """ The list of module dicts of the course, each with its list of items
+            under "module_items" """
+        self._crawl()
+        return self._modules
     
     def get_uninstalled_intervention_points(self):
         """ Returns the list of InterventionPoint objects that have been created for the
             current course but not installed in any of that course's modules """
-        installed_intervention_point_urls = self._get_installed_intervention_point_urls()
-        intervention_points = [intervention_point for intervention_point in
-                               InterventionPoint.objects.filter(course_id=self.course_id)
-                               if intervention_point_url(self.request, intervention_point.id)
-                               not in installed_intervention_point_urls]
-        return intervention_points
+        self._index_intervention_points()
+        return self._uninstalled_intervention_points
     
     def get_deletable_experiment_ids(self):
         """ Returns list of experiment ids for experiments that can be deleted
             (they have tracks_finalzed == False and no installed intervention
             points """
-        return [e.id for e in Experiment.objects.filter(course_id=self.course_id)
-                if not e.tracks_finalized
-                and not self.experiment_has_installed_intervention(e)]
+        self._index_intervention_points()
+        return [experiment_id for experiment_id in
+                Experiment.objects.filter(course_id=self.course_id, tracks_finalized=False
+                                          ).values_list("id", flat=True)
+                if experiment_id not in self._experiments_with_installed]
+    
+    def get_intervention_points_installed(self):
+        """ Returns a dict mapping the id of every intervention point of the
+            course to whether it is installed """
+        self._index_intervention_points()
+        return self._installed_by_id
+    
+    def _index_intervention_points(self):
+        """ Builds, with one query and one pass over the course's intervention
+            points, the intervention_point_id -> installed map, the set of ids
+            of experiments with an installed intervention point and the list
+            of uninstalled intervention points """
+        if self._installed_by_id is not None:
+            return
+        installed_urls = self._get_installed_intervention_point_urls()
+        self._installed_by_id = {}
+        self._experiments_with_installed = set()
+        self._uninstalled_intervention_points = []
+        for intervention_point in InterventionPoint.objects.filter(course_id=self.course_id):
+            installed = intervention_point_url(self.request, intervention_point.id) in installed_urls
+            self._installed_by_id[intervention_point.id] = installed
+            if installed:
+                self._experiments_with_installed.add(intervention_point.experiment_id)
+            else:
+                self._uninstalled_intervention_points.append(intervention_point)
     
     def intervention_point_is_installed(self, intervention_point):
-        return (intervention_point_url(self.request, intervention_point.id) in
-                self._get_installed_intervention_point_urls())
+        return self._any_installed([intervention_point_url(self.request, intervention_point.id)])
     
     def experiment_has_installed_intervention(self, experiment):
-        """ Checks to see if a experiment has any intervention points installed.
-            For Python2.6+, the built-in isdisjoint provides the fastest return"""
-        return not set([intervention_point_url(self.request, ip.id) for ip in
-               experiment.intervention_points.all()]).isdisjoint(set(self._get_installed_intervention_point_urls()))
+        """ Checks to see if a experiment has any intervention points installed """
+        return self._any_installed([intervention_point_url(self.request, ip_id) for ip_id in
+                                    experiment.intervention_points.values_list("id", flat=True)])
     
     def get_modules_with_items(self):
         """ Returns a list of all modules with the items of that module added to the
@@ -74,24 +126,98 @@ class CanvasModules(object):
         """ Returns a dict of deploy urls to intervention points of all intervention_points
             in the database for that course"""
         return {intervention_point_url(self.request, intervention_point.id): intervention_point
-                for intervention_point in InterventionPoint.objects.filter(course_id=self.course_id)}
+                for intervention_point in InterventionPoint.objects.filter(
+                        course_id=self.course_id).select_related("experiment")}
     
     def _get_installed_intervention_point_urls(self):
-        """ Returns the list of InterventionPointUrls (as strings) for InterventionPoints
-            that have been installed in at least one of the courses modules. """
-        installed_intervention_point_urls = []
-        for module in self.modules:
-            intervention_point_urls = [item["external_url"] for item in module["module_items"]
-                          if item["type"] == "ExternalTool"]
-            installed_intervention_point_urls.extend(intervention_point_urls)
-        return installed_intervention_point_urls
+        """ Returns the set of urls (as strings) of the ExternalTool items installed
+            in at least one of the course's modules. """
+        self._crawl()
+        return self._installed_urls
+    
+    def _any_installed(self, urls):
+        """ Returns whether any of urls is installed, fetching only as many
+            modules as it takes to find one """
+        urls = set(urls)
+        if not urls:
+            return False
+        self._crawl(until=lambda: not urls.isdisjoint(self._installed_urls))
+        return not urls.isdisjoint(self._installed_urls)
+    
+    def _crawl(self, until=None):
+        """ Fetches the items of the modules that haven't been fetched yet, a
+            batch at a time, until `until` returns True or every module has been
+            fetched.  Once every module has been fetched the modules are cached. """
+        if self._modules is not None:
+            return
+        if self._unfetched_modules is None:
+            self._unfetched_modules = list_modules(self.request_context, self.course_id)
+        while self._unfetched_modules and not (until and until()):
+            batch = self._unfetched_modules[:get_canvas_concurrency(self.request_context)]
+            del self._unfetched_modules[:len(batch)]
+            fetch_module_items(self.request_context, self.course_id, batch)
+            self._fetched_modules.extend(batch)
+            self._index(batch)
+        if not self._unfetched_modules:
+            self._modules = self._fetched_modules
+            cache_course_modules(self.course_id, self._modules)
+    
+    def _index(self, modules):
+        for module in modules:
+            self._installed_urls.update(item["external_url"] for item in module["module_items"]
+                                        if item["type"] == "ExternalTool")
+
+
+def fetch_modules_with_items(request_context, course_id):
+    """ Returns the list of module dicts of the course, each with its list of
+        items added under "module_items" """
+    return fetch_module_items(request_context, course_id,
+                              list_modules(request_context, course_id))
+
+
+def fetch_module_items(request_context, course_id, course_modules):
+    """ Adds the list of items of each of course_modules under "module_items"
+        and returns course_modules.  The items are fetched concurrently by at
+        most CANVAS_API_CONCURRENCY threads, which share the connection pool of
+        request_context's session. """
+    if not course_modules:
+        return course_modules
+    def fetch_items(module):
+        return list_module_items(request_context, course_id, module["id"])
+    pool = ThreadPool(min(get_canvas_concurrency(request_context), len(course_modules)))
+    try:
+        # map re-raises the first exception (e.g. NewTokenNeeded) of any fetch
+        module_items = pool.map(fetch_items, course_modules)
+    finally:
+        pool.terminate()
+    for module, items in zip(course_modules, module_items):
+        module["module_items"] = items
+    return course_modules
 
 
 def experiments_with_unassigned_students(request, course_id):
-    return [experiment.id for experiment in
-            Experiment.objects.filter(assignment_method=Experiment.CSV_UPLOAD,
-                                      course_id=course_id)
-            if get_unassigned_students(request, experiment)]
+    """ Returns the ids of the course's CSV upload experiments that have students
+        without a track.  The course roster is fetched from Canvas once and
+        compared with the assigned students of every experiment, which are
+        loaded with a single query. """
+    experiment_ids = list(Experiment.objects.filter(assignment_method=Experiment.CSV_UPLOAD,
+                                                    course_id=course_id).values_list("id", flat=True))
+    if not experiment_ids:
+        return []
+    roster = get_course_roster(get_canvas_request_context(request), course_id)
+    assigned_student_ids = get_assigned_student_ids(experiment_ids)
+    return [experiment_id for experiment_id in experiment_ids
+            if not assigned_student_ids[experiment_id].issuperset(roster)]
+
+
+def get_assigned_student_ids(experiment_ids):
+    """ Returns a dict mapping each of experiment_ids to the set of sis ids of
+        the students that have been assigned a track in that experiment """
+    assigned_student_ids = {experiment_id: set() for experiment_id in experiment_ids}
+    for experiment_id, student_id in ExperimentStudent.objects.filter(
+            experiment_id__in=experiment_ids).values_list("experiment_id", "student_id"):
+        assigned_student_ids[experiment_id].add(student_id)
+    return assigned_student_ids
 
 
 def get_unassigned_students(request, experiment):
@@ -114,11 +240,21 @@ def get_unassigned_students_with_stored_credentials(course_object, experiment):
         by sending an email request for new credentials """
     if experiment.course_id != course_object.course_id:
         raise UNAUTHORIZED_ACCESS
+    roster = get_course_roster_with_stored_credentials(course_object)
+    existing_student_ids = get_assigned_student_ids([experiment.id])[experiment.id]
+    return {sis_user_id: name for sis_user_id, name in roster.iteritems()
+            if sis_user_id not in existing_student_ids}
+
+
+def get_course_roster_with_stored_credentials(course_object):
+    """ Returns the course's roster (as get_course_roster), trying each of the
+        course's stored credentials in turn.  Raises NoValidCredentials if none
+        of the credentials work for the API call. """
     for credential in course_object.credentials.all():
         try:
             # Creates custom RequestContext with one of the CourseCredentials for the CourseNotification
-            request_context = RequestContext(credential.token, course_object.canvas_url)
-            return get_unassigned_students_with_context(request_context, experiment)
+            request_context = PooledRequestContext(credential.token, course_object.canvas_url)
+            return get_course_roster(request_context, course_object.course_id)
         except NewTokenNeeded:
             continue
     raise NoValidCredentials("There are no valid credentials for course %s" %
@@ -126,33 +262,88 @@ def get_unassigned_students_with_stored_credentials(course_object, experiment):
 
 
 def get_unassigned_students_with_context(request_context, experiment):
-    """ Returns a list of sis_user_ids because that is the unique
-        identifier the ab_tool users for students """
+    """ Returns a dict of sis_user_ids to names of the students of the course
+        without a track in the experiment; sis_user_ids are used because that
+        is the unique identifier the ab_tool uses for students """
+    roster = get_course_roster(request_context, experiment.course_id)
+    existing_student_ids = get_assigned_student_ids([experiment.id])[experiment.id]
+    return {sis_user_id: name for sis_user_id, name in roster.iteritems()
+            if sis_user_id not in existing_student_ids}
+
+
+def get_course_roster(request_context, course_id):
+    """ Returns a dict of the sis_user_ids of the students enrolled in the
+        course to their names, from the local copy of the course's roster.
+        The local copy is synced with Canvas first if it is older than
+        COURSE_ROSTER_MAX_AGE. """
+    roster = CourseRoster.objects.get_or_create(course_id=course_id)[0]
+    if roster.is_stale():
+        sync_course_roster(request_context, course_id)
+    return roster.as_dict()
+
+
+def sync_course_roster(request_context, course_id):
+    """ Brings the local copy of the course's roster up to date with Canvas and
+        moves its watermark.  Canvas can't list only the enrollments changed
+        since the watermark, so the whole roster is fetched, but only students
+        that were added, renamed or removed are written.  The watermark is
+        the time the roster was fetched, so a sync whose fetch started before
+        the roster's last sync is skipped rather than writing an older copy
+        of the roster over a newer one. """
+    fetched_on = timezone.now()
+    enrollments = fetch_course_enrollments(request_context, course_id)
+    with transaction.atomic():
+        # Locks the roster so that concurrent syncs of a course are applied one at a time
+        roster = CourseRoster.objects.select_for_update().get_or_create(course_id=course_id)[0]
+        if roster.last_synced is not None and roster.last_synced >= fetched_on:
+            return roster
+        existing = {sis_user_id: (student_id, name) for student_id, sis_user_id, name
+                    in roster.students.values_list("id", "sis_user_id", "name")}
+        removed_ids = [student_id for sis_user_id, (student_id, _) in existing.iteritems()
+                       if sis_user_id not in enrollments]
+        if removed_ids:
+            CourseRosterStudent.objects.filter(id__in=removed_ids).delete()
+        renamed = [(existing[sis_user_id][0], {"name": name})
+                   for sis_user_id, name in enrollments.iteritems()
+                   if sis_user_id in existing and existing[sis_user_id][1] != name]
+        for i in range(0, len(renamed), STUDENT_WRITE_BATCH_SIZE):
+            batch = dict(renamed[i:i + STUDENT_WRITE_BATCH_SIZE])
+            CourseRosterStudent.objects.filter(id__in=batch.keys()).update(
+                    name=case_by_id(batch, "name", CharField()))
+        CourseRosterStudent.objects.bulk_create(
+                [CourseRosterStudent(roster=roster, sis_user_id=sis_user_id, name=name)
+                 for sis_user_id, name in enrollments.iteritems() if sis_user_id not in existing])
+        roster.update(last_synced=fetched_on)
+    return roster
+
+
+def fetch_course_enrollments(request_context, course_id):
+    """ Returns a dict of the sis_user_ids of the students enrolled in the
+        course to their names, fetched from Canvas """
     try:
         """
         Part of TLT-949 add get_all_list_data call to get the full list of students in the course
+        (call_canvas_all_pages pages through the list as get_all_list_data does)
         """
-        enrollments = get_all_list_data(request_context, list_users_in_course_users, experiment.course_id, None, enrollment_type="student")
-
+        enrollments = call_canvas_all_pages(request_context, list_users_in_course_users,
+                                            course_id, None, enrollment_type="student")
     except CanvasAPIError as exception:
         handle_canvas_error(exception)
-    existing_student_ids = set(s.student_id for s in experiment.students.all())
-    return {i["sis_user_id"] : i["name"] for i in enrollments
-            if i["sis_user_id"] not in existing_student_ids}
+    return {i["sis_user_id"]: i["name"] for i in enrollments}
 
 
 def list_module_items(request_context, course_id, module_id):
     try:
-        return modules.list_module_items(request_context, course_id, module_id,
-                                         "content_details").json()
+        return call_canvas(request_context, modules.list_module_items, course_id, module_id,
+                           "content_details").json()
     except CanvasAPIError as exception:
         handle_canvas_error(exception)
 
 
 def list_modules(request_context, course_id):
     try:
-        return modules.list_modules(request_context, course_id,
-                                    "content_details").json()
+        return call_canvas(request_context, modules.list_modules, course_id,
+                           "content_details").json()
     except CanvasAPIError as exception:
         handle_canvas_error(exception)
 
@@ -180,11 +371,13 @@ def get_canvas_request_context(request):
     email = get_lti_param(request, "lis_person_contact_email_primary")
     course_id = get_lti_param(request, "custom_canvas_course_id")
     # This stores a credential to be added to list of CourseCredentials for the CourseNotification
-    CourseNotification.store_credential(course_id, canvas_url, email, oauth_token)
-    return RequestContext(oauth_token, canvas_url)
+    record_credential(course_id, canvas_url, email, oauth_token)
+    return PooledRequestContext(oauth_token, canvas_url)
 
 
 def handle_canvas_error(exception):
     if exception.status_code == 401:
         raise NewTokenNeeded("Your canvas oauth token is invalid")
+    if is_throttled(exception):
+        raise CANVAS_RATE_LIMITED
     raise NO_SDK_RESPONSE
@@ -0,0 +1,85 @@
+""" Keep-alive HTTP connection pools for Canvas API calls.
+
+canvas_sdk gives every RequestContext its own requests session, so every
+context the tool created used to open (and TLS handshake) new connections to
+Canvas.  This keeps one connection pool (an HTTPAdapter) per Canvas host per
+process, and PooledRequestContext mounts it on the session of each context.
+Only the pools are shared: sessions, which carry each user's token, are not.
+"""
+import threading
+from urlparse import urlparse
+
+from canvas_sdk import RequestContext
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """ HTTPAdapter that applies a default timeout to requests made without one """
+    def __init__(self, timeout=None, *args, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pool_stats = {"hits": 0, "misses": 0}
+
+
+def pool_prefix(base_url):
+    """ Returns the scheme and host of base_url, which is the prefix the pool
+        is mounted at so that it also serves pagination links """
+    parsed = urlparse(base_url)
+    return "%s://%s/" % (parsed.scheme, parsed.netloc)
+
+
+def get_connection_pool(base_url):
+    """ Returns the process-wide connection pool for the host of base_url,
+        creating it on first use """
+    prefix = pool_prefix(base_url)
+    with _pools_lock:
+        pool = _pools.get(prefix)
+        if pool is None:
+            _pool_stats["misses"] += 1
+            pool = TimeoutHTTPAdapter(
+                    timeout=(settings.CANVAS_HTTP_CONNECT_TIMEOUT, settings.CANVAS_HTTP_READ_TIMEOUT),
+                    pool_connections=1, pool_maxsize=settings.CANVAS_HTTP_POOL_SIZE)
+            _pools[prefix] = pool
+        else:
+            _pool_stats["hits"] += 1
+    return pool
+
+
+def get_pool_stats():
+    """ Returns the number of pools and how many times a context found an
+        existing pool (hits) or had to create one (misses) """
+    with _pools_lock:
+        return dict(_pool_stats, pools=len(_pools))
+
+
+def reset_pools():
+    """ Closes and forgets every pool and zeroes the counters """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+        _pool_stats["hits"] = _pool_stats["misses"] = 0
+
+
+class PooledRequestContext(RequestContext):
+    """ RequestContext whose session sends requests to the Canvas host through
+        the shared connection pool of that host """
+    @property
+    def session(self):
+        session = super(PooledRequestContext, self).session
+        # canvas_sdk replaces sessions that have been inactive for a while, so
+        # each new session needs the pool mounting
+        if getattr(session, "_canvas_pool_mounted", False) is not True:
+            session.mount(pool_prefix(self.base_api_url), get_connection_pool(self.base_api_url))
+            session._canvas_pool_mounted = True
+        return session
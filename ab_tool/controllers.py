@@ -1,18 +1,34 @@
 import csv
+import logging
+import time
 from django.conf import settings
-from django.http.response import StreamingHttpResponse
+from django.db import transaction, IntegrityError
+from django.db.models import (BooleanField, Case, CharField, Count, IntegerField,
+    Value, When)
+from django.http.response import StreamingHttpResponse, Http404
+from django.utils import timezone
 from django.core.urlresolvers import reverse
 from django.core.mail import send_mail
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
-from random import choice
+from bisect import bisect_right
+from random import randrange
 
-from ab_tool.models import (TrackProbabilityWeight, Experiment, ExperimentStudent)
+from ab_tool.models import (TrackProbabilityWeight, Experiment, ExperimentStudent,
+    Track, InterventionPoint, InterventionPointUrl)
 from ab_tool.exceptions import (BAD_INTERVENTION_POINT_ID, missing_param_error,
     NO_TRACKS_FOR_EXPERIMENT, TRACK_WEIGHTS_NOT_SET,
     CSV_UPLOAD_NEEDED, INVALID_URL_PARAM, INCORRECT_WEIGHTING_PARAM,
-    MISSING_NAME_PARAM, PARAM_LENGTH_EXCEEDS_LIMIT, INPUT_NOT_ALLOWED)
+    MISSING_NAME_PARAM, PARAM_LENGTH_EXCEEDS_LIMIT, INPUT_NOT_ALLOWED,
+    UNAUTHORIZED_ACCESS, DATABASE_ERROR)
 from ab_tool.constants import (NAME_CHAR_LIMIT)
+from ab_tool.caching import (cache_student_assignment, cache_student_assignments,
+    get_track_sampler)
+
+
+logger = logging.getLogger(__name__)
+
+STUDENT_WRITE_BATCH_SIZE = 500
 
 
 def assign_track_and_create_student(experiment, student_id, student_name):
@@ -22,31 +38,78 @@ def assign_track_and_create_student(experiment, student_id, student_name):
         # Raise error as student should have already been assigned a track if CSV upload
         #TODO: infrastructure needed notify course administrator about incomplete student-track mapping
         raise CSV_UPLOAD_NEEDED
-    tracks = experiment.tracks.all()
-    if not tracks:
+    sampler = get_track_sampler(experiment)
+    track_ids = sampler["track_ids"]
+    cumulative_weights = sampler["cumulative_weights"]
+    if not track_ids:
         raise NO_TRACKS_FOR_EXPERIMENT
-    if experiment.assignment_method == Experiment.UNIFORM_RANDOM:
-        # If uniform, pick randomly from the set of tracks
-        chosen_track = choice(tracks)
-    if experiment.assignment_method == Experiment.WEIGHTED_PROBABILITY_RANDOM:
-        # If weighted, generate a weighted list of tracks and pick one randomly from list
-        weighted_tracks = []
-        for track in tracks:
-            try:
-                track_weight = TrackProbabilityWeight.objects.get(track=track, experiment=experiment)
-            except TrackProbabilityWeight.DoesNotExist:
-                raise TRACK_WEIGHTS_NOT_SET
-            weighted_tracks.extend([track] * track_weight.weighting)
-        chosen_track = choice(weighted_tracks)
+    # Weighted experiments need a weight for every track and at least one
+    # non-zero weight; uniform experiments give every track a weight of 1
+    if cumulative_weights is None or not cumulative_weights[-1]:
+        raise TRACK_WEIGHTS_NOT_SET
+    # Pick a point in [0, total weight) and find the track whose cumulative
+    # weight range contains it.  Tracks with a weight of 0 are never chosen.
+    chosen_track_id = track_ids[bisect_right(cumulative_weights,
+                                             randrange(cumulative_weights[-1]))]
     # Create student with chosen track
     student = ExperimentStudent.objects.create(
             student_id=student_id, course_id=experiment.course_id,
-            track=chosen_track, student_name=student_name,
+            track_id=chosen_track_id, student_name=student_name,
             experiment=experiment
     )
+    cache_student_assignment(student)
     return student
 
 
+def save_track_assignments(experiment, assignments, student_names):
+    """ Saves the tracks of students uploaded for a CSV upload experiment and
+        finalizes its tracks, all in one transaction.  assignments is a dict
+        of {student_id: track} and student_names a dict of
+        {student_id: student_name}.  Assignments never change once made, so
+        students already in the experiment (e.g. assigned since the upload was
+        checked) keep their track and are skipped; the rest are bulk inserted.
+        Returns the number of students saved and the sorted ids of the
+        students skipped. """
+    start = time.time()
+    with transaction.atomic():
+        # Locking the experiment keeps concurrent uploads for it from
+        # inserting the same students
+        list(Experiment.objects.select_for_update().filter(id=experiment.id).values_list("id"))
+        existing_ids = set()
+        for student_ids in _in_batches(assignments.keys()):
+            existing_ids.update(ExperimentStudent.objects.filter(
+                    experiment=experiment, student_id__in=student_ids
+            ).values_list("student_id", flat=True))
+        # lis_person_sourcedid is not returned by SDK, so we set it to None
+        new_students = [ExperimentStudent(
+                student_id=student_id, course_id=experiment.course_id,
+                track=track, student_name=student_names[student_id],
+                experiment=experiment)
+                for student_id, track in assignments.iteritems()
+                if student_id not in existing_ids]
+        ExperimentStudent.objects.bulk_create(new_students, batch_size=STUDENT_WRITE_BATCH_SIZE)
+        if not experiment.tracks_finalized:
+            experiment.update(tracks_finalized=True)
+    # bulk_create doesn't send signals or return ids, so the saved students
+    # are read back to write their assignments to the cache
+    for student_ids in _in_batches([s.student_id for s in new_students]):
+        cache_student_assignments(ExperimentStudent.objects.filter(
+                experiment=experiment, student_id__in=student_ids
+        ).only("id", "experiment", "student_id", "track"))
+    elapsed = time.time() - start
+    logger.info("Saved %s track assignments (%s already assigned) for experiment %s in %.2fs "
+                "(%.0f rows/s)", len(new_students), len(existing_ids), experiment.id,
+                elapsed, len(new_students) / elapsed if elapsed else 0)
+    return len(new_students), sorted(existing_ids)
+
+
+def _in_batches(items):
+    """ Yields successive slices of at most STUDENT_WRITE_BATCH_SIZE of the
+        list items, keeping `IN` clauses on student ids to a bounded size """
+    for i in range(0, len(items), STUDENT_WRITE_BATCH_SIZE):
+        yield items[i:i + STUDENT_WRITE_BATCH_SIZE]
+
+
 def intervention_point_url(request, intervention_point_id):
     """ Builds a URL to deploy the intervention_point with the database id
         intervention_point_id """
@@ -73,6 +136,123 @@ def validate_weighting(weighting):
     return weighting
 
 
+def save_experiment_tracks(experiment, track_dicts, weighted, names_only=False):
+    """ Saves the "tracks" of an experiment posted by edit_experiment.js, a
+        list of dicts with an "id" (None for new tracks), a "name" and a
+        "weighting".  Existing tracks are renamed and new tracks created; if
+        weighted, every track's weight is set.  If names_only, new tracks are
+        ignored and existing tracks are only renamed.
+        
+        Every track is validated and the existing tracks are loaded (with
+        their weights, in one query) before anything is written, and each
+        kind of change is written with a single query.  This should be called
+        in a transaction so that an error leaves the experiment unchanged.
+        The writes don't send signals, so callers must invalidate the
+        experiment's track sampler afterwards. """
+    if names_only:
+        track_dicts = [t for t in track_dicts if t["id"] is not None]
+    submitted = [(None if t["id"] is None else int(t["id"]), validate_name(t["name"]),
+                  validate_weighting(t["weighting"]) if weighted else None)
+                 for t in track_dicts]
+    existing_ids = [track_id for track_id, _, _ in submitted if track_id is not None]
+    tracks = {track.id: track for track in
+              Track.objects.filter(id__in=existing_ids).select_related("weight")}
+    for track_id in existing_ids:
+        if track_id not in tracks:
+            raise Http404
+        if tracks[track_id].course_id != experiment.course_id:
+            raise UNAUTHORIZED_ACCESS
+    try:
+        _write_experiment_tracks(experiment, submitted, tracks, weighted)
+    except IntegrityError as e:
+        # e.g. two tracks with the same name; saving objects one at a time
+        # raises the same error (see TimestampedModel.save)
+        raise DATABASE_ERROR(e.message)
+
+
+def _write_experiment_tracks(experiment, submitted, tracks, weighted):
+    now = timezone.now()
+    renamed = {track_id: name for track_id, name, _ in submitted
+               if track_id is not None and tracks[track_id].name != name}
+    if renamed:
+        Track.objects.filter(id__in=renamed.keys()).update(
+                name=Case(*[When(id=track_id, then=Value(name))
+                            for track_id, name in renamed.iteritems()],
+                          output_field=CharField()),
+                updated_on=now)
+    new_names = [name for track_id, name, _ in submitted if track_id is None]
+    if new_names:
+        Track.objects.bulk_create([Track(name=name, course_id=experiment.course_id,
+                                         experiment=experiment) for name in new_names])
+        # bulk_create doesn't set ids, so the new tracks are read back by
+        # name, which is unique within an experiment
+        new_track_ids = dict(experiment.tracks.filter(name__in=new_names)
+                             .values_list("name", "id"))
+    if not weighted:
+        return
+    
+    reweighted = {}
+    new_weights = []
+    for track_id, name, weighting in submitted:
+        if track_id is None:
+            track_id = new_track_ids[name]
+        elif tracks[track_id].get_weighting() is not None:
+            weight = tracks[track_id].weight
+            if weight.weighting != weighting:
+                reweighted[weight.id] = weighting
+            continue
+        new_weights.append(TrackProbabilityWeight(
+                track_id=track_id, weighting=weighting, experiment=experiment,
+                course_id=experiment.course_id))
+    if reweighted:
+        TrackProbabilityWeight.objects.filter(id__in=reweighted.keys()).update(
+                weighting=Case(*[When(id=weight_id, then=Value(weighting))
+                                 for weight_id, weighting in reweighted.iteritems()],
+                               output_field=IntegerField()),
+                updated_on=now)
+    if new_weights:
+        TrackProbabilityWeight.objects.bulk_create(new_weights)
+
+
+def save_intervention_point_urls(intervention_point_id, track_urls):
+    """ Saves the urls of an intervention point from a dict of
+        {track_id(int): {"url": url(str),
+                         "is_canvas_page": True/False,
+                         "open_as_tab": True/False,
+                        }}
+        The existing InterventionPointUrls of those tracks are read with one
+        query; the changed ones are updated with a single query and the
+        missing ones bulk created, so this should be called in a
+        transaction.  The writes don't send signals, so callers must
+        invalidate the intervention point's deploy plan afterwards. """
+    existing = {ip_url.track_id: ip_url for ip_url in InterventionPointUrl.objects.filter(
+            intervention_point_id=intervention_point_id, track_id__in=track_urls.keys())}
+    changed = {ip_url.id: track_urls[track_id] for track_id, ip_url in existing.iteritems()
+               if any(getattr(ip_url, field) != value
+                      for field, value in track_urls[track_id].iteritems())}
+    try:
+        if changed:
+            InterventionPointUrl.objects.filter(id__in=changed.keys()).update(
+                    url=case_by_id(changed, "url", CharField()),
+                    is_canvas_page=case_by_id(changed, "is_canvas_page", BooleanField()),
+                    open_as_tab=case_by_id(changed, "open_as_tab", BooleanField()),
+                    updated_on=timezone.now())
+        InterventionPointUrl.objects.bulk_create(
+                [InterventionPointUrl(intervention_point_id=intervention_point_id,
+                                      track_id=track_id, **fields)
+                 for track_id, fields in track_urls.iteritems() if track_id not in existing])
+    except IntegrityError as e:
+        raise DATABASE_ERROR(e.message)
+
+
+def case_by_id(values_by_id, field, output_field):
+    """ Returns an expression that sets each row's `field` to
+        values_by_id[row id][field] in an UPDATE """
+    return Case(*[When(id=object_id, then=Value(values[field]))
+                  for object_id, values in values_by_id.iteritems()],
+                output_field=output_field)
+
+
 def validate_format_url(url):
     validator = URLValidator()
     """ Adds "http://" to the beginning of a url if it isn't there """
@@ -87,24 +267,28 @@ def validate_format_url(url):
         raise INVALID_URL_PARAM
 
 
-def get_incomplete_intervention_points(intervention_point_list):
-    """ Takes paramter intervention_point_list instead of parameter course_id to avoid
-        second database call to the InterventionPoint table in methods that needs to
-        already fetch the InterventionPoint table"""
-    return [intervention_point.name for intervention_point in intervention_point_list
-            if intervention_point.is_missing_urls()]
-
-
-def get_missing_track_weights(experiment, course_id):
-    if experiment.assignment_method != Experiment.WEIGHTED_PROBABILITY_RANDOM:
-        return []
-    missing_weights = []
-    track_weights = [t.track for t in
-                     TrackProbabilityWeight.objects.filter(course_id=course_id, experiment=experiment)]
-    for track in experiment.tracks.all():
-        if track not in track_weights:
-            missing_weights.append(track)
-    return [track.name for track in missing_weights]
+def check_experiment_complete(experiment):
+    """ Returns what is still needed before the experiment's tracks can be
+        finalized, in two queries whatever the size of the experiment, as
+        (track_names, incomplete_intervention_point_names,
+         missing_track_weight_names).  An intervention point is incomplete
+        (see InterventionPoint.is_missing_urls) if it doesn't have a url for
+        every track or any of its urls is blank; track weights are only
+        needed for weighted experiments. """
+    tracks = list(experiment.tracks.order_by("id").values_list("name", "weight__id"))
+    track_names = [name for name, _ in tracks]
+    if experiment.assignment_method == Experiment.WEIGHTED_PROBABILITY_RANDOM:
+        missing_track_weight_names = [name for name, weight_id in tracks if weight_id is None]
+    else:
+        missing_track_weight_names = []
+    intervention_points = experiment.intervention_points.order_by("id").annotate(
+            num_urls=Count("interventionpointurl"),
+            num_blank_urls=Count(Case(When(interventionpointurl__url="", then=Value(1))))
+    ).values_list("name", "num_urls", "num_blank_urls")
+    incomplete_intervention_point_names = [
+            name for name, num_urls, num_blank_urls in intervention_points
+            if num_urls != len(tracks) or num_blank_urls]
+    return track_names, incomplete_intervention_point_names, missing_track_weight_names
 
 
 def format_weighting(weighting):
@@ -131,6 +315,50 @@ class Echo(object):
         return value
 
 
+def load_dashboard_experiments(course_id):
+    """ Loads the experiments of the course with everything the dashboard
+        shows about them in four queries, whatever the number of experiments.
+        Returns (experiments, intervention_points), where each experiment has
+        the extra attributes:
+            track_list: its tracks (with their weights), in id order
+            intervention_point_list: its intervention points, in id order
+            incomplete_intervention_point_names: as get_incomplete_intervention_point_names
+        and each intervention point has the extra attributes:
+            track_url_list: the InterventionPointUrl of each track of its
+                experiment, in track id order, with an unsaved one for tracks
+                that don't have a url yet; each has its track already set
+            missing_urls: as is_missing_urls """
+    experiments = list(Experiment.objects.filter(course_id=course_id).order_by("id"))
+    tracks_by_experiment = {e.id: [] for e in experiments}
+    for track in Track.objects.filter(course_id=course_id).select_related("weight").order_by("id"):
+        tracks_by_experiment.setdefault(track.experiment_id, []).append(track)
+    urls_by_intervention_point = {}
+    for ip_url in InterventionPointUrl.objects.filter(intervention_point__course_id=course_id):
+        urls_by_intervention_point.setdefault(ip_url.intervention_point_id, {})[ip_url.track_id] = ip_url
+    intervention_points_by_experiment = {e.id: [] for e in experiments}
+    intervention_points = list(InterventionPoint.objects.filter(course_id=course_id).order_by("id"))
+    for intervention_point in intervention_points:
+        tracks = tracks_by_experiment.get(intervention_point.experiment_id, [])
+        ip_urls = urls_by_intervention_point.get(intervention_point.id, {})
+        track_url_list = []
+        for track in tracks:
+            ip_url = ip_urls.get(track.id) or InterventionPointUrl(track=track)
+            # Avoids a query for the track when the template reads it
+            ip_url.track = track
+            track_url_list.append(ip_url)
+        intervention_point.track_url_list = track_url_list
+        intervention_point.missing_urls = (len(tracks) != len(ip_urls) or
+                                           any(not ip_url.url for ip_url in ip_urls.values()))
+        intervention_points_by_experiment.setdefault(intervention_point.experiment_id, []
+                                                     ).append(intervention_point)
+    for experiment in experiments:
+        experiment.track_list = tracks_by_experiment[experiment.id]
+        experiment.intervention_point_list = intervention_points_by_experiment[experiment.id]
+        experiment.incomplete_intervention_point_names = [
+                ip.name for ip in experiment.intervention_point_list if ip.missing_urls]
+    return experiments, intervention_points
+
+
 def streamed_csv_response(row_generator, file_title):
     """ Returns a streaming csv response containing the rows generated by row_generator """
     writer = csv.writer(Echo())
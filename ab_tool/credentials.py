@@ -0,0 +1,118 @@
+""" Recording of the Canvas credentials of course admins.
+
+Every request that talks to Canvas records the admin's credential (see
+CourseNotification.store_credential) so that the unassigned_students command
+can call Canvas for the course later.  Admins make many such requests with the
+same token, so a fingerprint of each credential written is kept in the cache
+for COURSE_CREDENTIAL_CACHE_TIMEOUT and requests with an unchanged credential
+don't touch the database at all.
+
+Changed credentials are queued in process and written together by a background
+thread every COURSE_CREDENTIAL_FLUSH_INTERVAL_SECS, keeping only the latest
+token of each admin, so that concurrent admins of a course don't contend on
+its rows during their requests.  The fingerprint is only cached once the write
+has committed, so a credential whose write failed (or was lost with its
+process) is queued again by the admin's next request, and a batch whose
+write failed is queued again for the next flush.  With an interval of 0
+credentials are written in the request.
+"""
+import atexit
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from ab_tool.models import CourseNotification
+
+
+logger = logging.getLogger(__name__)
+
+COURSE_CREDENTIAL_KEY = "course_credential_%s"
+
+
+def course_credential_key(course_id, canvas_url, email, oauth_token):
+    # The fingerprint is hashed so that tokens don't end up in cache keys
+    fingerprint = u"%s\n%s\n%s\n%s" % (course_id, canvas_url, email, oauth_token)
+    return COURSE_CREDENTIAL_KEY % hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()
+
+
+_pending = {}
+_pending_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_worker = None
+
+
+def record_credential(course_id, canvas_url, email, oauth_token):
+    """ Records the admin's credential for the course unless the same
+        credential was recorded recently.  Returns whether it was written or
+        queued. """
+    if cache.get(course_credential_key(course_id, canvas_url, email, oauth_token)):
+        return False
+    if not settings.COURSE_CREDENTIAL_FLUSH_INTERVAL_SECS:
+        _write_credentials([(course_id, canvas_url, email, oauth_token)])
+        return True
+    with _pending_lock:
+        _pending[(course_id, email)] = (canvas_url, oauth_token)
+    _ensure_worker()
+    return True
+
+
+def flush_credentials():
+    """ Writes every queued credential and returns the number written """
+    with _flush_lock:
+        with _pending_lock:
+            credentials = [(course_id, canvas_url, email, oauth_token)
+                           for (course_id, email), (canvas_url, oauth_token)
+                           in _pending.iteritems()]
+            _pending.clear()
+        if not credentials:
+            return 0
+        try:
+            return _write_credentials(credentials)
+        except Exception:
+            logger.exception("Failed to write %s course credentials, requeueing them",
+                             len(credentials))
+            with _pending_lock:
+                for course_id, canvas_url, email, oauth_token in credentials:
+                    # Credentials recorded since are newer and are kept instead
+                    _pending.setdefault((course_id, email), (canvas_url, oauth_token))
+            return 0
+
+
+def _write_credentials(credentials):
+    with transaction.atomic():
+        for credential in credentials:
+            CourseNotification.store_credential(*credential)
+    cache.set_many({course_credential_key(*credential): True for credential in credentials},
+                   settings.COURSE_CREDENTIAL_CACHE_TIMEOUT)
+    return len(credentials)
+
+
+def _ensure_worker():
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _pending_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="credential-writer")
+            _worker.daemon = True
+            _worker.start()
+
+
+def _run():
+    while True:
+        time.sleep(settings.COURSE_CREDENTIAL_FLUSH_INTERVAL_SECS)
+        try:
+            flush_credentials()
+        finally:
+            # The worker thread gets its own database connection, which is
+            # closed after every flush so that one broken by a database
+            # restart isn't reused by the next
+            connection.close()
+
+
+atexit.register(flush_credentials)
@@ -10,6 +10,7 @@ UNAUTHORIZED_ACCESS = Renderable403("Sorry, you do not have access to this cours
 ADMIN_VISIBLE_ERROR = """Sadly, there was a problem loading this page. Please try again.
  If the problem persists please notify your local academic support staff."""
 NO_SDK_RESPONSE = Renderable500(ADMIN_VISIBLE_ERROR)
+CANVAS_RATE_LIMITED = Renderable500("Canvas is receiving too many requests right now. Please wait a minute and try again.")
 MISSING_LTI_LAUNCH = Renderable400(ADMIN_VISIBLE_ERROR)
 MISSING_LTI_PARAM = Renderable400(ADMIN_VISIBLE_ERROR)
 BAD_INTERVENTION_POINT_ID = Renderable400(ADMIN_VISIBLE_ERROR)
@@ -24,6 +25,10 @@ UNAUTHORIZED_ACCESS = Renderable403("You do not have access to this course.")
 FILE_TOO_LARGE = Renderable403("Files over %sMB are not allowed for upload" %
                                (int(settings.MAX_FILE_UPLOAD_SIZE) / 1024 / 1024))
 
+XLS_FILE_TOO_LARGE = Renderable403("XLS files over %sMB are not allowed for upload, "
+                                   "save the file as XLSX or CSV instead" %
+                                   (int(settings.MAX_XLS_FILE_UPLOAD_SIZE) / 1024 / 1024))
+
 MISSING_RETURN_TYPES_PARAM = Renderable400("Invalid ext_content_return_types")
 
 MISSING_RETURN_URL = Renderable400("No ext_content_return_url")
@@ -0,0 +1,56 @@
+import logging
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ab_tool.analytics import archive_interactions, ARCHIVE_BATCH_SIZE
+from ab_tool.models import CourseNotification, InterventionPointInteraction
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Moves InterventionPointInteractions of courses that are no longer "
+            "active (installed more than COURSE_ACTIVE_DAYS ago) to the "
+            "interaction archive")
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--before',
+            dest='before',
+            default=None,
+            help='Archive every interaction created before this date (YYYY-MM-DD) '
+                 'instead of the interactions of inactive courses'
+        ),
+        make_option(
+            '--batch-size',
+            dest='batch_size',
+            type='int',
+            default=ARCHIVE_BATCH_SIZE,
+            help='Number of interactions moved per transaction'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['before']:
+            try:
+                before = datetime.strptime(options['before'], "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--before must be a date of the form YYYY-MM-DD")
+            before = timezone.make_aware(before, timezone.get_default_timezone())
+            interactions = InterventionPointInteraction.objects.filter(created_on__lt=before)
+        else:
+            cutoff = timezone.now() - timedelta(days=settings.COURSE_ACTIVE_DAYS)
+            inactive_course_ids = CourseNotification.objects.filter(
+                    created_on__lt=cutoff).values_list("course_id", flat=True)
+            interactions = InterventionPointInteraction.objects.filter(
+                    course_id__in=list(inactive_course_ids))
+        try:
+            moved = archive_interactions(interactions, batch_size=options['batch_size'])
+        except Exception:
+            logger.exception("Error encountered while archiving interactions")
+            raise CommandError("Failed to archive interactions")
+        self.stdout.write("Archived %s interactions" % moved)
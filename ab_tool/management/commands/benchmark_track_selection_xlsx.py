@@ -0,0 +1,59 @@
+import resource
+import time
+from multiprocessing import Process, Queue
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ab_tool.spreadsheets import build_track_selection_xlsx, XLSX_STREAM_CHUNK_SIZE
+
+
+TRACK_NAMES = ["Track A", "Track B", "Track C"]
+
+
+def measure_track_selection_xlsx(size, results):
+    """ Builds and reads through the track selection workbook of a roster of
+        `size` students, putting the elapsed time, file size and increase in
+        peak memory (in kB) on the results queue.  The roster is built before
+        the baseline is taken, so the increase only covers generating the
+        file.  Run in its own process so that each size starts from a fresh
+        peak. """
+    students = {str(10000000 + i): "Student %s" % i for i in range(size)}
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    output = build_track_selection_xlsx("Experiment", students, TRACK_NAMES)
+    file_size = 0
+    for chunk in iter(lambda: output.read(XLSX_STREAM_CHUNK_SIZE), ""):
+        file_size += len(chunk)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, file_size, peak - baseline))
+
+
+class Command(BaseCommand):
+    help = ("Measures the time and peak memory taken to generate the track "
+            "selection spreadsheet for rosters of increasing size")
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--sizes',
+            dest='sizes',
+            default="1000,10000,50000,100000",
+            help='Comma separated numbers of students to generate the spreadsheet for'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(",")]
+        except ValueError:
+            raise CommandError("--sizes must be a comma separated list of numbers")
+        self.stdout.write("%10s %10s %12s %16s" % ("students", "seconds", "file (kB)",
+                                                   "peak delta (kB)"))
+        for size in sizes:
+            results = Queue()
+            process = Process(target=measure_track_selection_xlsx, args=(size, results))
+            process.start()
+            elapsed, file_size, peak_delta = results.get()
+            process.join()
+            self.stdout.write("%10s %10.2f %12s %16s" % (size, elapsed, file_size / 1024,
+                                                         peak_delta))
@@ -0,0 +1,35 @@
+import logging
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ab_tool.analytics import FileInteractionSink
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Loads InterventionPointInteractions logged by the file interaction "
+            "sink into the database")
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--directory',
+            dest='directory',
+            default=None,
+            help='Directory of interaction log files to drain (defaults to the '
+                 'directory of the configured FileInteractionSink)'
+        ),
+    )
+    
+    def handle(self, *args, **options):
+        directory = options['directory'] or settings.INTERACTION_SINK.get('OPTIONS', {}).get('directory')
+        loaded = 0
+        if directory:
+            try:
+                loaded = FileInteractionSink(directory).drain()
+            except Exception:
+                logger.exception("Error encountered while draining interactions from %s", directory)
+                raise CommandError("Failed to drain interactions from %s" % directory)
+        self.stdout.write("Loaded %s interactions from log files" % loaded)
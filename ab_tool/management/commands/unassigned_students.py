@@ -1,37 +1,106 @@
 import logging
+import time
 import traceback
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection
 
-from ab_tool.canvas import get_unassigned_students_with_stored_credentials
+from ab_tool.canvas import (get_course_roster_with_stored_credentials,
+    get_assigned_student_ids)
 from ab_tool.exceptions import NoValidCredentials
-from ab_tool.models import Experiment
+from ab_tool.models import Experiment, CourseNotification
 from ab_tool.constants import (ASSIGN_STUDENTS_MESSAGE, NO_CREDENTIALS_MESSAGE)
 from ab_tool.controllers import send_email_notification
+from ab_tool.connection_pools import get_pool_stats
 
 
 logger = logging.getLogger(__name__)
 
+# Outcomes of handling a course, as counted in the summary
+NOTIFIED = "notified"
+NO_CREDENTIALS = "no credentials"
+UP_TO_DATE = "up to date"
+SKIPPED = "skipped"
+ERROR = "error"
+
 
 class Command(BaseCommand):
     args = ""
     help = "Sends email alerts about courses with unassigned students"
-    
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--workers',
+            dest='workers',
+            type='int',
+            default=settings.CANVAS_API_CONCURRENCY,
+            help='Number of courses handled concurrently; 1 handles them one '
+                 'at a time in the main thread'
+        ),
+    )
+
     def handle(self, *args, **options):
+        start = time.time()
         # TODO: Include intent-to-treat experiments when that is supported
-        for experiment in Experiment.get_all_started_csv():
+        experiment_ids_by_course = defaultdict(list)
+        for experiment_id, course_id in Experiment.get_all_started_csv().values_list(
+                "id", "course_id"):
+            experiment_ids_by_course[course_id].append(experiment_id)
+        courses = sorted(experiment_ids_by_course.items())
+        workers = max(1, min(options['workers'], len(courses)))
+        if workers == 1:
+            outcomes = [self.handle_course(course) for course in courses]
+        else:
+            pool = ThreadPool(workers)
             try:
-                self.handle_experiment(experiment)
-            except Exception as exception:
-                logger.error(repr(exception))
-                logger.error(traceback.format_exc())
-    
-    def handle_experiment(self, experiment):
-        course_notification = experiment.get_course_notification()
-        # Check whether or not a notification can be sent to avoid extra API calls
-        if course_notification.can_notify():
+                outcomes = pool.map(self.handle_course_in_worker, courses)
+            finally:
+                pool.terminate()
+        elapsed = time.time() - start
+        counts = defaultdict(int)
+        for outcome in outcomes:
+            counts[outcome] += 1
+        summary = ("Handled %s courses (%s experiments) with %s workers in %.1fs (%.1f courses/s): %s" %
+                   (len(courses), sum(len(ids) for _, ids in courses), workers, elapsed,
+                    len(courses) / elapsed if elapsed else 0,
+                    ", ".join("%s %s" % (counts[outcome], outcome) for outcome in
+                              (NOTIFIED, NO_CREDENTIALS, UP_TO_DATE, SKIPPED, ERROR))))
+        summary += ("; Canvas connection pools: %(pools)s pools, %(hits)s hits, %(misses)s misses"
+                    % get_pool_stats())
+        logger.info(summary)
+        self.stdout.write(summary)
+
+    def handle_course_in_worker(self, course):
+        try:
+            return self.handle_course(course)
+        finally:
+            # Each worker thread has its own database connection
+            connection.close()
+
+    def handle_course(self, course):
+        """ Fetches the course's roster once and notifies the course if any of
+            its experiments has unassigned students.  Returns the outcome. """
+        course_id, experiment_ids = course
+        try:
+            course_notification = CourseNotification.objects.get(course_id=course_id)
+            # Check whether or not a notification can be sent to avoid extra API calls
+            if not course_notification.can_notify():
+                return SKIPPED
             try:
-                students = get_unassigned_students_with_stored_credentials(course_notification, experiment)
-                if students:
-                    send_email_notification(course_notification, ASSIGN_STUDENTS_MESSAGE)
+                roster = get_course_roster_with_stored_credentials(course_notification)
             except NoValidCredentials:
                 send_email_notification(course_notification, NO_CREDENTIALS_MESSAGE)
+                return NO_CREDENTIALS
+            assigned_student_ids = get_assigned_student_ids(experiment_ids)
+            if any(not assigned_student_ids[experiment_id].issuperset(roster)
+                   for experiment_id in experiment_ids):
+                send_email_notification(course_notification, ASSIGN_STUDENTS_MESSAGE)
+                return NOTIFIED
+            return UP_TO_DATE
+        except Exception as exception:
+            logger.error(repr(exception))
+            logger.error(traceback.format_exc())
+            return ERROR
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ab_tool', '0004_merge'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='interventionpointinteraction',
+            index_together=set([('experiment', 'created_on'), ('student', 'intervention_point'), ('course_id', 'created_on')]),
+        ),
+        migrations.CreateModel(
+            name='InterventionPointInteractionArchive',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('interaction_id', models.IntegerField(unique=True)),
+                ('course_id', models.CharField(max_length=128)),
+                ('month', models.DateField()),
+                ('created_on', models.DateTimeField()),
+                ('experiment_id', models.IntegerField()),
+                ('experiment_name', models.CharField(max_length=256)),
+                ('track_id', models.IntegerField()),
+                ('track_name', models.CharField(max_length=256)),
+                ('intervention_point_id', models.IntegerField()),
+                ('intervention_point_name', models.CharField(max_length=256)),
+                ('student_id', models.CharField(max_length=128)),
+                ('student_name', models.CharField(max_length=256, null=True)),
+                ('url', models.URLField(max_length=2048)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='interventionpointinteractionarchive',
+            index_together=set([('course_id', 'month'), ('experiment_id', 'created_on')]),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ab_tool', '0005_interaction_indexes_and_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseRoster',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('course_id', models.CharField(unique=True, max_length=128)),
+                ('last_synced', models.DateTimeField(null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='CourseRosterStudent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('sis_user_id', models.CharField(max_length=128, null=True)),
+                ('name', models.CharField(max_length=256, null=True)),
+                ('roster', models.ForeignKey(related_name='students', to='ab_tool.CourseRoster')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='courserosterstudent',
+            unique_together=set([('roster', 'sis_user_id')]),
+        ),
+    ]
@@ -1,6 +1,6 @@
 from urlparse import urlparse
 from datetime import timedelta
-from django.db import models, IntegrityError
+from django.db import models, IntegrityError, transaction
 from django.conf import settings
 from django.shortcuts import get_object_or_404
 from ab_tool.exceptions import (UNAUTHORIZED_ACCESS,
@@ -26,14 +26,21 @@ class TimestampedModel(models.Model):
             update_fields.add(k)
         self.save(update_fields=update_fields)
     
+    def as_new_object(self, **kwargs):
+        """ Turns the object into an unsaved new object based on the original,
+            applying updates in kwargs, and returns it (e.g. for bulk_create).
+            Note that this operates in-place; do not use this if other memory
+            references to this object exist """
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
+        self.pk, self.id = None, None
+        return self
+    
     def save_as_new_object(self, **kwargs):
         """ Saves a new object based on the original, applying updates in
             kwargs.  Note that this operates in-place; do not use this if
             other memory references to this object exist """
-        for k, v in kwargs.iteritems():
-            setattr(self, k, v)
-        self.pk, self.id = None, None
-        self.save()
+        self.as_new_object(**kwargs).save()
     
     # Override for objects.create
     def save(self, *args, **kwargs):
@@ -122,37 +129,51 @@ class Experiment(CourseObject):
                         "newName" : t.name,
                         "editing": False,
                         "deleteURL": reverse('ab_testing_tool_delete_track', args=(t.id,))}
-                       for t in self.tracks.all()],
+                       for t in self.tracks.select_related("weight")],
         }
         return json.dumps(experiment_dict)
     
     def copy(self, new_name):
-        tracks = self.tracks.all()
-        intervention_points = self.intervention_points.all()
-        # Copy Experiment
-        self.save_as_new_object(name=new_name, tracks_finalized=False)
-        
-        # Copy Tracks
-        track_id_mapping = {}
-        for track in tracks:
-            original_track_id = track.id
-            track.save_as_new_object(experiment=self)
-            track_id_mapping[original_track_id] = track
-            # Copy TrackProbabilityWeight, if any
-            try:
-                weight = TrackProbabilityWeight.objects.get(track_id=original_track_id)
-                weight.save_as_new_object(track=track)
-            except TrackProbabilityWeight.DoesNotExist:
-                pass
-        
-        # Copy InterventionPoints
-        for intervention_point in intervention_points:
-            orig_ip_id = intervention_point.id
-            intervention_point.save_as_new_object(experiment=self)
-            # Copy InterventionPointUrls, if any
-            for ip_url in InterventionPointUrl.objects.filter(intervention_point_id=orig_ip_id):
-                ip_url.save_as_new_object(track=track_id_mapping[ip_url.track.id],
-                                          intervention_point=intervention_point)
+        """ Copies the experiment, with its tracks, track weights, intervention
+            points and intervention point urls, to a new experiment named
+            new_name.  Everything is read with three queries and written with
+            one bulk insert per table, in one transaction.  Like
+            save_as_new_object, this operates in-place: afterwards the object
+            is the new experiment. """
+        with transaction.atomic():
+            tracks = list(self.tracks.select_related("weight"))
+            weights = [track.weight for track in tracks if track.get_weighting() is not None]
+            intervention_points = list(self.intervention_points.all())
+            ip_urls = list(InterventionPointUrl.objects.filter(
+                    intervention_point__experiment_id=self.id))
+            track_names = {track.id: track.name for track in tracks}
+            intervention_point_names = {ip.id: ip.name for ip in intervention_points}
+            
+            # Copy Experiment
+            self.save_as_new_object(name=new_name, tracks_finalized=False)
+            
+            # bulk_create doesn't set the ids of the new objects, so the new
+            # tracks and intervention points are read back and matched to the
+            # originals by their names, which are unique within an experiment
+            Track.objects.bulk_create(
+                    [track.as_new_object(experiment=self) for track in tracks])
+            new_track_ids = dict(self.tracks.values_list("name", "id"))
+            track_id_mapping = {track_id: new_track_ids[name]
+                                for track_id, name in track_names.iteritems()}
+            TrackProbabilityWeight.objects.bulk_create(
+                    [weight.as_new_object(track_id=track_id_mapping[weight.track_id],
+                                          experiment=self)
+                     for weight in weights])
+            
+            InterventionPoint.objects.bulk_create(
+                    [ip.as_new_object(experiment=self) for ip in intervention_points])
+            new_ip_ids = dict(self.intervention_points.values_list("name", "id"))
+            InterventionPointUrl.objects.bulk_create(
+                    [ip_url.as_new_object(
+                            track_id=track_id_mapping[ip_url.track_id],
+                            intervention_point_id=new_ip_ids[
+                                    intervention_point_names[ip_url.intervention_point_id]])
+                     for ip_url in ip_urls])
     
     @classmethod
     def get_placeholder_course_experiment(cls, course_id):
@@ -213,22 +234,6 @@ class InterventionPoint(CourseObject):
     
     class Meta:
         unique_together = (('experiment', 'name'),)
-    
-    def track_urls(self):
-        """ This gets the InterventionPointUrls for an InterventionPoint in the
-            default databse order of Tracks and uses a mock InterventionPointUrl
-            with only the track attribute set in the event an InterventionPointUrl
-            is missing for that track """
-        ip_urls = self.interventionpointurl_set.all()
-        track_urls = []
-        for track in self.experiment.tracks.all():
-            for ip_url in ip_urls:
-                if ip_url.track == track:
-                    track_urls.append(ip_url)
-                    break
-            else:
-                track_urls.append(InterventionPointUrl(track=track))
-        return track_urls
 
 
 class InterventionPointUrl(TimestampedModel):
@@ -259,13 +264,73 @@ class ExperimentStudent(CourseObject):
 
 class InterventionPointInteraction(CourseObject):
     """ This model logs every time an intervention point is deployed for a
-        student.  Consider moving this out of the database and into
-        flat file storage. """
+        student.  Rows are only ever appended (see ab_tool.analytics), and
+        rows for courses that are no longer active are moved to
+        InterventionPointInteractionArchive by the archive_interactions
+        management command so that this table only holds current terms. """
     student = models.ForeignKey(ExperimentStudent)
     intervention_point = models.ForeignKey(InterventionPoint)
     experiment = models.ForeignKey(Experiment, related_name="intervention_point_interactions")
     track = models.ForeignKey(Track)
     url = models.URLField(max_length=URL_CHAR_LIMIT)
+    
+    class Meta:
+        index_together = (('experiment', 'created_on'),
+                          ('student', 'intervention_point'),
+                          ('course_id', 'created_on'),)
+
+
+class InterventionPointInteractionArchive(models.Model):
+    """ Cold storage for InterventionPointInteractions of closed terms.  Rows
+        are denormalized, with the names of the objects involved, so that they
+        can be exported without joins and outlive the objects they refer to.
+        Rows are partitioned by course and month through the
+        (course_id, month) index. """
+    interaction_id = models.IntegerField(unique=True)
+    course_id = models.CharField(max_length=128)
+    month = models.DateField()
+    created_on = models.DateTimeField()
+    experiment_id = models.IntegerField()
+    experiment_name = models.CharField(max_length=NAME_CHAR_LIMIT)
+    track_id = models.IntegerField()
+    track_name = models.CharField(max_length=NAME_CHAR_LIMIT)
+    intervention_point_id = models.IntegerField()
+    intervention_point_name = models.CharField(max_length=NAME_CHAR_LIMIT)
+    student_id = models.CharField(max_length=128)
+    student_name = models.CharField(max_length=256, null=True)
+    url = models.URLField(max_length=URL_CHAR_LIMIT)
+    
+    class Meta:
+        index_together = (('course_id', 'month'),
+                          ('experiment_id', 'created_on'),)
+
+
+class CourseRoster(TimestampedModel):
+    """ Local copy of the students enrolled in a Canvas course.  last_synced is
+        the watermark of the last sync with Canvas; the roster is synced again
+        once it is older than COURSE_ROSTER_MAX_AGE (see
+        ab_tool.canvas.get_course_roster). """
+    course_id = models.CharField(max_length=128, unique=True)
+    last_synced = models.DateTimeField(null=True)
+    
+    def is_stale(self):
+        if self.last_synced is None:
+            return True
+        max_age = timedelta(seconds=settings.COURSE_ROSTER_MAX_AGE)
+        return timezone.now() > self.last_synced + max_age
+    
+    def as_dict(self):
+        """ Returns a dict of the sis_user_ids of the students to their names """
+        return dict(self.students.values_list("sis_user_id", "name"))
+
+
+class CourseRosterStudent(models.Model):
+    roster = models.ForeignKey(CourseRoster, related_name="students")
+    sis_user_id = models.CharField(max_length=128, null=True)
+    name = models.CharField(max_length=256, null=True)
+    
+    class Meta:
+        unique_together = (('roster', 'sis_user_id'),)
 
 
 class CourseNotification(TimestampedModel):
@@ -275,7 +340,14 @@ class CourseNotification(TimestampedModel):
     
     @classmethod
     def store_credential(cls, course_id, canvas_url, email, oauth_token):
-        """ Gets and stores a credential per user of the course. """
+        """ Gets and stores a credential per user of the course.  Callers on
+            the request path should use ab_tool.credentials.record_credential,
+            which skips credentials that haven't changed. """
+        # The admin's credential usually exists already, in which case a
+        # single UPDATE replaces its token
+        if CourseCredential.objects.filter(course__course_id=course_id, email=email).update(
+                token=oauth_token, updated_on=timezone.now()):
+            return
         course = cls.objects.get_or_create(
                 course_id=course_id, defaults={"canvas_url": canvas_url})[0]
         credential, created = CourseCredential.objects.get_or_create(
@@ -301,6 +373,11 @@ class CourseNotification(TimestampedModel):
             return False
         return self.experiments_to_check().count() > 0
     
+    def experiments_to_check(self):
+        """ The started CSV upload experiments of the course, whose students
+            may need to be assigned tracks """
+        return Experiment.get_all_started_csv().filter(course_id=self.course_id)
+    
     def get_emails(self):
         return [credential.email for credential in self.credentials.all()]
     
@@ -0,0 +1,37 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from ab_tool.models import (Experiment, InterventionPoint, InterventionPointUrl,
+    ExperimentStudent, Track, TrackProbabilityWeight)
+from ab_tool.caching import (invalidate_deploy_plans, invalidate_student_assignment,
+    invalidate_track_sampler)
+
+
+@receiver([post_save, post_delete], sender=Experiment)
+def experiment_changed(sender, instance, **kwargs):
+    invalidate_deploy_plans(instance.intervention_points.values_list("id", flat=True))
+    invalidate_track_sampler(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Track)
+@receiver([post_save, post_delete], sender=TrackProbabilityWeight)
+def track_weighting_changed(sender, instance, **kwargs):
+    invalidate_track_sampler(instance.experiment_id)
+
+
+@receiver([post_save, post_delete], sender=InterventionPoint)
+def intervention_point_changed(sender, instance, **kwargs):
+    invalidate_deploy_plans([instance.id])
+
+
+@receiver([post_save, post_delete], sender=InterventionPointUrl)
+def intervention_point_url_changed(sender, instance, **kwargs):
+    invalidate_deploy_plans([instance.intervention_point_id])
+
+
+@receiver([post_save, post_delete], sender=ExperimentStudent)
+def experiment_student_changed(sender, instance, **kwargs):
+    """ Code that creates students writes their assignment to the cache
+        explicitly; this only covers students changed or deleted elsewhere
+        (e.g. by cascade or through the admin) """
+    invalidate_student_assignment(instance.experiment_id, instance.student_id)
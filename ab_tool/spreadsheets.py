@@ -1,58 +1,116 @@
 import csv
+import openpyxl
+import tempfile
 import xlsxwriter
-import StringIO
 import xlrd
-from django.http.response import HttpResponse
+from wsgiref.util import FileWrapper
+from django.conf import settings
+from django.http.response import StreamingHttpResponse
 
-from ab_tool.models import ExperimentStudent, InterventionPointInteraction
+from ab_tool.models import (ExperimentStudent, InterventionPointInteraction,
+    InterventionPointInteractionArchive)
 from ab_tool.controllers import streamed_csv_response
 from ab_tool.canvas import get_unassigned_students
-from ab_tool.exceptions import INVALID_FILE_TYPE
+from ab_tool.exceptions import INVALID_FILE_TYPE, XLS_FILE_TOO_LARGE
+
+
+EXPORT_CHUNK_SIZE = 2000
+XLSX_SPOOL_SIZE = 1024 * 1024
+XLSX_STREAM_CHUNK_SIZE = 64 * 1024
 
 
 def get_student_list_csv(experiment, file_title):
     def row_generator():
         yield ["Student Name", "Student ID", "Experiment", "Assigned Track",
                    "Timestamp Last Updated"]
-        for s in ExperimentStudent.objects.filter(experiment=experiment):
-            yield [s.student_name, s.student_id, s.experiment.name,
-                   s.track.name, s.updated_on]
+        track_names = dict(experiment.tracks.values_list("id", "name"))
+        students = ExperimentStudent.objects.filter(experiment_id=experiment.id)
+        for _, student_name, student_id, track_id, updated_on in iterate_in_chunks(
+                students, ("id", "student_name", "student_id", "track_id", "updated_on")):
+            yield [student_name, student_id, experiment.name,
+                   track_names.get(track_id), updated_on]
     return streamed_csv_response(row_generator(), file_title)
 
 
+def iterate_in_chunks(queryset, fields, chunk_size=None):
+    """ Yields the values_list rows of `fields` for queryset, fetching
+        chunk_size (by default EXPORT_CHUNK_SIZE) rows per query by keyset
+        pagination on id, so that exports use constant memory and a query
+        count that only depends on the number of chunks.  The first of
+        `fields` must be "id". """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    last_id = None
+    while True:
+        chunk = queryset.order_by("id")
+        if last_id is not None:
+            chunk = chunk.filter(id__gt=last_id)
+        rows = list(chunk.values_list(*fields)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+
 def get_intervention_point_interactions_csv(experiment, file_title):
     def row_generator():
         yield ["Student Name", "Student ID", "Experiment", "Assigned Track",
                    "Intervention Point", "Intervention Point URL", "Timestamp Encountered"]
-        for i in InterventionPointInteraction.objects.filter(experiment=experiment):
-            yield [i.student.student_name, i.student.student_id,
-                   i.experiment.name, i.track.name,
-                   i.intervention_point.name, i.url, i.created_on]
+        # Interactions of earlier terms that have been archived come first
+        archived = InterventionPointInteractionArchive.objects.filter(experiment_id=experiment.id)
+        for (_, student_name, student_id, experiment_name, track_name,
+             intervention_point_name, url, created_on) in iterate_in_chunks(
+                archived, ("id", "student_name", "student_id", "experiment_name",
+                           "track_name", "intervention_point_name", "url", "created_on")):
+            yield [student_name, student_id, experiment_name, track_name,
+                   intervention_point_name, url, created_on]
+        # Related names are joined in rather than fetched per row
+        interactions = InterventionPointInteraction.objects.filter(experiment_id=experiment.id)
+        for (_, student_name, student_id, track_name, intervention_point_name,
+             url, created_on) in iterate_in_chunks(
+                interactions, ("id", "student__student_name", "student__student_id",
+                               "track__name", "intervention_point__name", "url",
+                               "created_on")):
+            yield [student_name, student_id, experiment.name, track_name,
+                   intervention_point_name, url, created_on]
     return streamed_csv_response(row_generator(), file_title)
 
 
 def get_track_selection_xlsx(request, experiment, file_title="test.xlsx"):
-    output = StringIO.StringIO()
-    workbook = xlsxwriter.Workbook(output, {"in_memory": True})
+    students = get_unassigned_students(request, experiment)
+    track_names = [t.name for t in experiment.tracks.all()]
+    output = build_track_selection_xlsx(experiment.name, students, track_names)
+    content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    response = StreamingHttpResponse(FileWrapper(output, XLSX_STREAM_CHUNK_SIZE),
+                                     content_type=content_type)
+    response['Content-Disposition'] = ("attachment; filename=%s" % file_title)
+    return response
+
+
+def build_track_selection_xlsx(experiment_name, students, track_names):
+    """ Writes the track selection workbook for the dict of
+        {student_id: student_name} and returns it as a file positioned at
+        its start.  The workbook is written in xlsxwriter's constant_memory
+        mode, which flushes each row to a temporary file once the next one
+        is started, and the finished file is only kept in memory while it is
+        smaller than XLSX_SPOOL_SIZE, so memory doesn't grow with the number
+        of students. """
+    output = tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_SIZE)
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
     worksheet = workbook.add_worksheet()
     worksheet.set_column(0, 3, 20)
     headers = ["Student Name", "Student ID", "Experiment", "Assigned Track"]
     worksheet.write_row(0, 0, headers)
-    students = get_unassigned_students(request, experiment)
-    # Row offsets of +1 below are to account for header
-    for i, student_id in enumerate(students):
-        row = [students[student_id], student_id, experiment.name, ""]
-        worksheet.write_row(i + 1, 0, row)
+    # Row offsets of +1 below are to account for header.  constant_memory
+    # requires rows to be written in order.
+    for i, (student_id, student_name) in enumerate(students.iteritems()):
+        worksheet.write_row(i + 1, 0, [student_name, student_id, experiment_name, ""])
     # Add drop-down with track names as the only valid options for the missing column
-    track_names = [t.name for t in experiment.tracks.all()]
     worksheet.data_validation(1, 3, len(students) + 1, 3,
                               {'validate': 'list', 'source': track_names,})
     workbook.close()
     output.seek(0)
-    content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    response = HttpResponse(output.read(), content_type=content_type)
-    response['Content-Disposition'] = ("attachment; filename=%s" % file_title)
-    return response
+    return output
 
 
 def get_track_selection_csv(request, experiment, file_title="test.xlsx"):
@@ -64,35 +122,90 @@ def get_track_selection_csv(request, experiment, file_title="test.xlsx"):
     return streamed_csv_response(row_generator(), file_title)
 
 
-def parse_uploaded_file(experiment, unassigned_students, input_spreadsheet, filename):
+def parse_uploaded_file(experiment, unassigned_students, uploaded_file, filename):
     """ This function parses an uploaded spreadsheet of student track assignments.
         It returns a dictionary `students`, mapping sis_ids to track
         names as well as a list of errors (in string form) encountered while
-        parsing the spreadsheet.  If errors is empty, no errors were encountered. """
+        parsing the spreadsheet.  If errors is empty, no errors were encountered.
+        
+        Rows are read from the file one at a time (CSV lines straight from
+        the upload's chunks, XLSX rows with a read-only workbook), so memory
+        only grows with the number of valid rows, which can't exceed the
+        number of unassigned students.  XLS files are read whole and so are
+        limited to MAX_XLS_FILE_UPLOAD_SIZE.  Parsing stops once
+        MAX_UPLOAD_ERRORS errors have been found. """
     students = {}
     errors = []
     track_names = {track.name: track for track in experiment.tracks.all()}
     if filename.endswith('.csv'):
-        reader = csv.reader(input_spreadsheet.splitlines())
-        reader.next()  # Skip the header
-        for row_number, row in enumerate(reader):
-            # Row number is off by 2 because we trimmed the headers and
-            # CSV files are 1-indexed while enumerate is 0-indexed
-            parse_row(row, row_number + 2, experiment, track_names,
-                      unassigned_students, students, errors)
-    elif filename.endswith('.xlsx') or filename.endswith('.xls'):
-        book = xlrd.open_workbook(file_contents=input_spreadsheet)
-        sheet = book.sheet_by_index(0)
-        # Start at 1 to skip headers
-        for row_number in range(1, sheet.nrows):
-            row = sheet.row_values(row_number)
-            parse_row(row, row_number, experiment, track_names,
-                      unassigned_students, students, errors)
+        reader = csv.reader(uploaded_file)
+        next(reader, None)  # Skip the header
+        # Row numbers start at 2 because we trimmed the headers and
+        # CSV files are 1-indexed
+        rows = enumerate(reader, 2)
+    elif filename.endswith('.xlsx'):
+        rows = iterate_xlsx_rows(uploaded_file)
+    elif filename.endswith('.xls'):
+        # The binary .xls format can't be read a row at a time, so it is held
+        # to the smaller MAX_XLS_FILE_UPLOAD_SIZE; no more than that is read
+        max_size = int(settings.MAX_XLS_FILE_UPLOAD_SIZE)
+        file_contents = uploaded_file.read(max_size + 1)
+        if len(file_contents) > max_size:
+            raise XLS_FILE_TOO_LARGE
+        rows = iterate_xls_rows(file_contents)
     else:
         raise INVALID_FILE_TYPE
+    for row_number, row in rows:
+        if len(errors) >= settings.MAX_UPLOAD_ERRORS:
+            errors.append("Row %s: stopped checking after %s errors" % (row_number, len(errors)))
+            break
+        parse_row(row, row_number, experiment, track_names,
+                  unassigned_students, students, errors)
     return students, errors
 
 
+def iterate_xlsx_rows(uploaded_file):
+    """ Yields (row_number, row) for the rows of the first sheet of an XLSX
+        file after the headers """
+    workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        # Start at 1 to skip headers
+        for row_number, cells in enumerate(sheet.iter_rows(min_row=2), 1):
+            yield row_number, spreadsheet_row([cell.value for cell in cells])
+    finally:
+        workbook.close()
+
+
+def iterate_xls_rows(file_contents):
+    """ Yields (row_number, row) for the rows of the first sheet of an XLS
+        file after the headers """
+    book = xlrd.open_workbook(file_contents=file_contents, on_demand=True)
+    sheet = book.sheet_by_index(0)
+    # Start at 1 to skip headers
+    for row_number in range(1, sheet.nrows):
+        yield row_number, spreadsheet_row(sheet.row_values(row_number))
+
+
+def spreadsheet_row(values):
+    """ Returns the cell values of a spreadsheet row as they would be read
+        from a CSV file: empty cells as "" and whole numbers (such as
+        student ids) without a decimal point.  Rows without any values are
+        returned as an empty list. """
+    row = []
+    for value in values:
+        if value is None:
+            value = ""
+        elif isinstance(value, float) and value.is_integer():
+            value = unicode(int(value))
+        elif isinstance(value, (int, long)):
+            value = unicode(value)
+        row.append(value)
+    if not any(row):
+        return []
+    return row
+
+
 def parse_row(row, row_number, experiment, tracks, unassigned_students, students, errors):
     """ The arguments `students` and `errors` are each data structures
         from `parse_uploaded_file` indented to be modified by this function.
@@ -14,6 +14,15 @@ from error_middleware.middleware import ERROR_TEMPLATE
 LIST_MODULES = "canvas_sdk.methods.modules.list_modules"
 LIST_ITEMS = "canvas_sdk.methods.modules.list_module_items"
 GET_TOKEN = "ab_tool.canvas.get_token"
+# Returns the list of enrollment dicts of a course's roster
+GET_ENROLLMENTS = "ab_tool.canvas.call_canvas_all_pages"
+
+# Tests run against the dummy cache; tests of caching use this with override_settings
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
 
 TEST_COURSE_ID = "12345"
 TEST_OTHER_COURSE_ID = "5555555"
@@ -70,6 +79,7 @@ class SessionTestCase(TestCase):
             patch(LIST_MODULES, return_value=APIReturn([])),
             patch(LIST_ITEMS, return_value=APIReturn([])),
             patch(GET_TOKEN, return_value="MOCK_TOKEN"),
+            patch(GET_ENROLLMENTS, return_value=[]),
         ]
         for patcher in patchers:
             patcher.start()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from django.core.management import call_command
+from django.utils import timezone
+
+from ab_tool.analytics import (DatabaseInteractionSink, BufferedInteractionSink,
+    FileInteractionSink, archive_interactions, insert_interactions)
+from ab_tool.models import (Experiment, ExperimentStudent, InterventionPointInteraction,
+    InterventionPointInteractionArchive, CourseNotification)
+from ab_tool.tests.common import (SessionTestCase, TEST_COURSE_ID, TEST_STUDENT_ID)
+
+
+class TestAnalytics(SessionTestCase):
+    def setUp(self):
+        super(TestAnalytics, self).setUp()
+        self.experiment = Experiment.get_placeholder_course_experiment(TEST_COURSE_ID)
+        self.intervention_point = self.create_test_intervention_point(experiment=self.experiment)
+        self.track = self.create_test_track(experiment=self.experiment)
+        self.student = ExperimentStudent.objects.create(
+                course_id=TEST_COURSE_ID, experiment=self.experiment,
+                student_id=TEST_STUDENT_ID, track=self.track)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+    
+    def interaction(self, created_on=None):
+        return {"course_id": TEST_COURSE_ID, "student_id": self.student.id,
+                "intervention_point_id": self.intervention_point.id,
+                "experiment_id": self.experiment.id, "track_id": self.track.id,
+                "url": "http://example.com",
+                "created_on": created_on or timezone.now()}
+    
+    def test_database_sink_writes_immediately(self):
+        """ Tests that the database sink writes the interaction when it is recorded,
+            keeping the time it was recorded at """
+        created_on = timezone.now() - timedelta(minutes=5)
+        DatabaseInteractionSink().record(self.interaction(created_on))
+        interaction = InterventionPointInteraction.objects.get()
+        self.assertEqual(interaction.created_on, created_on)
+        self.assertEqual(interaction.student, self.student)
+    
+    def test_buffered_sink_writes_on_flush(self):
+        """ Tests that the buffered sink only writes interactions when flushed,
+            in batches of batch_size """
+        sink = BufferedInteractionSink(batch_size=2, background=False)
+        for _ in range(3):
+            sink.record(self.interaction())
+        self.assertEqual(InterventionPointInteraction.objects.count(), 0)
+        self.assertEqual(sink.flush(), 3)
+        self.assertEqual(InterventionPointInteraction.objects.count(), 3)
+    
+    def test_buffered_sink_drops_when_full(self):
+        """ Tests that the buffered sink drops interactions instead of blocking
+            when its queue is full """
+        sink = BufferedInteractionSink(max_queue_size=1, background=False)
+        sink.record(self.interaction())
+        sink.record(self.interaction())
+        self.assertEqual(sink.dropped, 1)
+        self.assertEqual(sink.flush(), 1)
+    
+    def test_file_sink_drain(self):
+        """ Tests that interactions recorded by the file sink are loaded by a drain,
+            keeping the time they were recorded at, and that the log file is removed """
+        created_on = timezone.now() - timedelta(days=1)
+        sink = FileInteractionSink(self.directory)
+        sink.record(self.interaction(created_on))
+        sink.record(self.interaction())
+        self.assertEqual(InterventionPointInteraction.objects.count(), 0)
+        self.assertEqual(sink.drain(), 2)
+        self.assertEqual(InterventionPointInteraction.objects.count(), 2)
+        self.assertEqual(InterventionPointInteraction.objects.order_by("created_on")[0].created_on,
+                         created_on)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(sink.drain(), 0)
+    
+    def test_file_sink_records_after_drain(self):
+        """ Tests that interactions recorded after a drain go to a new log file """
+        sink = FileInteractionSink(self.directory)
+        sink.record(self.interaction())
+        sink.drain()
+        sink.record(self.interaction())
+        self.assertEqual(sink.drain(), 1)
+        self.assertEqual(InterventionPointInteraction.objects.count(), 2)
+    
+    def test_drain_interactions_command(self):
+        """ Tests that the drain_interactions command loads logged interactions """
+        FileInteractionSink(self.directory).record(self.interaction())
+        call_command("drain_interactions", directory=self.directory)
+        self.assertEqual(InterventionPointInteraction.objects.count(), 1)
+    
+    def test_archive_interactions(self):
+        """ Tests that archive_interactions moves interactions to the archive in
+            batches, keeping their names and timestamps """
+        created_on = timezone.now() - timedelta(days=40)
+        insert_interactions([self.interaction(created_on) for _ in range(3)])
+        moved = archive_interactions(InterventionPointInteraction.objects.all(), batch_size=2)
+        self.assertEqual(moved, 3)
+        self.assertFalse(InterventionPointInteraction.objects.exists())
+        archived = InterventionPointInteractionArchive.objects.all()
+        self.assertEqual(archived.count(), 3)
+        for row in archived:
+            self.assertEqual(row.created_on, created_on)
+            self.assertEqual(row.month, created_on.date().replace(day=1))
+            self.assertEqual(row.student_id, TEST_STUDENT_ID)
+            self.assertEqual(row.track_name, self.track.name)
+            self.assertEqual(row.intervention_point_name, self.intervention_point.name)
+    
+    def test_archive_interactions_command_inactive_courses(self):
+        """ Tests that the command only archives interactions of courses
+            installed more than COURSE_ACTIVE_DAYS ago """
+        insert_interactions([self.interaction()])
+        call_command("archive_interactions")
+        self.assertEqual(InterventionPointInteraction.objects.count(), 1)
+        notification = CourseNotification.objects.create(course_id=TEST_COURSE_ID)
+        CourseNotification.objects.filter(pk=notification.pk).update(
+                created_on=timezone.now() - timedelta(days=400))
+        call_command("archive_interactions")
+        self.assertEqual(InterventionPointInteraction.objects.count(), 0)
+        self.assertEqual(InterventionPointInteractionArchive.objects.count(), 1)
+    
+    def test_archive_interactions_command_before(self):
+        """ Tests that --before archives only interactions created before the date """
+        insert_interactions([self.interaction(timezone.now() - timedelta(days=30)),
+                             self.interaction()])
+        before = (timezone.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+        call_command("archive_interactions", before=before)
+        self.assertEqual(InterventionPointInteraction.objects.count(), 1)
+        self.assertEqual(InterventionPointInteractionArchive.objects.count(), 1)
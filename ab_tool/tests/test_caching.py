@@ -0,0 +1,143 @@
+from django.core.cache import cache
+from django.http.response import Http404
+from django.test.utils import override_settings
+
+from ab_tool.caching import get_deploy_plan, get_student_assignment, get_track_sampler
+from ab_tool.controllers import assign_track_and_create_student
+from ab_tool.models import Experiment, InterventionPointUrl, ExperimentStudent
+from ab_tool.tests.common import (SessionTestCase, TEST_COURSE_ID,
+    NONEXISTENT_INTERVENTION_POINT_ID, TEST_STUDENT_ID, TEST_STUDENT_NAME,
+    LOCMEM_CACHES)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestCaching(SessionTestCase):
+    def setUp(self):
+        super(TestCaching, self).setUp()
+        cache.clear()
+
+    def test_get_deploy_plan_contents(self):
+        """ Tests that the deploy plan contains the experiment and url configuration
+            of the intervention point """
+        experiment = self.create_test_experiment(assignment_method=Experiment.UNIFORM_RANDOM)
+        intervention_point = self.create_test_intervention_point(experiment=experiment)
+        track = self.create_test_track(experiment=experiment)
+        InterventionPointUrl.objects.create(intervention_point=intervention_point, track=track,
+                                            url="http://example.com", open_as_tab=True)
+        plan = get_deploy_plan(intervention_point.id)
+        self.assertEqual(plan["course_id"], TEST_COURSE_ID)
+        self.assertEqual(plan["experiment_id"], experiment.id)
+        self.assertEqual(plan["tracks_finalized"], False)
+        self.assertEqual(plan["assignment_method"], Experiment.UNIFORM_RANDOM)
+        self.assertEqual(plan["track_urls"], {track.id: {"url": "http://example.com",
+                                                         "open_as_tab": True,
+                                                         "is_canvas_page": False}})
+
+    def test_get_deploy_plan_is_cached(self):
+        """ Tests that a second lookup of the deploy plan doesn't query the database """
+        intervention_point = self.create_test_intervention_point()
+        get_deploy_plan(intervention_point.id)
+        with self.assertNumQueries(0):
+            get_deploy_plan(intervention_point.id)
+
+    def test_get_deploy_plan_nonexistent(self):
+        """ Tests that get_deploy_plan raises a 404 for a nonexistent intervention point """
+        self.assertRaises(Http404, get_deploy_plan, NONEXISTENT_INTERVENTION_POINT_ID)
+
+    def test_deploy_plan_invalidated_on_url_save(self):
+        """ Tests that adding or changing an InterventionPointUrl invalidates the plan """
+        intervention_point = self.create_test_intervention_point()
+        track = self.create_test_track()
+        get_deploy_plan(intervention_point.id)
+        ip_url = InterventionPointUrl.objects.create(intervention_point=intervention_point,
+                                                     track=track, url="http://example.com")
+        self.assertEqual(get_deploy_plan(intervention_point.id)["track_urls"][track.id]["url"],
+                         "http://example.com")
+        ip_url.update(url="http://example.com/other")
+        self.assertEqual(get_deploy_plan(intervention_point.id)["track_urls"][track.id]["url"],
+                         "http://example.com/other")
+
+    def test_deploy_plan_invalidated_on_track_delete(self):
+        """ Tests that deleting a track (and its urls by cascade) invalidates the plan """
+        intervention_point = self.create_test_intervention_point()
+        track = self.create_test_track()
+        InterventionPointUrl.objects.create(intervention_point=intervention_point,
+                                            track=track, url="http://example.com")
+        self.assertIn(track.id, get_deploy_plan(intervention_point.id)["track_urls"])
+        track_id = track.id
+        track.delete()
+        self.assertNotIn(track_id, get_deploy_plan(intervention_point.id)["track_urls"])
+
+    def test_deploy_plan_invalidated_on_experiment_save(self):
+        """ Tests that finalizing an experiment invalidates the plans of its
+            intervention points """
+        experiment = Experiment.get_placeholder_course_experiment(TEST_COURSE_ID)
+        intervention_point = self.create_test_intervention_point(experiment=experiment)
+        self.assertFalse(get_deploy_plan(intervention_point.id)["tracks_finalized"])
+        experiment.update(tracks_finalized=True)
+        self.assertTrue(get_deploy_plan(intervention_point.id)["tracks_finalized"])
+
+    def test_deploy_plan_invalidated_on_intervention_point_delete(self):
+        """ Tests that deleting the intervention point invalidates its plan """
+        intervention_point = self.create_test_intervention_point()
+        intervention_point_id = intervention_point.id
+        get_deploy_plan(intervention_point_id)
+        intervention_point.delete()
+        self.assertRaises(Http404, get_deploy_plan, intervention_point_id)
+
+    def test_assign_track_and_create_student_caches_assignment(self):
+        """ Tests that assigning a student a track writes the assignment to the cache """
+        experiment = self.create_test_experiment()
+        track = self.create_test_track(experiment=experiment)
+        self.assertIsNone(get_student_assignment(experiment.id, TEST_STUDENT_ID))
+        student = assign_track_and_create_student(experiment, TEST_STUDENT_ID, TEST_STUDENT_NAME)
+        self.assertEqual(get_student_assignment(experiment.id, TEST_STUDENT_ID),
+                         {"id": student.id, "track_id": track.id})
+
+    def test_student_assignment_invalidated_on_delete(self):
+        """ Tests that deleting a student removes the cached assignment """
+        experiment = self.create_test_experiment()
+        self.create_test_track(experiment=experiment)
+        student = assign_track_and_create_student(experiment, TEST_STUDENT_ID, TEST_STUDENT_NAME)
+        student.delete()
+        self.assertIsNone(get_student_assignment(experiment.id, TEST_STUDENT_ID))
+
+    def test_student_assignment_invalidated_on_track_change(self):
+        """ Tests that changing a student's track outside of the assignment code
+            removes the cached assignment """
+        experiment = self.create_test_experiment()
+        self.create_test_track(experiment=experiment)
+        student = assign_track_and_create_student(experiment, TEST_STUDENT_ID, TEST_STUDENT_NAME)
+        track2 = self.create_test_track(name="track2", experiment=experiment)
+        ExperimentStudent.objects.get(pk=student.id).update(track=track2)
+        self.assertIsNone(get_student_assignment(experiment.id, TEST_STUDENT_ID))
+
+    def test_get_track_sampler_weighted(self):
+        """ Tests that the sampler for a weighted experiment holds the cumulative
+            weights of its tracks and is served from the cache afterwards """
+        experiment = self.create_test_experiment(assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+        track1 = self.create_test_track(experiment=experiment, name="track1")
+        track2 = self.create_test_track(experiment=experiment, name="track2")
+        self.create_test_track_weight(track=track1, experiment=experiment, weighting=20)
+        self.create_test_track_weight(track=track2, experiment=experiment, weighting=5)
+        with self.assertNumQueries(1):
+            sampler = get_track_sampler(experiment)
+        self.assertEqual(sampler, {"track_ids": [track1.id, track2.id],
+                                   "cumulative_weights": [20, 25]})
+        with self.assertNumQueries(0):
+            get_track_sampler(experiment)
+
+    def test_get_track_sampler_missing_weight(self):
+        """ Tests that the sampler flags a weighted experiment with missing weights """
+        experiment = self.create_test_experiment(assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+        self.create_test_track(experiment=experiment)
+        self.assertIsNone(get_track_sampler(experiment)["cumulative_weights"])
+
+    def test_track_sampler_invalidated_on_weight_change(self):
+        """ Tests that changing a track weight rebuilds the sampler """
+        experiment = self.create_test_experiment(assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+        track = self.create_test_track(experiment=experiment)
+        track.set_weighting(10)
+        self.assertEqual(get_track_sampler(experiment)["cumulative_weights"], [10])
+        track.set_weighting(40)
+        self.assertEqual(get_track_sampler(experiment)["cumulative_weights"], [40])
@@ -1,7 +1,18 @@
+from datetime import timedelta
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
 from ab_tool.tests.common import (SessionTestCase, APIReturn,
-    LIST_MODULES, LIST_ITEMS, TEST_COURSE_ID, TEST_OTHER_COURSE_ID)
+    LIST_MODULES, LIST_ITEMS, TEST_COURSE_ID, TEST_OTHER_COURSE_ID, LOCMEM_CACHES,
+    GET_ENROLLMENTS)
 from ab_tool.canvas import (get_lti_param, list_modules,
-    list_module_items, get_canvas_request_context, CanvasModules)
+    list_module_items, get_canvas_request_context, CanvasModules,
+    fetch_modules_with_items, experiments_with_unassigned_students,
+    get_unassigned_students, get_course_roster, sync_course_roster)
+from ab_tool.models import Experiment, ExperimentStudent, CourseRoster
+from ab_tool.caching import invalidate_course_modules
 from ab_tool.exceptions import (MISSING_LTI_LAUNCH, MISSING_LTI_PARAM,
     NO_SDK_RESPONSE)
 from mock import patch, MagicMock
@@ -24,7 +35,10 @@ class TestCanvas(SessionTestCase):
     def get_canvas_modules(self, list_modules_return=[], list_items_return=[]):
         with patch(LIST_MODULES, return_value=APIReturn(list_modules_return)):
             with patch(LIST_ITEMS, return_value=APIReturn(list_items_return)):
-                return CanvasModules(self.request)
+                canvas_modules = CanvasModules(self.request)
+                # CanvasModules is lazy, so fetch everything while the api is patched
+                canvas_modules.modules
+                return canvas_modules
     
     def test_get_lti_param_success(self):
         """ Tests that get_lti_param returns the correct value when it is present """
@@ -168,3 +182,216 @@ class TestCanvas(SessionTestCase):
         module_item = modules[0]["module_items"][0]
         self.assertEqual(module_item["is_intervention_point"], True)
         self.assertEqual(module_item["database_name"], "test_database_name")
+    
+    def test_fetch_modules_with_items(self):
+        """ Tests that fetch_modules_with_items attaches the items of each module
+            to that module """
+        def items_of_module(request_context, course_id, module_id, include):
+            return APIReturn([{"module": module_id}])
+        with patch(LIST_MODULES, return_value=APIReturn([{"id": i} for i in range(20)])):
+            with patch(LIST_ITEMS, side_effect=items_of_module) as mock_list_items:
+                modules = fetch_modules_with_items(None, TEST_COURSE_ID)
+        self.assertEqual(mock_list_items.call_count, 20)
+        for module in modules:
+            self.assertEqual(module["module_items"], [{"module": module["id"]}])
+    
+    def test_fetch_modules_with_items_error(self):
+        """ Tests that an error fetching the items of a module is raised to the caller """
+        with patch(LIST_MODULES, return_value=APIReturn([{"id": 0}, {"id": 1}])):
+            with patch(LIST_ITEMS, side_effect=self.mock_unauthorized_exception()):
+                self.assertRaises(NewTokenNeeded, fetch_modules_with_items,
+                                  None, TEST_COURSE_ID)
+    
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_canvas_modules_cached_per_course(self):
+        """ Tests that the modules of a course are only fetched from Canvas again
+            once the cache is invalidated """
+        cache.clear()
+        self.get_canvas_modules(list_modules_return=[{"id": 0}])
+        with patch(LIST_MODULES) as mock_list_modules:
+            CanvasModules(self.request).modules
+            self.assertFalse(mock_list_modules.called)
+        invalidate_course_modules(TEST_COURSE_ID)
+        with patch(LIST_MODULES, return_value=APIReturn([])) as mock_list_modules:
+            CanvasModules(self.request).modules
+            self.assertTrue(mock_list_modules.called)
+    
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_canvas_modules_without_cache(self):
+        """ Tests that CanvasModules with use_cache=False asks Canvas even when
+            modules cached before an install are still in the cache """
+        cache.clear()
+        intervention_point = self.create_test_intervention_point()
+        self.get_canvas_modules(list_modules_return=[{"id": 0}])
+        self.assertFalse(CanvasModules(self.request).intervention_point_is_installed(
+                intervention_point))
+        mock_item = {"type": "ExternalTool",
+                     "external_url": intervention_point_url(self.request, intervention_point.id)}
+        with patch(LIST_MODULES, return_value=APIReturn([{"id": 0}])):
+            with patch(LIST_ITEMS, return_value=APIReturn([mock_item])):
+                self.assertTrue(CanvasModules(self.request, use_cache=False
+                                              ).intervention_point_is_installed(intervention_point))
+    
+    def test_canvas_modules_is_lazy(self):
+        """ Tests that creating CanvasModules doesn't call the Canvas API """
+        with patch(LIST_MODULES) as mock_list_modules:
+            CanvasModules(self.request)
+            self.assertFalse(mock_list_modules.called)
+    
+    @override_settings(CANVAS_API_CONCURRENCY=1)
+    def test_intervention_point_is_installed_stops_early(self):
+        """ Tests that intervention_point_is_installed stops fetching module items
+            once it finds the intervention point, and that later questions reuse
+            what was fetched """
+        intervention_point = self.create_test_intervention_point()
+        mock_item = {"type": "ExternalTool",
+                     "external_url": intervention_point_url(self.request, intervention_point.id)}
+        canvas_modules = CanvasModules(self.request)
+        with patch(LIST_MODULES, return_value=APIReturn([{"id": 0}, {"id": 1}, {"id": 2}])):
+            with patch(LIST_ITEMS, return_value=APIReturn([mock_item])) as mock_list_items:
+                self.assertTrue(canvas_modules.intervention_point_is_installed(intervention_point))
+                self.assertEqual(mock_list_items.call_count, 1)
+                self.assertTrue(canvas_modules.experiment_has_installed_intervention(
+                        intervention_point.experiment))
+                self.assertEqual(mock_list_items.call_count, 1)
+                self.assertEqual(len(canvas_modules.modules), 3)
+                self.assertEqual(mock_list_items.call_count, 3)
+    
+    @override_settings(CANVAS_API_CONCURRENCY=1)
+    def test_intervention_point_is_installed_not_installed(self):
+        """ Tests that intervention_point_is_installed fetches every module when
+            the intervention point isn't installed """
+        intervention_point = self.create_test_intervention_point()
+        canvas_modules = CanvasModules(self.request)
+        with patch(LIST_MODULES, return_value=APIReturn([{"id": 0}, {"id": 1}])):
+            with patch(LIST_ITEMS, return_value=APIReturn([])) as mock_list_items:
+                self.assertFalse(canvas_modules.intervention_point_is_installed(intervention_point))
+                self.assertEqual(mock_list_items.call_count, 2)
+    
+    def test_get_intervention_points_installed(self):
+        """ Tests that get_intervention_points_installed maps each intervention point
+            of the course to whether it is installed, and that the uninstalled
+            intervention points are then known without another query """
+        installed = self.create_test_intervention_point(name="ip1")
+        uninstalled = self.create_test_intervention_point(name="ip2")
+        mock_item = {"type": "ExternalTool",
+                     "external_url": intervention_point_url(self.request, installed.id)}
+        canvas_modules = self.get_canvas_modules(list_modules_return=[{"id": 0}], list_items_return=[mock_item])
+        self.assertEqual(canvas_modules.get_intervention_points_installed(),
+                         {installed.id: True, uninstalled.id: False})
+        with self.assertNumQueries(0):
+            self.assertSameIds(canvas_modules.get_uninstalled_intervention_points(), [uninstalled])
+    
+    def test_get_deletable_experiment_ids(self):
+        """ Tests that get_deletable_experiment_ids excludes finalized experiments and
+            experiments with an installed intervention point, in a fixed number of queries """
+        deletable = self.create_test_experiment(name="deletable")
+        self.create_test_intervention_point(name="ip1", experiment=deletable)
+        finalized = self.create_test_experiment(name="finalized")
+        finalized.update(tracks_finalized=True)
+        installed = self.create_test_experiment(name="installed")
+        intervention_point = self.create_test_intervention_point(name="ip2", experiment=installed)
+        mock_item = {"type": "ExternalTool",
+                     "external_url": intervention_point_url(self.request, intervention_point.id)}
+        canvas_modules = self.get_canvas_modules(list_modules_return=[{"id": 0}], list_items_return=[mock_item])
+        with self.assertNumQueries(2):
+            self.assertEqual(canvas_modules.get_deletable_experiment_ids(), [deletable.id])
+    
+    @patch(GET_ENROLLMENTS)
+    def test_experiments_with_unassigned_students(self, mock_get_all_list_data):
+        """ Tests that experiments_with_unassigned_students fetches the roster once
+            and returns only the CSV experiments with unassigned students """
+        mock_get_all_list_data.return_value = [{"sis_user_id": "1", "name": "One"},
+                                               {"sis_user_id": "2", "name": "Two"}]
+        complete = self.create_test_experiment(name="complete",
+                                               assignment_method=Experiment.CSV_UPLOAD)
+        incomplete = self.create_test_experiment(name="incomplete",
+                                                 assignment_method=Experiment.CSV_UPLOAD)
+        self.create_test_experiment(name="uniform")
+        for experiment, student_ids in [(complete, ["1", "2"]), (incomplete, ["1"])]:
+            track = self.create_test_track(experiment=experiment)
+            for student_id in student_ids:
+                ExperimentStudent.objects.create(course_id=TEST_COURSE_ID, experiment=experiment,
+                                                 student_id=student_id, track=track)
+        self.assertEqual(experiments_with_unassigned_students(self.request, TEST_COURSE_ID),
+                         [incomplete.id])
+        self.assertEqual(mock_get_all_list_data.call_count, 1)
+    
+    @patch(GET_ENROLLMENTS)
+    def test_experiments_with_unassigned_students_no_csv_experiments(self, mock_get_all_list_data):
+        """ Tests that the roster isn't fetched when there are no CSV experiments """
+        self.create_test_experiment()
+        self.assertEqual(experiments_with_unassigned_students(self.request, TEST_COURSE_ID), [])
+        self.assertFalse(mock_get_all_list_data.called)
+    
+    @patch(GET_ENROLLMENTS)
+    def test_get_unassigned_students(self, mock_get_all_list_data):
+        """ Tests that get_unassigned_students returns the students of the roster
+            without a track in the experiment """
+        mock_get_all_list_data.return_value = [{"sis_user_id": "1", "name": "One"},
+                                               {"sis_user_id": "2", "name": "Two"}]
+        experiment = self.create_test_experiment(assignment_method=Experiment.CSV_UPLOAD)
+        ExperimentStudent.objects.create(course_id=TEST_COURSE_ID, experiment=experiment,
+                                         student_id="1",
+                                         track=self.create_test_track(experiment=experiment))
+        self.assertEqual(get_unassigned_students(self.request, experiment), {"2": "Two"})
+    
+    def test_sync_course_roster(self):
+        """ Tests that sync_course_roster adds, renames and removes students and
+            moves the roster's watermark """
+        with patch(GET_ENROLLMENTS, return_value=[{"sis_user_id": "1", "name": "One"},
+                                                  {"sis_user_id": "2", "name": "Two"}]):
+            roster = sync_course_roster(None, TEST_COURSE_ID)
+        first_synced = roster.last_synced
+        self.assertEqual(roster.as_dict(), {"1": "One", "2": "Two"})
+        with patch(GET_ENROLLMENTS, return_value=[{"sis_user_id": "2", "name": "Renamed"},
+                                                  {"sis_user_id": "3", "name": "Three"}]):
+            roster = sync_course_roster(None, TEST_COURSE_ID)
+        self.assertEqual(roster.as_dict(), {"2": "Renamed", "3": "Three"})
+        self.assertGreater(roster.last_synced, first_synced)
+        self.assertEqual(CourseRoster.objects.count(), 1)
+    
+    def test_sync_course_roster_skips_older_fetch(self):
+        """ Tests that a sync whose fetch started before another sync of the
+            course finished doesn't write its older copy of the roster """
+        with patch(GET_ENROLLMENTS, return_value=[{"sis_user_id": "1", "name": "One"}]):
+            sync_course_roster(None, TEST_COURSE_ID)
+        def fetch_while_other_sync_finishes(*args, **kwargs):
+            CourseRoster.objects.filter(course_id=TEST_COURSE_ID).update(
+                    last_synced=timezone.now())
+            return [{"sis_user_id": "1", "name": "Old name"}]
+        with patch(GET_ENROLLMENTS, side_effect=fetch_while_other_sync_finishes):
+            roster = sync_course_roster(None, TEST_COURSE_ID)
+        self.assertEqual(roster.as_dict(), {"1": "One"})
+    
+    def test_sync_course_roster_renames_in_one_query(self):
+        """ Tests that renaming students takes the same number of queries
+            however many are renamed """
+        def rename(num_students):
+            course_id = "course%s" % num_students
+            students = [{"sis_user_id": str(i), "name": "Student %s" % i}
+                        for i in range(num_students)]
+            with patch(GET_ENROLLMENTS, return_value=students):
+                sync_course_roster(None, course_id)
+            renamed = [{"sis_user_id": s["sis_user_id"], "name": s["name"] + " Renamed"}
+                       for s in students]
+            with patch(GET_ENROLLMENTS, return_value=renamed):
+                with CaptureQueriesContext(connection) as queries:
+                    roster = sync_course_roster(None, course_id)
+            self.assertEqual(roster.as_dict(), {s["sis_user_id"]: s["name"] for s in renamed})
+            return len(queries)
+        self.assertEqual(rename(1), rename(5))
+    
+    def test_get_course_roster_served_locally_until_stale(self):
+        """ Tests that get_course_roster only fetches the roster from Canvas
+            once the local copy is older than COURSE_ROSTER_MAX_AGE """
+        enrollments = [{"sis_user_id": "1", "name": "One"}]
+        with patch(GET_ENROLLMENTS, return_value=enrollments) as mock_get_enrollments:
+            self.assertEqual(get_course_roster(None, TEST_COURSE_ID), {"1": "One"})
+            self.assertEqual(get_course_roster(None, TEST_COURSE_ID), {"1": "One"})
+            self.assertEqual(mock_get_enrollments.call_count, 1)
+            with self.settings(COURSE_ROSTER_MAX_AGE=60):
+                CourseRoster.objects.filter(course_id=TEST_COURSE_ID).update(
+                        last_synced=timezone.now() - timedelta(seconds=61))
+                get_course_roster(None, TEST_COURSE_ID)
+            self.assertEqual(mock_get_enrollments.call_count, 2)
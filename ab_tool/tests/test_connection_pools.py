@@ -0,0 +1,46 @@
+from django.test.utils import override_settings
+from mock import patch
+from requests.adapters import HTTPAdapter
+
+from ab_tool.connection_pools import (PooledRequestContext, get_connection_pool,
+    get_pool_stats, reset_pools)
+from ab_tool.tests.common import SessionTestCase
+
+
+TEST_CANVAS_URL = "https://canvas.example.com/api"
+
+
+@override_settings(CANVAS_HTTP_POOL_SIZE=4, CANVAS_HTTP_CONNECT_TIMEOUT=2,
+                   CANVAS_HTTP_READ_TIMEOUT=10)
+class TestConnectionPools(SessionTestCase):
+    def setUp(self):
+        super(TestConnectionPools, self).setUp()
+        reset_pools()
+        self.addCleanup(reset_pools)
+
+    def test_one_pool_per_host(self):
+        """ Tests that urls on the same host share a pool and that the
+            counters record it """
+        pool = get_connection_pool(TEST_CANVAS_URL)
+        self.assertIs(get_connection_pool("https://canvas.example.com/api/v1/courses"), pool)
+        self.assertIsNot(get_connection_pool("https://other.example.com/api"), pool)
+        self.assertEqual(get_pool_stats(), {"pools": 2, "hits": 1, "misses": 2})
+
+    def test_request_contexts_share_pool(self):
+        """ Tests that contexts for different tokens have their own sessions
+            but send requests through the same pool """
+        context1 = PooledRequestContext("token1", TEST_CANVAS_URL)
+        context2 = PooledRequestContext("token2", TEST_CANVAS_URL)
+        self.assertIsNot(context1.session, context2.session)
+        url = TEST_CANVAS_URL + "/v1/courses/1/modules"
+        self.assertIs(context1.session.get_adapter(url), context2.session.get_adapter(url))
+        self.assertIs(context1.session.get_adapter(url), get_connection_pool(TEST_CANVAS_URL))
+
+    def test_pool_applies_default_timeout(self):
+        """ Tests that requests sent without a timeout get the configured ones """
+        pool = get_connection_pool(TEST_CANVAS_URL)
+        with patch.object(HTTPAdapter, "send") as mock_send:
+            pool.send("request")
+            pool.send("request", timeout=1)
+        self.assertEqual(mock_send.call_args_list[0][1]["timeout"], (2, 10))
+        self.assertEqual(mock_send.call_args_list[1][1]["timeout"], 1)
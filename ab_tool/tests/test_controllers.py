@@ -1,14 +1,18 @@
-from mock import MagicMock
+from django.core.cache import cache
+from django.test.utils import override_settings
+from mock import MagicMock, patch
 
 from ab_tool.controllers import (intervention_point_url,
     validate_format_url, post_param, assign_track_and_create_student,
-    validate_name, validate_weighting)
-from ab_tool.tests.common import (SessionTestCase, TEST_STUDENT_ID, TEST_STUDENT_NAME)
+    validate_name, validate_weighting, save_track_assignments, check_experiment_complete)
+from ab_tool.caching import get_student_assignment
+from ab_tool.tests.common import (SessionTestCase, TEST_STUDENT_ID, TEST_STUDENT_NAME,
+    LOCMEM_CACHES)
 from ab_tool.exceptions import (BAD_INTERVENTION_POINT_ID, CSV_UPLOAD_NEEDED,
     NO_TRACKS_FOR_EXPERIMENT, TRACK_WEIGHTS_NOT_SET,
     INVALID_URL_PARAM, MISSING_NAME_PARAM, PARAM_LENGTH_EXCEEDS_LIMIT,
     INCORRECT_WEIGHTING_PARAM)
-from ab_tool.models import Experiment, ExperimentStudent
+from ab_tool.models import Experiment, ExperimentStudent, InterventionPointUrl
 
 
 class TestControllers(SessionTestCase):
@@ -32,6 +36,33 @@ class TestControllers(SessionTestCase):
         self.assertTrue(student in ExperimentStudent.objects.all())
         self.assertTrue(student.track == track)
 
+    def test_assign_track_and_create_student_follows_cumulative_weights(self):
+        """ Tests that the track is picked by where the random draw falls within
+            the cumulative weights of the tracks """
+        experiment = self.create_test_experiment(assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+        track1 = self.create_test_track(experiment=experiment, name="track1")
+        track2 = self.create_test_track(experiment=experiment, name="track2")
+        self.create_test_track_weight(track=track1, experiment=experiment, weighting=30)
+        self.create_test_track_weight(track=track2, experiment=experiment, weighting=70)
+        with patch("ab_tool.controllers.randrange", return_value=29) as mock_randrange:
+            student = assign_track_and_create_student(experiment, "1", TEST_STUDENT_NAME)
+            mock_randrange.assert_called_with(100)
+        self.assertEqual(student.track, track1)
+        with patch("ab_tool.controllers.randrange", return_value=30):
+            student = assign_track_and_create_student(experiment, "2", TEST_STUDENT_NAME)
+        self.assertEqual(student.track, track2)
+    
+    def test_assign_track_and_create_student_skips_zero_weights(self):
+        """ Tests that a track with a weight of 0 is never assigned """
+        experiment = self.create_test_experiment(assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+        track1 = self.create_test_track(experiment=experiment, name="track1")
+        track2 = self.create_test_track(experiment=experiment, name="track2")
+        self.create_test_track_weight(track=track1, experiment=experiment, weighting=0)
+        self.create_test_track_weight(track=track2, experiment=experiment, weighting=1)
+        for i in range(10):
+            student = assign_track_and_create_student(experiment, str(i), TEST_STUDENT_NAME)
+            self.assertEqual(student.track, track2)
+    
     def test_assign_track_and_create_student_without_weights_raises_error(self):
         experiment = self.create_test_experiment(assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
         self.create_test_track(experiment=experiment)
@@ -122,3 +153,100 @@ class TestControllers(SessionTestCase):
         self.assertRaisesSpecific(INCORRECT_WEIGHTING_PARAM, validate_weighting, weighting)
         weighting = 101
         self.assertRaisesSpecific(INCORRECT_WEIGHTING_PARAM, validate_weighting, weighting)
+    
+    def test_save_track_assignments_creates_students(self):
+        """ Tests that save_track_assignments creates the uploaded students and
+            finalizes the experiment's tracks """
+        experiment = self.create_test_experiment(assignment_method=Experiment.CSV_UPLOAD)
+        track1 = self.create_test_track(name="track1", experiment=experiment)
+        track2 = self.create_test_track(name="track2", experiment=experiment)
+        assignments = {"student%s" % i: (track1, track2)[i % 2] for i in range(10)}
+        names = {student_id: student_id.title() for student_id in assignments}
+        self.assertEqual(save_track_assignments(experiment, assignments, names), (10, []))
+        students = ExperimentStudent.objects.filter(experiment=experiment)
+        self.assertEqual({s.student_id: (s.track_id, s.student_name) for s in students},
+                         {student_id: (track.id, names[student_id])
+                          for student_id, track in assignments.items()})
+        self.assertTrue(Experiment.objects.get(id=experiment.id).tracks_finalized)
+    
+    def test_save_track_assignments_keeps_existing_assignments(self):
+        """ Tests that students already in the experiment keep their track and
+            are reported rather than moved or duplicated """
+        experiment = self.create_test_experiment(assignment_method=Experiment.CSV_UPLOAD)
+        track1 = self.create_test_track(name="track1", experiment=experiment)
+        track2 = self.create_test_track(name="track2", experiment=experiment)
+        ExperimentStudent.objects.create(course_id=experiment.course_id, experiment=experiment,
+                                         track=track1, student_id=TEST_STUDENT_ID)
+        self.assertEqual(save_track_assignments(
+                experiment, {TEST_STUDENT_ID: track2, "other": track2},
+                {TEST_STUDENT_ID: TEST_STUDENT_NAME, "other": "Other"}), (1, [TEST_STUDENT_ID]))
+        students = ExperimentStudent.objects.filter(experiment=experiment)
+        self.assertEqual(sorted((s.student_id, s.track_id) for s in students),
+                         sorted([(TEST_STUDENT_ID, track1.id), ("other", track2.id)]))
+    
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_save_track_assignments_caches_assignments(self):
+        """ Tests that the saved assignments are written to the cache even
+            though bulk writes don't send signals """
+        cache.clear()
+        experiment = self.create_test_experiment(assignment_method=Experiment.CSV_UPLOAD)
+        track = self.create_test_track(experiment=experiment)
+        save_track_assignments(experiment, {TEST_STUDENT_ID: track},
+                               {TEST_STUDENT_ID: TEST_STUDENT_NAME})
+        student = ExperimentStudent.objects.get(experiment=experiment)
+        self.assertEqual(get_student_assignment(experiment.id, TEST_STUDENT_ID),
+                         {"id": student.id, "track_id": track.id})
+    
+    @override_settings(CACHES=LOCMEM_CACHES)
+    @patch("ab_tool.controllers.STUDENT_WRITE_BATCH_SIZE", 2)
+    def test_save_track_assignments_in_batches(self):
+        """ Tests that uploads larger than a batch are saved and cached in full,
+            and that students already assigned keep their track """
+        cache.clear()
+        experiment = self.create_test_experiment(assignment_method=Experiment.CSV_UPLOAD)
+        track1 = self.create_test_track(name="track1", experiment=experiment)
+        track2 = self.create_test_track(name="track2", experiment=experiment)
+        for student_id in ["0", "1", "untouched"]:
+            ExperimentStudent.objects.create(student_id=student_id, student_name=student_id,
+                                             course_id=experiment.course_id, track=track1,
+                                             experiment=experiment)
+        assignments = {str(i): track2 for i in range(7)}
+        self.assertEqual(
+                save_track_assignments(experiment, assignments, {str(i): str(i) for i in range(7)}),
+                (5, ["0", "1"]))
+        students = ExperimentStudent.objects.filter(experiment=experiment)
+        self.assertEqual(sorted((s.student_id, s.track_id) for s in students),
+                         sorted([(str(i), track2.id) for i in range(2, 7)] +
+                                [("0", track1.id), ("1", track1.id), ("untouched", track1.id)]))
+        for i in range(2, 7):
+            self.assertEqual(get_student_assignment(experiment.id, str(i))["track_id"], track2.id)
+    
+    def test_check_experiment_complete(self):
+        """ Tests that check_experiment_complete finds the intervention points
+            with missing or blank urls and the tracks without weights in two
+            queries """
+        experiment = self.create_test_experiment(
+                assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+        track1 = self.create_test_track(name="track1", experiment=experiment)
+        track2 = self.create_test_track(name="track2", experiment=experiment)
+        track1.set_weighting(50)
+        complete, missing, blank = [
+                self.create_test_intervention_point(name=name, experiment=experiment)
+                for name in ["complete", "missing", "blank"]]
+        for intervention_point, track, url in [(complete, track1, "http://example.com"),
+                                               (complete, track2, "http://example.com"),
+                                               (missing, track1, "http://example.com"),
+                                               (blank, track1, "http://example.com"),
+                                               (blank, track2, "")]:
+            InterventionPointUrl.objects.create(intervention_point=intervention_point,
+                                                track=track, url=url)
+        with self.assertNumQueries(2):
+            result = check_experiment_complete(experiment)
+        self.assertEqual(result, (["track1", "track2"], ["missing", "blank"], ["track2"]))
+    
+    def test_check_experiment_complete_unweighted(self):
+        """ Tests that check_experiment_complete doesn't require weights for
+            experiments that aren't weighted """
+        experiment = self.create_test_experiment(assignment_method=Experiment.UNIFORM_RANDOM)
+        self.create_test_track(name="track1", experiment=experiment)
+        self.assertEqual(check_experiment_complete(experiment), (["track1"], [], []))
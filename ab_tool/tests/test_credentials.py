@@ -0,0 +1,61 @@
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test.utils import override_settings
+from mock import patch
+
+from ab_tool.credentials import record_credential, flush_credentials
+from ab_tool.models import CourseCredential
+from ab_tool.tests.common import SessionTestCase, TEST_COURSE_ID, LOCMEM_CACHES
+
+
+TEST_CANVAS_URL = "https://canvas.example.com/api"
+TEST_EMAIL = "admin@example.com"
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestCredentials(SessionTestCase):
+    def setUp(self):
+        super(TestCredentials, self).setUp()
+        cache.clear()
+
+    def test_unchanged_credential_skips_database(self):
+        """ Tests that recording the same credential again doesn't query the database """
+        self.assertTrue(record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, TEST_EMAIL, "token1"))
+        with self.assertNumQueries(0):
+            self.assertFalse(record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, TEST_EMAIL, "token1"))
+        self.assertEqual(CourseCredential.objects.get(email=TEST_EMAIL).token, "token1")
+
+    def test_changed_token_replaces_credential(self):
+        """ Tests that a new token for the admin replaces the stored one """
+        record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, TEST_EMAIL, "token1")
+        self.assertTrue(record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, TEST_EMAIL, "token2"))
+        credentials = CourseCredential.objects.filter(course__course_id=TEST_COURSE_ID)
+        self.assertEqual([(c.email, c.token) for c in credentials], [(TEST_EMAIL, "token2")])
+
+    @override_settings(COURSE_CREDENTIAL_FLUSH_INTERVAL_SECS=60)
+    @patch("ab_tool.credentials._ensure_worker")
+    def test_deferred_credentials_written_on_flush(self, _mock):
+        """ Tests that deferred credentials are only written on flush, keeping
+            the latest token of each admin """
+        record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, TEST_EMAIL, "token1")
+        record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, TEST_EMAIL, "token2")
+        record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, "other@example.com", "token3")
+        self.assertFalse(CourseCredential.objects.exists())
+        self.assertEqual(flush_credentials(), 2)
+        self.assertEqual(CourseCredential.objects.get(email=TEST_EMAIL).token, "token2")
+        self.assertFalse(record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, TEST_EMAIL, "token2"))
+        self.assertEqual(flush_credentials(), 0)
+    
+    @override_settings(COURSE_CREDENTIAL_FLUSH_INTERVAL_SECS=60)
+    @patch("ab_tool.credentials._ensure_worker")
+    def test_failed_flush_requeues_credentials(self, _mock):
+        """ Tests that credentials whose write failed are written by the next
+            flush, unless a newer token was recorded for the admin since """
+        record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, TEST_EMAIL, "token1")
+        record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, "other@example.com", "token2")
+        with patch("ab_tool.credentials._write_credentials", side_effect=DatabaseError):
+            self.assertEqual(flush_credentials(), 0)
+        record_credential(TEST_COURSE_ID, TEST_CANVAS_URL, TEST_EMAIL, "token3")
+        self.assertEqual(flush_credentials(), 2)
+        self.assertEqual(CourseCredential.objects.get(email=TEST_EMAIL).token, "token3")
+        self.assertEqual(CourseCredential.objects.get(email="other@example.com").token, "token2")
@@ -2,10 +2,12 @@ from ab_tool.tests.common import (SessionTestCase, TEST_COURSE_ID,
     TEST_OTHER_COURSE_ID, NONEXISTENT_TRACK_ID, NONEXISTENT_EXPERIMENT_ID,
     APIReturn, LIST_MODULES)
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from ab_tool.models import (Experiment, InterventionPointUrl)
 from ab_tool.exceptions import (EXPERIMENT_TRACKS_ALREADY_FINALIZED,
     NO_TRACKS_FOR_EXPERIMENT, UNAUTHORIZED_ACCESS,
-    INTERVENTION_POINTS_ARE_INSTALLED)
+    INTERVENTION_POINTS_ARE_INSTALLED, INCORRECT_WEIGHTING_PARAM)
 import json
 from mock import patch
 
@@ -51,6 +53,24 @@ class TestExperimentPages(SessionTestCase):
         response = self.client.get(reverse("ab_testing_tool_edit_experiment", args=(experiment.id,)))
         self.assertTemplateUsed(response, "ab_tool/edit_experiment.html")
     
+    def test_edit_experiment_view_query_count_independent_of_tracks(self):
+        """ Tests that the number of queries made to render edit_experiment
+            doesn't grow with the number of tracks """
+        def render(num_tracks):
+            experiment = self.create_test_experiment(name="experiment%s" % num_tracks,
+                    assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+            for i in range(num_tracks):
+                track = self.create_test_track(experiment=experiment, name="track%s" % i)
+                self.create_test_track_weight(experiment=experiment, track=track)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("ab_testing_tool_edit_experiment",
+                                                   args=(experiment.id,)))
+            self.assertOkay(response)
+            self.assertEqual(len(json.loads(response.context["experiment_json"])["tracks"]),
+                             num_tracks)
+            return len(queries)
+        self.assertEqual(render(1), render(5))
+    
     def test_edit_experiment_view_unauthorized(self):
         """ Tests edit_experiment template doesn't render when unauthorized """
         self.set_roles([])
@@ -329,6 +349,55 @@ class TestExperimentPages(SessionTestCase):
         self.assertEquals(track1.weight.weighting, 30) #Checks weighting has changed
         self.assertEquals(track2.weight.weighting, 70)
     
+    def test_submit_edit_experiment_invalid_track_changes_nothing(self):
+        """ Tests that submit_edit_experiment saves nothing if any track is invalid """
+        experiment = self.create_test_experiment(name="old_name",
+                assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+        track = self.create_test_track(experiment=experiment, name="A")
+        self.create_test_track_weight(experiment=experiment, track=track, weighting=50)
+        experiment_json = {
+                "name": "new_name", "notes": "hi", "uniformRandom": False,
+                "csvUpload": False,
+                "tracks": [{"id": track.id, "weighting": 30, "name": "C"},
+                           {"id": None, "weighting": 500, "name": "D"}]
+        }
+        response = self.client.post(
+            reverse("ab_testing_tool_submit_edit_experiment", args=(experiment.id,)),
+            follow=True, content_type="application/json", data=json.dumps(experiment_json)
+        )
+        self.assertError(response, INCORRECT_WEIGHTING_PARAM)
+        experiment = Experiment.objects.get(id=experiment.id)
+        self.assertEquals(experiment.name, "old_name")
+        self.assertEquals([(t.name, t.get_weighting()) for t in experiment.tracks.all()],
+                          [("A", 50)])
+    
+    def test_submit_edit_experiment_query_count_independent_of_tracks(self):
+        """ Tests that the number of queries made to save an experiment doesn't
+            grow with its number of tracks """
+        def submit(num_tracks):
+            experiment = self.create_test_experiment(name="experiment%s" % num_tracks,
+                    assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+            tracks = [self.create_test_track(experiment=experiment, name="track%s" % i)
+                      for i in range(num_tracks)]
+            for track in tracks[1:]:
+                self.create_test_track_weight(experiment=experiment, track=track)
+            track_dicts = [{"id": t.id, "weighting": 10, "name": t.name + "_new"} for t in tracks]
+            track_dicts += [{"id": None, "weighting": 10, "name": "new%s" % i}
+                            for i in range(num_tracks)]
+            experiment_json = {"name": experiment.name, "notes": "", "uniformRandom": False,
+                               "csvUpload": False, "tracks": track_dicts}
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    reverse("ab_testing_tool_submit_edit_experiment", args=(experiment.id,)),
+                    content_type="application/json", data=json.dumps(experiment_json)
+                )
+            self.assertEquals(response.content, "success")
+            self.assertEquals(experiment.tracks.count(), 2 * num_tracks)
+            self.assertEquals(experiment.track_probabilites.filter(weighting=10).count(),
+                              2 * num_tracks)
+            return len(queries)
+        self.assertEqual(submit(2), submit(10))
+    
     def test_delete_experiment(self):
         """ Tests that delete_experiment method properly deletes a experiment when authorized"""
         first_num_experiments = Experiment.objects.count()
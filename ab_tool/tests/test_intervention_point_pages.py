@@ -1,4 +1,6 @@
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from mock import patch, Mock
 
 from ab_tool.views.intervention_point_pages import get_ip_open_where_display_index
@@ -268,6 +270,31 @@ class TestInterventionPointPages(SessionTestCase):
                 intervention_point=intervention_point, track=track2).url,
                 "http://example.com/second_page")
     
+    def test_submit_edit_intervention_point_query_count_independent_of_tracks(self):
+        """ Tests that the number of queries made to save an intervention point's
+            urls doesn't grow with the number of tracks """
+        def submit(num_tracks):
+            experiment = self.create_test_experiment(name="experiment%s" % num_tracks)
+            intervention_point = self.create_test_intervention_point(experiment=experiment)
+            tracks = [self.create_test_track(experiment=experiment, name="track%s" % i)
+                      for i in range(2 * num_tracks)]
+            for track in tracks[:num_tracks]:
+                InterventionPointUrl.objects.create(intervention_point=intervention_point,
+                                                    url="http://example.com/old", track=track)
+            data = {"name": intervention_point.name, "notes": ""}
+            for track in tracks:
+                data[INTERVENTION_POINT_URL_TAG + str(track.id)] = "http://example.com/new"
+                data[DEPLOY_OPTION_TAG + str(track.id)] = "newTab"
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse("ab_testing_tool_submit_edit_intervention_point",
+                                                    args=(intervention_point.id,)), data)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(InterventionPointUrl.objects.filter(
+                    intervention_point=intervention_point, url="http://example.com/new",
+                    open_as_tab=True).count(), 2 * num_tracks)
+            return len(queries)
+        self.assertEqual(submit(1), submit(5))
+    
     def test_submit_edit_intervention_point_unauthorized(self):
         """ Tests that submit_edit_intervention_point when unauthorized """
         self.set_roles([])
@@ -400,6 +427,26 @@ class TestInterventionPointPages(SessionTestCase):
         self.assertOkay(response)
         self.assertTemplateUsed(response, "ab_tool/view_intervention_point_from_canvas.html")
     
+    def test_modules_page_intervention_point_query_count_independent_of_tracks(self):
+        """ Tests that the number of queries made to render the modules page
+            views of an intervention point doesn't grow with the number of tracks """
+        def render(view_name, num_tracks):
+            experiment = self.create_test_experiment(name="%s%s" % (view_name, num_tracks))
+            intervention_point = self.create_test_intervention_point(experiment=experiment)
+            tracks = [self.create_test_track(experiment=experiment, name="track%s" % i)
+                      for i in range(2 * num_tracks)]
+            for track in tracks[:num_tracks]:
+                InterventionPointUrl.objects.create(intervention_point=intervention_point,
+                                                    url="http://example.com/page", track=track)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse(view_name, args=(intervention_point.id,)))
+            self.assertOkay(response)
+            self.assertEqual(response.content.count("http://example.com/page"), num_tracks)
+            return len(queries)
+        for view_name in ["ab_testing_tool_modules_page_view_intervention_point",
+                          "ab_testing_tool_modules_page_edit_intervention_point"]:
+            self.assertEqual(render(view_name, 1), render(view_name, 5))
+    
     def test_submit_edit_intervention_point_from_modules(self):
         """ Tests that test_submit_edit_intervention_point_from_modules does not change DB count
             but does change InterventionPoint attribute """
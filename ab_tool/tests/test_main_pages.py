@@ -1,11 +1,13 @@
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from mock import patch
 
-from ab_tool.controllers import intervention_point_url
+from ab_tool.controllers import intervention_point_url, load_dashboard_experiments
 from ab_tool.tests.common import (SessionTestCase, LIST_MODULES,
     LIST_ITEMS, APIReturn, TEST_COURSE_ID, TEST_OTHER_COURSE_ID)
 from ab_tool.models import (ExperimentStudent, Experiment,
-    InterventionPointInteraction)
+    InterventionPointInteraction, InterventionPointUrl)
 from ab_tool.views.main_pages import tool_config
 
 
@@ -92,6 +94,53 @@ class TestMainPages(SessionTestCase):
             response = self.client.get(reverse("ab_testing_tool_index"), follow=True)
             self.assertEqual(response.context["modules"], ret_val)
     
+    def create_dashboard_experiment(self, name):
+        """ Creates an experiment with two tracks and an intervention point with
+            a url for one of them """
+        experiment = self.create_test_experiment(name=name)
+        track1 = self.create_test_track(name="track1", experiment=experiment)
+        self.create_test_track(name="track2", experiment=experiment)
+        track1.set_weighting(10)
+        intervention_point = self.create_test_intervention_point(name="ip", experiment=experiment)
+        InterventionPointUrl.objects.create(intervention_point=intervention_point, track=track1,
+                                            url="http://example.com")
+        return experiment
+    
+    def test_load_dashboard_experiments(self):
+        """ Tests that load_dashboard_experiments attaches the tracks, intervention
+            points and urls of each experiment, in a fixed number of queries """
+        experiment = self.create_dashboard_experiment("experiment1")
+        self.create_dashboard_experiment("experiment2")
+        tracks = list(experiment.tracks.all())
+        with self.assertNumQueries(4):
+            experiments, intervention_points = load_dashboard_experiments(TEST_COURSE_ID)
+            self.assertSameIds(experiments[0].track_list, tracks)
+            self.assertEqual(experiments[0].track_list[0].get_weighting(), 10)
+            intervention_point = experiments[0].intervention_point_list[0]
+            self.assertEqual([u.url for u in intervention_point.track_url_list],
+                             ["http://example.com", ""])
+            self.assertEqual([u.track.name for u in intervention_point.track_url_list],
+                             ["track1", "track2"])
+            self.assertTrue(intervention_point.missing_urls)
+            self.assertEqual(experiments[0].incomplete_intervention_point_names, ["ip"])
+        self.assertEqual(len(intervention_points), 2)
+        self.assertEqual(intervention_point.missing_urls, intervention_point.is_missing_urls())
+    
+    def test_control_panel_query_count_independent_of_experiments(self):
+        """ Tests that the number of queries made to render the control panel
+            doesn't grow with the number of experiments """
+        self.create_dashboard_experiment("experiment1")
+        with CaptureQueriesContext(connection) as one_experiment:
+            response = self.client.get(reverse("ab_testing_tool_index"), follow=True)
+            self.assertOkay(response)
+        for i in range(2, 6):
+            self.create_dashboard_experiment("experiment%s" % i)
+        with CaptureQueriesContext(connection) as five_experiments:
+            response = self.client.get(reverse("ab_testing_tool_index"), follow=True)
+            self.assertOkay(response)
+        self.assertEqual(len(response.context["experiments"]), 5)
+        self.assertEqual(len(one_experiment), len(five_experiments))
+    
     def test_tool_config(self):
         """ Tests that that tool_config page returns XML content"""
         response = self.client.get(reverse("ab_testing_tool_tool_config"))
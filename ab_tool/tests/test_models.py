@@ -2,7 +2,9 @@ from ab_tool.tests.common import SessionTestCase, TEST_COURSE_ID
 from ab_tool.models import (Track, InterventionPointUrl, Experiment,
     TrackProbabilityWeight, InterventionPoint)
 import json
-from django.db import IntegrityError
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 from mock import patch
 from ab_tool.exceptions import DATABASE_ERROR
 
@@ -62,6 +64,18 @@ class TestModels(SessionTestCase):
         self.assertEqual(len(experiment_dict["tracks"]), 2)
         self.assertEqual(experiment_dict["uniformRandom"], True)
     
+    def test_experiment_to_json_tracks(self):
+        """ Tests that to_json includes the weighting and delete url of each track """
+        experiment = self.create_test_experiment()
+        track1 = self.create_test_track(name="track1", experiment=experiment)
+        track2 = self.create_test_track(name="track2", experiment=experiment)
+        self.create_test_track_weight(weighting=42, experiment=experiment, track=track1)
+        experiment_dict = json.loads(experiment.to_json())
+        self.assertEqual(
+            [(t["id"], t["weighting"], t["deleteURL"]) for t in experiment_dict["tracks"]],
+            [(track1.id, 42, reverse("ab_testing_tool_delete_track", args=(track1.id,))),
+             (track2.id, None, reverse("ab_testing_tool_delete_track", args=(track2.id,)))])
+    
     def test_track_get_weighting(self):
         """ Tests that get_weighting returns the weighting of the track """
         track = self.create_test_track()
@@ -119,6 +133,51 @@ class TestModels(SessionTestCase):
         self.assertEqual(InterventionPoint.objects.count(), num_ips + 2)
         self.assertEqual(InterventionPointUrl.objects.count(), num_ip_urls + 8)
     
+    def create_copyable_experiment(self, name, num_tracks, num_intervention_points):
+        experiment = self.create_test_experiment(
+                name=name, assignment_method=Experiment.WEIGHTED_PROBABILITY_RANDOM)
+        tracks = [self.create_test_track(experiment=experiment, name="track%s" % i)
+                  for i in range(num_tracks)]
+        for i, track in enumerate(tracks):
+            track.set_weighting(i + 1)
+        for i in range(num_intervention_points):
+            intervention_point = self.create_test_intervention_point(
+                    name="ip%s" % i, experiment=experiment)
+            for track in tracks:
+                InterventionPointUrl.objects.create(
+                        intervention_point=intervention_point, track=track,
+                        url="http://example.com/%s/%s" % (intervention_point.name, track.name))
+        return experiment
+    
+    def test_copy_experiment_remaps_objects(self):
+        """ Tests that the copied weights and urls belong to the copied tracks
+            and intervention points """
+        experiment = self.create_copyable_experiment("original", 2, 2)
+        experiment.copy("new_name")
+        copy = Experiment.objects.get(name="new_name")
+        self.assertFalse(copy.tracks_finalized)
+        self.assertEqual(sorted((t.name, t.get_weighting()) for t in copy.tracks.all()),
+                         [("track0", 1), ("track1", 2)])
+        ip_urls = InterventionPointUrl.objects.filter(intervention_point__experiment=copy)
+        self.assertEqual(
+                sorted((u.intervention_point.name, u.track.name, u.url, u.track.experiment_id)
+                       for u in ip_urls),
+                sorted((ip, track, "http://example.com/%s/%s" % (ip, track), copy.id)
+                       for ip in ["ip0", "ip1"] for track in ["track0", "track1"]))
+    
+    def test_copy_experiment_query_count_independent_of_size(self):
+        """ Tests that the number of queries made to copy an experiment doesn't
+            grow with its number of tracks and intervention points """
+        small_experiment = self.create_copyable_experiment("small", 1, 1)
+        large_experiment = self.create_copyable_experiment("large", 4, 5)
+        with CaptureQueriesContext(connection) as small_copy:
+            small_experiment.copy("small_copy")
+        with CaptureQueriesContext(connection) as large_copy:
+            large_experiment.copy("large_copy")
+        self.assertEqual(len(small_copy), len(large_copy))
+        self.assertEqual(InterventionPointUrl.objects.filter(
+                intervention_point__experiment__name="large_copy").count(), 20)
+    
     @patch("django.db.models.Model.save", side_effect=IntegrityError("error"))
     def test_object_update_raises_integrity_error(self, _mock1):
         """ Tests that database error is raised. The patch creates a fake database conflict """
@@ -1,14 +1,21 @@
+import StringIO
+import openpyxl
+import xlsxwriter
 from django.test import RequestFactory
+from django.test.utils import override_settings
 
 from ab_tool.spreadsheets import (get_student_list_csv, get_intervention_point_interactions_csv,
                                   get_track_selection_xlsx, get_track_selection_csv,
-                                  parse_uploaded_file, parse_row)
+                                  parse_uploaded_file, parse_row, iterate_in_chunks,
+                                  build_track_selection_xlsx)
 
 from ab_tool.models import (InterventionPointUrl, ExperimentStudent, Experiment,
                             InterventionPointInteraction)
+from ab_tool.analytics import archive_interactions
 from ab_tool.tests.common import (SessionTestCase, TEST_COURSE_ID, TEST_STUDENT_ID)
 from mock import patch, Mock
 from error_middleware.exceptions import Renderable404
+from ab_tool.exceptions import XLS_FILE_TOO_LARGE
 
 
 '''
@@ -100,6 +107,30 @@ class TestSpreadsheets(SessionTestCase):
         self.assertTrue('Experiment 1' in streaming_list[1])
         self.assertTrue('track1' in streaming_list[1])
 
+    def assertExportQueries(self, export_csv, num_rows, num_queries):
+        """
+        Asserts that streaming the csv returned by export_csv for the experiment
+        yields num_rows rows after the header in num_queries queries
+        """
+        response = export_csv(self.experiment, TEST_XLSX_FILE_NAME)
+        with self.assertNumQueries(num_queries):
+            streaming_list = list(response.streaming_content)
+        self.assertEqual(len(streaming_list), num_rows + 1)
+
+    @patch('ab_tool.spreadsheets.EXPORT_CHUNK_SIZE', 10)
+    def test_get_student_list_csv_query_count(self):
+        """
+        Test that get_student_list_csv fetches the students a chunk per query,
+        after one query for the track names
+        """
+        self.assertExportQueries(get_student_list_csv, 1, 2)
+        ExperimentStudent.objects.bulk_create([
+                ExperimentStudent(course_id=TEST_COURSE_ID, experiment=self.experiment,
+                                  student_id="student_%s" % i, track=self.track2)
+                for i in range(100)])
+        # 101 students are 10 full chunks and a last chunk of 1
+        self.assertExportQueries(get_student_list_csv, 101, 12)
+
     def test_get_intervention_point_interactions_csv(self):
         """
         Test that get_intervention_point_interactions_csv returned the correct data
@@ -111,6 +142,51 @@ class TestSpreadsheets(SessionTestCase):
         self.assertTrue('Experiment 1' in streaming_list[1])
         self.assertTrue(TEST_DOMAIN in streaming_list[1])
 
+    def test_get_intervention_point_interactions_csv_includes_archive(self):
+        """
+        Test that get_intervention_point_interactions_csv includes interactions
+        that have been moved to the archive
+        """
+        archive_interactions(InterventionPointInteraction.objects.all())
+        response = get_intervention_point_interactions_csv(self.experiment, TEST_XLSX_FILE_NAME)
+        streaming_list = list(response.streaming_content)
+        self.assertEqual(len(streaming_list), 2)
+        self.assertTrue(TEST_STUDENT_ID in streaming_list[1])
+        self.assertTrue('Experiment 1' in streaming_list[1])
+        self.assertTrue(TEST_DOMAIN in streaming_list[1])
+
+    @patch('ab_tool.spreadsheets.EXPORT_CHUNK_SIZE', 10)
+    def test_get_intervention_point_interactions_csv_query_count(self):
+        """
+        Test that get_intervention_point_interactions_csv fetches the interactions
+        a chunk per query, after one query for the (empty) archive
+        """
+        self.assertExportQueries(get_intervention_point_interactions_csv, 1, 2)
+        InterventionPointInteraction.objects.bulk_create([
+                InterventionPointInteraction(course_id=TEST_COURSE_ID, student=self.student,
+                                             intervention_point=self.intervention_point,
+                                             experiment=self.experiment, track=self.track1,
+                                             url=TEST_DOMAIN)
+                for _ in range(100)])
+        # 101 interactions are 10 full chunks and a last chunk of 1
+        self.assertExportQueries(get_intervention_point_interactions_csv, 101, 12)
+
+    def test_iterate_in_chunks(self):
+        """
+        Test that iterate_in_chunks returns every row, one query per chunk
+        """
+        InterventionPointInteraction.objects.bulk_create([
+                InterventionPointInteraction(course_id=TEST_COURSE_ID, student=self.student,
+                                             intervention_point=self.intervention_point,
+                                             experiment=self.experiment, track=self.track1,
+                                             url=TEST_DOMAIN)
+                for _ in range(4)])
+        ids = list(InterventionPointInteraction.objects.order_by("id").values_list("id", flat=True))
+        with self.assertNumQueries(3):
+            rows = list(iterate_in_chunks(InterventionPointInteraction.objects.all(),
+                                          ("id",), chunk_size=2))
+        self.assertEqual([row[0] for row in rows], ids)
+
     @patch('ab_tool.spreadsheets.get_unassigned_students')
     def test_get_track_selection_xlsx(self, mock_get_unassigned_students):
         """
@@ -120,6 +196,19 @@ class TestSpreadsheets(SessionTestCase):
         response = get_track_selection_xlsx(self.request, self.experiment)
         self.assertEqual(response.items(), TEST_CONTENT_TYPE)
 
+    def test_build_track_selection_xlsx(self):
+        """
+        Test that build_track_selection_xlsx writes a row per student after the
+        headers
+        """
+        output = build_track_selection_xlsx("Experiment 1", TEST_STUDENT_DICT, ["track1"])
+        sheet = openpyxl.load_workbook(output, read_only=True).worksheets[0]
+        rows = [[cell.value for cell in row] for row in sheet.iter_rows()]
+        self.assertEqual(rows[0], ["Student Name", "Student ID", "Experiment", "Assigned Track"])
+        self.assertEqual(sorted(row[:3] for row in rows[1:]),
+                         sorted([name, student_id, "Experiment 1"]
+                                for student_id, name in TEST_STUDENT_DICT.items()))
+
     @patch('ab_tool.spreadsheets.get_unassigned_students')
     def test_get_track_selection_csv(self, mock_get_unassigned_students):
         """
@@ -131,38 +220,74 @@ class TestSpreadsheets(SessionTestCase):
         streaming_list = list(response.streaming_content)
         self.assertEqual(streaming_list, TEST_TRACK_SELECTION_RESPONSE)
 
-    @patch('ab_tool.spreadsheets.xlrd.open_workbook')
-    def test_parse_uploaded_xlsx_file(self, mock_open_workbook):
+    def test_parse_uploaded_xlsx_file(self):
         """
-        Test that parse_uploaded_xlsx_file calls the xlrd.open_workbook method with the
-        appropriate data for files of type xlsx
+        Test that parse_uploaded_file reads the rows of xlsx files, including
+        student ids stored as numbers
         """
-        parse_uploaded_file(self.experiment, TEST_STUDENT_DICT, TEST_TRACK_SELECTION_RESPONSE, TEST_XLSX_FILE_NAME)
-        mock_open_workbook.assert_called_with(file_contents=TEST_TRACK_SELECTION_RESPONSE)
+        output = StringIO.StringIO()
+        workbook = xlsxwriter.Workbook(output, {"in_memory": True})
+        worksheet = workbook.add_worksheet()
+        for row_number, line in enumerate(TEST_TRACK_SELECTION_UPLOAD):
+            worksheet.write_row(row_number, 0, line.strip().split(","))
+        worksheet.write_number(1, 1, 40212478)
+        workbook.close()
+        output.seek(0)
+        students, errors = parse_uploaded_file(self.experiment, TEST_STUDENT_DICT,
+                                               output, TEST_XLSX_FILE_NAME)
+        self.assertEqual(errors, [])
+        self.assertEqual(students, {student_id: self.track1 for student_id in TEST_STUDENT_DICT})
 
     @patch('ab_tool.spreadsheets.xlrd.open_workbook')
     def test_parse_uploaded_xls_file(self, mock_open_workbook):
         """
-        Test that parse_uploaded_xlsx_file calls the xlrd.open_workbook method with the
+        Test that parse_uploaded_file calls the xlrd.open_workbook method with the
         appropriate data for files of type xls
         """
-        parse_uploaded_file(self.experiment, TEST_STUDENT_DICT, TEST_TRACK_SELECTION_RESPONSE, TEST_XLS_FILE_NAME)
-        mock_open_workbook.assert_called_with(file_contents=TEST_TRACK_SELECTION_RESPONSE)
+        parse_uploaded_file(self.experiment, TEST_STUDENT_DICT,
+                            StringIO.StringIO("file contents"), TEST_XLS_FILE_NAME)
+        mock_open_workbook.assert_called_with(file_contents="file contents", on_demand=True)
+
+    @override_settings(MAX_XLS_FILE_UPLOAD_SIZE=5)
+    @patch('ab_tool.spreadsheets.xlrd.open_workbook')
+    def test_parse_uploaded_xls_file_too_large(self, mock_open_workbook):
+        """
+        Test that parse_uploaded_file rejects xls files over MAX_XLS_FILE_UPLOAD_SIZE
+        without opening them
+        """
+        self.assertRaisesSpecific(XLS_FILE_TOO_LARGE, parse_uploaded_file, self.experiment,
+                                  TEST_STUDENT_DICT, StringIO.StringIO("file contents"),
+                                  TEST_XLS_FILE_NAME)
+        self.assertFalse(mock_open_workbook.called)
 
     @patch('ab_tool.spreadsheets.parse_row')
     def test_parse_uploaded_csv_file(self, mock_parse_row):
         """
-        Test that parse_uploaded_csv_file calls the csv.reader method with the
-        appropriate data for files of type csv
+        Test that parse_uploaded_csv_file calls parse_row with the rows of the
+        uploaded file for files of type csv
         """
         tracks = {track.name: track for track in self.experiment.tracks.all()}
         parse_uploaded_file(self.experiment, TEST_STUDENT_DICT,
-                            ''.join(TEST_TRACK_SELECTION_UPLOAD[0:3]),
+                            StringIO.StringIO(''.join(TEST_TRACK_SELECTION_UPLOAD[0:3])),
                             TEST_CSV_FILE_NAME)
         mock_parse_row.assert_called_with(TEST_ROW, TEST_ROW_NUMBER + 2,
                                           self.experiment, tracks,
                                           TEST_STUDENT_DICT, {}, [])
 
+    @override_settings(MAX_UPLOAD_ERRORS=2)
+    def test_parse_uploaded_file_caps_errors(self):
+        """
+        Test that parse_uploaded_file stops once MAX_UPLOAD_ERRORS errors have
+        been found
+        """
+        rows = [TEST_TRACK_SELECTION_UPLOAD[0]] + [
+                "Student,%s,Experiment 1,track3\r\n" % i for i in range(10)]
+        students, errors = parse_uploaded_file(self.experiment, TEST_STUDENT_DICT,
+                                               StringIO.StringIO(''.join(rows)),
+                                               TEST_CSV_FILE_NAME)
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(errors[2], "Row 4: stopped checking after 2 errors")
+
     @patch('ab_tool.spreadsheets.xlrd.open_workbook')
     def test_parse_uploaded_file_invalid_file_name(self, mock_open_workbook):
         """
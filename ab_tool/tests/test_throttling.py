@@ -0,0 +1,129 @@
+from canvas_sdk.exceptions import CanvasAPIError
+from django.core.cache import cache
+from django.test.utils import override_settings
+from mock import patch, MagicMock
+
+from ab_tool.canvas import list_modules
+from ab_tool.exceptions import CANVAS_RATE_LIMITED, NO_SDK_RESPONSE
+from ab_tool.tests.common import (SessionTestCase, APIReturn, LIST_MODULES,
+    TEST_COURSE_ID, LOCMEM_CACHES)
+from ab_tool.throttling import (call_canvas, call_canvas_all_pages,
+    get_canvas_concurrency, get_remaining_budget, is_throttled)
+
+
+class MockRequestContext(object):
+    auth_token = "MOCK_TOKEN"
+
+
+def canvas_response(remaining):
+    response = APIReturn([])
+    response.headers = {"X-Rate-Limit-Remaining": str(remaining)}
+    return response
+
+
+def canvas_page(data, remaining, next_url=None):
+    response = canvas_response(remaining)
+    response.obj = data
+    response.links = {"next": {"url": next_url}} if next_url else {}
+    return response
+
+
+def canvas_error(status_code, text=""):
+    # This is how canvas_sdk raises errors for responses with an error status
+    return CanvasAPIError(status_code=status_code, msg=text)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CANVAS_API_CONCURRENCY=8,
+                   CANVAS_RATE_LIMIT_BUDGET=700, CANVAS_RATE_LIMIT_LOW_BUDGET=100,
+                   CANVAS_THROTTLE_RETRIES=2)
+@patch("ab_tool.throttling.time.sleep")
+class TestThrottling(SessionTestCase):
+    def setUp(self):
+        super(TestThrottling, self).setUp()
+        cache.clear()
+        self.request_context = MockRequestContext()
+
+    def test_call_canvas_records_budget(self, mock_sleep):
+        """ Tests that call_canvas stores the remaining budget reported by Canvas """
+        self.assertIsNone(get_remaining_budget(self.request_context))
+        method = MagicMock(return_value=canvas_response(400.5))
+        call_canvas(self.request_context, method, TEST_COURSE_ID)
+        method.assert_called_once_with(self.request_context, TEST_COURSE_ID)
+        self.assertEqual(get_remaining_budget(self.request_context), 400.5)
+        self.assertFalse(mock_sleep.called)
+
+    def test_concurrency_follows_budget(self, mock_sleep):
+        """ Tests that concurrency is full while the budget is unknown or full
+            and drops to 1 at the low budget """
+        self.assertEqual(get_canvas_concurrency(self.request_context), 8)
+        for remaining, concurrency in [(700, 8), (400, 4), (100, 1), (0, 1)]:
+            call_canvas(self.request_context, MagicMock(return_value=canvas_response(remaining)))
+            self.assertEqual(get_canvas_concurrency(self.request_context), concurrency)
+
+    def test_low_budget_waits(self, mock_sleep):
+        """ Tests that calls wait while the budget is below the low budget """
+        call_canvas(self.request_context, MagicMock(return_value=canvas_response(50)))
+        call_canvas(self.request_context, MagicMock(return_value=canvas_response(50)))
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    def test_throttled_call_retried(self, mock_sleep):
+        """ Tests that a call throttled by Canvas is retried after a backoff """
+        method = MagicMock(side_effect=[canvas_error(403, "403 Forbidden (Rate Limit Exceeded)"),
+                                        canvas_response(300)])
+        response = call_canvas(self.request_context, method)
+        self.assertEqual(method.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual(response.headers["X-Rate-Limit-Remaining"], "300")
+    
+    def test_throttled_call_empties_budget(self, mock_sleep):
+        """ Tests that a throttled call sets the remaining budget to 0, which
+            drops the concurrency of other callers with the token to 1 """
+        call_canvas(self.request_context, MagicMock(return_value=canvas_response(600)))
+        method = MagicMock(side_effect=canvas_error(403, "403 Forbidden (Rate Limit Exceeded)"))
+        self.assertRaises(CanvasAPIError, call_canvas, self.request_context, method)
+        self.assertEqual(get_remaining_budget(self.request_context), 0)
+        self.assertEqual(get_canvas_concurrency(self.request_context), 1)
+    
+    def test_throttled_detected_from_error_json(self, mock_sleep):
+        """ Tests that throttling is also detected from the json body of the error """
+        exception = CanvasAPIError(status_code=403,
+                                   error_json={"errors": [{"message": "Rate Limit Exceeded"}]})
+        self.assertTrue(is_throttled(exception))
+
+    def test_throttled_call_gives_up(self, mock_sleep):
+        """ Tests that a call throttled on every attempt raises once the retries
+            are used up, and that handle_canvas_error reports it as throttling """
+        throttled = canvas_error(403, "403 Forbidden (Rate Limit Exceeded)")
+        method = MagicMock(side_effect=throttled)
+        self.assertRaises(CanvasAPIError, call_canvas, self.request_context, method)
+        self.assertEqual(method.call_count, 3)
+        with patch(LIST_MODULES, side_effect=throttled):
+            self.assertRaisesSpecific(CANVAS_RATE_LIMITED, list_modules,
+                                      self.request_context, TEST_COURSE_ID)
+
+    def test_other_errors_not_retried(self, mock_sleep):
+        """ Tests that errors other than throttling are raised immediately """
+        method = MagicMock(side_effect=canvas_error(403, "Unauthorized"))
+        self.assertRaises(CanvasAPIError, call_canvas, self.request_context, method)
+        self.assertEqual(method.call_count, 1)
+        self.assertFalse(is_throttled(canvas_error(500, "Rate Limit Exceeded")))
+        with patch(LIST_MODULES, side_effect=canvas_error(500)):
+            self.assertRaisesSpecific(NO_SDK_RESPONSE, list_modules,
+                                      self.request_context, TEST_COURSE_ID)
+    
+    def test_call_canvas_all_pages_records_budget_per_page(self, mock_sleep):
+        """ Tests that call_canvas_all_pages combines every page and records the
+            budget reported by each of them """
+        method = MagicMock(return_value=canvas_page([1, 2], 600, next_url="https://next/1"))
+        pages = [canvas_page([3], 500, next_url="https://next/2"), canvas_page([4], 400)]
+        budgets = []
+        def get_page(request_context, url):
+            budgets.append(get_remaining_budget(request_context))
+            return pages.pop(0)
+        with patch("ab_tool.throttling.client.get", side_effect=get_page) as mock_get:
+            data = call_canvas_all_pages(self.request_context, method, TEST_COURSE_ID)
+        self.assertEqual(data, [1, 2, 3, 4])
+        self.assertEqual([c[0][1] for c in mock_get.call_args_list],
+                         ["https://next/1", "https://next/2"])
+        self.assertEqual(budgets, [600, 500])
+        self.assertEqual(get_remaining_budget(self.request_context), 400)
@@ -0,0 +1,57 @@
+from StringIO import StringIO
+from django.core import mail
+from django.core.management import call_command
+from mock import patch
+
+from ab_tool.models import (Experiment, ExperimentStudent, CourseNotification,
+    CourseCredential)
+from ab_tool.tests.common import (SessionTestCase, TEST_COURSE_ID, TEST_EMAIL,
+    GET_ENROLLMENTS)
+
+
+class TestUnassignedStudents(SessionTestCase):
+    def setUp(self):
+        super(TestUnassignedStudents, self).setUp()
+        self.course_notification = CourseNotification.objects.create(
+                course_id=TEST_COURSE_ID, canvas_url="https://example.com/api")
+        self.experiments = []
+        for name in ["experiment1", "experiment2"]:
+            experiment = self.create_test_experiment(name=name,
+                                                     assignment_method=Experiment.CSV_UPLOAD,
+                                                     tracks_finalized=True)
+            track = self.create_test_track(experiment=experiment)
+            ExperimentStudent.objects.create(course_id=TEST_COURSE_ID, experiment=experiment,
+                                             student_id="1", track=track)
+            self.experiments.append(experiment)
+
+    def run_command(self):
+        stdout = StringIO()
+        call_command("unassigned_students", workers=1, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_notifies_course_once(self):
+        """ Tests that a course with unassigned students is notified once, with
+            its roster fetched once for all of its experiments """
+        CourseCredential.objects.create(course=self.course_notification, email=TEST_EMAIL,
+                                        token="token")
+        enrollments = [{"sis_user_id": "1", "name": "One"}, {"sis_user_id": "2", "name": "Two"}]
+        with patch(GET_ENROLLMENTS, return_value=enrollments) as mock_get_enrollments:
+            output = self.run_command()
+        self.assertEqual(mock_get_enrollments.call_count, 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("1 notified", output)
+
+    def test_up_to_date_course_not_notified(self):
+        """ Tests that a course without unassigned students isn't notified """
+        CourseCredential.objects.create(course=self.course_notification, email=TEST_EMAIL,
+                                        token="token")
+        with patch(GET_ENROLLMENTS, return_value=[{"sis_user_id": "1", "name": "One"}]):
+            output = self.run_command()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertIn("1 up to date", output)
+
+    def test_course_without_credentials(self):
+        """ Tests that a course without stored credentials is reported as such """
+        output = self.run_command()
+        self.assertIn("Handled 1 courses (2 experiments)", output)
+        self.assertIn("1 no credentials", output)
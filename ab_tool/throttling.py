@@ -0,0 +1,136 @@
+""" Rate limit handling for Canvas API calls.
+
+Canvas gives every token a request budget and reports what is left of it in
+the X-Rate-Limit-Remaining header of each response; once the budget runs out
+Canvas answers with 403 (Rate Limit Exceeded) until it refills.  The last
+remaining budget seen for each token is kept in the cache, so that every
+process and thread making calls with the token sees it, and is used to slow
+down and narrow concurrent fetching before Canvas starts refusing calls.
+"""
+import hashlib
+import logging
+import random
+import time
+
+from canvas_sdk import client
+from canvas_sdk.exceptions import CanvasAPIError
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_REMAINING_HEADER = "X-Rate-Limit-Remaining"
+THROTTLED_MESSAGE = "Rate Limit Exceeded"
+CANVAS_BUDGET_KEY = "canvas_budget_%s"
+
+
+def canvas_budget_key(request_context):
+    # Tokens are hashed so that they don't end up in cache keys
+    token = getattr(request_context, "auth_token", None) or ""
+    return CANVAS_BUDGET_KEY % hashlib.sha1(token.encode("utf-8")).hexdigest()
+
+
+def get_remaining_budget(request_context):
+    """ Returns the last remaining budget Canvas reported for the token of
+        request_context, or None if it isn't known """
+    return cache.get(canvas_budget_key(request_context))
+
+
+def record_rate_limit(request_context, response):
+    """ Stores the remaining budget reported by a Canvas response, if any """
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return
+    try:
+        remaining = float(headers.get(RATE_LIMIT_REMAINING_HEADER))
+    except (TypeError, ValueError):
+        return
+    cache.set(canvas_budget_key(request_context), remaining,
+              settings.CANVAS_RATE_LIMIT_STATE_TIMEOUT)
+
+
+def get_canvas_concurrency(request_context):
+    """ Returns how many calls to make concurrently with the token of
+        request_context: CANVAS_API_CONCURRENCY while the remaining budget is
+        unknown or full, falling linearly to 1 as it reaches
+        CANVAS_RATE_LIMIT_LOW_BUDGET """
+    maximum = settings.CANVAS_API_CONCURRENCY
+    remaining = get_remaining_budget(request_context)
+    if remaining is None:
+        return maximum
+    low = settings.CANVAS_RATE_LIMIT_LOW_BUDGET
+    full = settings.CANVAS_RATE_LIMIT_BUDGET
+    if remaining <= low:
+        return 1
+    return max(1, min(maximum, int(maximum * (remaining - low) / (full - low))))
+
+
+def wait_for_budget(request_context):
+    """ Sleeps before a call while the token's remaining budget is below
+        CANVAS_RATE_LIMIT_LOW_BUDGET, for longer the closer it is to empty """
+    remaining = get_remaining_budget(request_context)
+    low = settings.CANVAS_RATE_LIMIT_LOW_BUDGET
+    if remaining is not None and remaining < low:
+        time.sleep(settings.CANVAS_THROTTLE_BACKOFF_SECS * (low - max(remaining, 0)) / low)
+
+
+def is_throttled(exception):
+    """ Returns whether a CanvasAPIError is Canvas refusing a call because the
+        token's budget ran out, rather than a real permission error.
+        CanvasAPIError only keeps the status code and body of the response, so
+        this is told from the message in the body. """
+    if getattr(exception, "status_code", None) != 403:
+        return False
+    for text in (getattr(exception, "error_msg", None), getattr(exception, "error_json", None)):
+        if text is not None and THROTTLED_MESSAGE in unicode(text):
+            return True
+    return False
+
+
+def call_canvas(request_context, method, *args, **kwargs):
+    """ Calls the canvas_sdk method with request_context and the other
+        arguments and returns its result.  Waits first if the token's budget
+        is low, and retries throttled calls up to CANVAS_THROTTLE_RETRIES times
+        with exponential backoff before raising the CanvasAPIError. """
+    attempt = 0
+    while True:
+        # Retries have already backed off
+        if not attempt:
+            wait_for_budget(request_context)
+        try:
+            response = method(request_context, *args, **kwargs)
+        except CanvasAPIError as exception:
+            if not is_throttled(exception):
+                raise
+            # The error doesn't carry the response headers, but a throttled
+            # call means the budget has run out
+            cache.set(canvas_budget_key(request_context), 0,
+                      settings.CANVAS_RATE_LIMIT_STATE_TIMEOUT)
+            if attempt >= settings.CANVAS_THROTTLE_RETRIES:
+                raise
+            # Jitter keeps concurrent callers that were throttled together
+            # from retrying together
+            delay = (min(settings.CANVAS_THROTTLE_MAX_BACKOFF_SECS,
+                         settings.CANVAS_THROTTLE_BACKOFF_SECS * 2 ** attempt)
+                     * random.uniform(0.5, 1.5))
+            logger.warning("Canvas throttled %s, retrying in %.1fs",
+                           getattr(method, "__name__", method), delay)
+            time.sleep(delay)
+            attempt += 1
+            continue
+        record_rate_limit(request_context, response)
+        return response
+
+
+def call_canvas_all_pages(request_context, method, *args, **kwargs):
+    """ Returns the combined json list of every page of a paginated canvas_sdk
+        method, as canvas_sdk.utils.get_all_list_data does, but makes the call
+        for each page through call_canvas, so that the budget reported by
+        every page is recorded and throttled pages are retried. """
+    response = call_canvas(request_context, method, *args, **kwargs)
+    data = response.json()
+    while "next" in (getattr(response, "links", None) or {}):
+        response = call_canvas(request_context, client.get, response.links["next"]["url"])
+        data.extend(response.json())
+    return data
@@ -4,18 +4,20 @@ from django.views.decorators.http import require_POST
 from django_auth_lti.decorators import lti_role_required
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.db import transaction
 
 from ab_tool.constants import ADMINS
-from ab_tool.models import (Track, Experiment, ExperimentStudent)
+from ab_tool.models import (Track, Experiment)
 from ab_tool.canvas import get_lti_param, CanvasModules, get_unassigned_students
 from ab_tool.exceptions import (NO_TRACKS_FOR_EXPERIMENT,
     INTERVENTION_POINTS_ARE_INSTALLED, FILE_TOO_LARGE, COPIES_EXCEEDS_LIMIT)
 from django.http.response import HttpResponse, Http404
 
-from ab_tool.controllers import (get_missing_track_weights,
-    get_incomplete_intervention_points, validate_weighting, validate_name)
+from ab_tool.controllers import (check_experiment_complete, validate_name,
+    save_track_assignments, save_experiment_tracks)
 from ab_tool.spreadsheets import (get_track_selection_xlsx, get_track_selection_csv,
     parse_uploaded_file)
+from ab_tool.caching import invalidate_track_sampler
 
 
 @lti_role_required(ADMINS)
@@ -47,30 +49,24 @@ def submit_create_experiment(request):
     tracks = experiment_dict["tracks"]
     csv_upload = bool(experiment_dict["csvUpload"])
 
-    # Validates using backend rules before any object creation
-    for track_dict in tracks:
-        validate_name(track_dict["name"])
-        # added check for csv upload. if we are uploading a csv file
-        # we don't want track weights
-        if not uniform_random and not csv_upload:
-            validate_weighting(track_dict["weighting"])
-
     if csv_upload:
         assignment_method = Experiment.CSV_UPLOAD
     elif uniform_random:
         assignment_method = Experiment.UNIFORM_RANDOM
     else:
         assignment_method = Experiment.WEIGHTED_PROBABILITY_RANDOM
-    experiment = Experiment.objects.create(
-            name=name, course_id=course_id, notes=notes,
-            assignment_method=assignment_method
-    )
-    
-    # Update existing tracks
-    for track_dict in tracks:
-        track = experiment.new_track(validate_name(track_dict["name"]))
-        if not uniform_random and not csv_upload:
-            track.set_weighting(track_dict["weighting"])
+    # The tracks are validated before they are saved, and an invalid track
+    # rolls back the creation of the experiment
+    with transaction.atomic():
+        experiment = Experiment.objects.create(
+                name=name, course_id=course_id, notes=notes,
+                assignment_method=assignment_method
+        )
+        # added check for csv upload. if we are uploading a csv file
+        # we don't want track weights
+        save_experiment_tracks(experiment, tracks,
+                               weighted=not uniform_random and not csv_upload)
+    invalidate_track_sampler(experiment.id)
     return HttpResponse("success")
 
 
@@ -80,6 +76,8 @@ def edit_experiment(request, experiment_id):
     experiment = Experiment.get_or_404_check_course(experiment_id, course_id)
     has_installed_intervention = CanvasModules(request).experiment_has_installed_intervention(experiment)
     context = {"experiment": experiment,
+               # The template uses the json twice, so it is only built once here
+               "experiment_json": experiment.to_json(),
                "experiment_has_installed_intervention": has_installed_intervention,
                "create": False,
                "started": experiment.tracks_finalized}
@@ -121,37 +119,27 @@ def submit_edit_experiment(request, experiment_id):
     notes = experiment_dict["notes"]
     if experiment.tracks_finalized:
         # Only allow updating name, notes, and track names for started experiments
-        experiment.update(name=name, notes=notes)
-        existing_tracks = [i for i in experiment_dict["tracks"] if i["id"] is not None]
-        for track_dict in existing_tracks:
-            track = Track.get_or_404_check_course(track_dict["id"], course_id)
-            track.update(name=validate_name(track_dict["name"]))
+        with transaction.atomic():
+            experiment.update(name=name, notes=notes)
+            save_experiment_tracks(experiment, experiment_dict["tracks"], weighted=False,
+                                   names_only=True)
+        invalidate_track_sampler(experiment.id)
         return HttpResponse("success")
     
     uniform_random = experiment_dict["uniformRandom"]
     csv_upload = experiment_dict["csvUpload"]
-    existing_tracks = [i for i in experiment_dict["tracks"] if i["id"] is not None]
-    new_tracks = [i for i in experiment_dict["tracks"] if i["id"] is None]
     if csv_upload:
         assignment_method = Experiment.CSV_UPLOAD
     elif uniform_random:
         assignment_method = Experiment.UNIFORM_RANDOM
     else:
         assignment_method = Experiment.WEIGHTED_PROBABILITY_RANDOM
-    experiment.update(name=name, notes=notes, assignment_method=assignment_method)
-    
-    # Update existing tracks
-    for track_dict in existing_tracks:
-        track = Track.get_or_404_check_course(track_dict["id"], course_id)
-        track.update(name=validate_name(track_dict["name"]))
-        if not uniform_random and not csv_upload:
-            track.set_weighting(validate_weighting(track_dict["weighting"]))
-    
-    # Create new tracks
-    for track_dict in new_tracks:
-        track = experiment.new_track(validate_name(track_dict["name"]))
-        if not uniform_random and not csv_upload:
-            track.set_weighting(validate_weighting(track_dict["weighting"]))
+    # Nothing is saved unless every track is valid
+    with transaction.atomic():
+        experiment.update(name=name, notes=notes, assignment_method=assignment_method)
+        save_experiment_tracks(experiment, experiment_dict["tracks"],
+                               weighted=not uniform_random and not csv_upload)
+    invalidate_track_sampler(experiment.id)
     return HttpResponse("success")
 
 
@@ -179,7 +167,8 @@ def delete_experiment(request, experiment_id):
     try:
         experiment = Experiment.get_or_404_check_course(experiment_id, course_id)
         experiment.assert_not_finalized()
-        canvas_modules = CanvasModules(request)
+        # The cached modules may predate an install, so Canvas is asked directly
+        canvas_modules = CanvasModules(request, use_cache=False)
         if canvas_modules.experiment_has_installed_intervention(experiment):
             raise INTERVENTION_POINTS_ARE_INSTALLED
         experiment.delete()
@@ -193,14 +182,13 @@ def delete_experiment(request, experiment_id):
 def finalize_tracks(request, experiment_id):
     course_id = get_lti_param(request, "custom_canvas_course_id")
     experiment = Experiment.get_or_404_check_course(experiment_id, course_id)
-    if not experiment.tracks.count():
+    (track_names, incomplete_intervention_points,
+     missing_track_weights) = check_experiment_complete(experiment)
+    if not track_names:
         raise NO_TRACKS_FOR_EXPERIMENT
-    intervention_points = experiment.intervention_points.all()
-    incomplete_intervention_points = get_incomplete_intervention_points(intervention_points)
     if incomplete_intervention_points:
         return HttpResponse("URLs missing for these tracks in these Intervention Points: %s"
                             % ", ".join(incomplete_intervention_points))
-    missing_track_weights = get_missing_track_weights(experiment, course_id)
     if missing_track_weights:
         return HttpResponse("Track weightings missing for these tracks: %s"
                             % ", ".join(missing_track_weights))
@@ -228,21 +216,19 @@ def upload_track_assignments(request, experiment_id):
     uploaded_file = request.FILES["track_assignments"]
     if (uploaded_file.size > int(settings.MAX_FILE_UPLOAD_SIZE)):
         raise FILE_TOO_LARGE
-    uploaded_text = uploaded_file.read()
     unassigned_students = get_unassigned_students(request, experiment)
     students, errors = parse_uploaded_file(
-            experiment, unassigned_students, uploaded_text, uploaded_file.name
+            experiment, unassigned_students, uploaded_file, uploaded_file.name
     )
     if errors:
         return render_to_response("ab_tool/spreadsheetErrors.html", {"errors": errors})
     
-    for student_id, track in students.items():
-        # lis_person_sourcedid is not returned by SDK, so we set it to None
-        ExperimentStudent.objects.create(
-            student_id=student_id, course_id=experiment.course_id,
-            track=track, student_name=unassigned_students[student_id],
-            experiment=experiment
-        )
-    if not experiment.tracks_finalized:
-        experiment.update(tracks_finalized=True)
+    saved, already_assigned = save_track_assignments(experiment, students, unassigned_students)
+    if already_assigned:
+        # These students were assigned a track after the upload was checked,
+        # and keep that track
+        return render_to_response("ab_tool/spreadsheetErrors.html", {
+                "saved": saved, "already_assigned": already_assigned,
+                "errors": ["Student %s: already assigned to a track" % student_id
+                           for student_id in already_assigned]})
     return redirect(reverse("ab_testing_tool_index"))
@@ -10,12 +10,17 @@ from ab_tool.models import (InterventionPoint, Track, InterventionPointUrl,
      ExperimentStudent, Experiment)
 from ab_tool.canvas import get_lti_param, CanvasModules
 from ab_tool.controllers import (validate_format_url, post_param, assign_track_and_create_student,
-    validate_name)
+    validate_name, save_intervention_point_urls)
 from ab_tool.exceptions import (DELETING_INSTALLED_INTERVENTION_POINT,
     EXPERIMENT_TRACKS_NOT_FINALIZED, NO_URL_FOR_TRACK, UNIQUE_NAME_ERROR,
-    EXPERIMENT_TRACKS_ALREADY_FINALIZED, DELETING_INTERVENTION_POINT_AFTER_FINALIZED)
+    EXPERIMENT_TRACKS_ALREADY_FINALIZED, DELETING_INTERVENTION_POINT_AFTER_FINALIZED,
+    UNAUTHORIZED_ACCESS)
 from ab_tool.analytics import log_intervention_point_interaction
+from ab_tool.caching import (get_deploy_plan, get_student_assignment,
+    cache_student_assignment, invalidate_deploy_plans)
+from django.db import transaction
 from django.http.response import Http404
+from error_middleware.exceptions import Renderable400
 
 
 @csrf_exempt
@@ -37,46 +42,52 @@ def deploy_intervention_point(request, intervention_point_id):
         return redirect(reverse("ab_testing_tool_modules_page_view_intervention_point",
                                 args=(intervention_point_id,)))
     
-    intervention_point = InterventionPoint.get_or_404_check_course(
-            intervention_point_id, course_id)
-    
-    experiment = intervention_point.experiment
+    # The deploy plan is a cached, denormalized view of the intervention point,
+    # its experiment and its urls; see ab_tool.caching.build_deploy_plan
+    deploy_plan = get_deploy_plan(intervention_point_id)
+    if deploy_plan["course_id"] != course_id:
+        raise UNAUTHORIZED_ACCESS
     
     # Otherwise, user is a student.  Tracks for the course must be finalized
     # for a student to be able to access content from the ab_testing_tool
-    if not experiment.tracks_finalized:
+    if not deploy_plan["tracks_finalized"]:
         raise EXPERIMENT_TRACKS_NOT_FINALIZED
     
     student_id = get_lti_param(request, "custom_canvas_user_login_id")
     
-    # Get or create an object to track the student for this course
-    try:
-        student = ExperimentStudent.objects.get(student_id=student_id, experiment=experiment)
-    except ExperimentStudent.DoesNotExist:
-        # If this is a new student or the student doesn't yet have a track,
-        # select a track before creating the student. This avoids a race condition of
-        # a student existing but not having a track assigned (e.g. if the update to
-        # a student database object fails)
-        student_name = get_lti_param(request, "lis_person_name_full")
-        student = assign_track_and_create_student(experiment, student_id, student_name)
+    # Get or create an object to track the student for this course.  Returning
+    # students are served from the assignment cache without a database query
+    assignment = get_student_assignment(deploy_plan["experiment_id"], student_id)
+    if assignment is None:
+        try:
+            student = ExperimentStudent.objects.get(student_id=student_id,
+                                                    experiment_id=deploy_plan["experiment_id"])
+            assignment = cache_student_assignment(student)
+        except ExperimentStudent.DoesNotExist:
+            # If this is a new student or the student doesn't yet have a track,
+            # select a track before creating the student. This avoids a race condition of
+            # a student existing but not having a track assigned (e.g. if the update to
+            # a student database object fails)
+            student_name = get_lti_param(request, "lis_person_name_full")
+            experiment = Experiment.objects.get(pk=deploy_plan["experiment_id"])
+            student = assign_track_and_create_student(experiment, student_id, student_name)
+            assignment = {"id": student.id, "track_id": student.track_id}
     
     # Retrieve the url for the student's track at the current intervention point
     # Return an error page if there is no url configured.
-    try:
-        chosen_intervention_point_url = InterventionPointUrl.objects.get(intervention_point__pk=intervention_point_id, track=student.track)
-    except InterventionPointUrl.DoesNotExist:
-        raise NO_URL_FOR_TRACK
-    if not chosen_intervention_point_url.url:
+    chosen_intervention_point_url = deploy_plan["track_urls"].get(assignment["track_id"])
+    if not chosen_intervention_point_url or not chosen_intervention_point_url["url"]:
         raise NO_URL_FOR_TRACK
     
-    log_intervention_point_interaction(course_id, student, intervention_point, experiment,
-                                       student.track, chosen_intervention_point_url)
+    log_intervention_point_interaction(course_id, assignment["id"], int(intervention_point_id),
+                                       deploy_plan["experiment_id"], assignment["track_id"],
+                                       chosen_intervention_point_url["url"])
     
-    if chosen_intervention_point_url.open_as_tab:
-        return render_to_response("ab_tool/new_tab_redirect.html", {"url": chosen_intervention_point_url.url})
-    if chosen_intervention_point_url.is_canvas_page:
-        return render_to_response("ab_tool/window_redirect.html", {"url": chosen_intervention_point_url.url})
-    return redirect(chosen_intervention_point_url.url)
+    if chosen_intervention_point_url["open_as_tab"]:
+        return render_to_response("ab_tool/new_tab_redirect.html", {"url": chosen_intervention_point_url["url"]})
+    if chosen_intervention_point_url["is_canvas_page"]:
+        return render_to_response("ab_tool/window_redirect.html", {"url": chosen_intervention_point_url["url"]})
+    return redirect(chosen_intervention_point_url["url"])
 
 
 @lti_role_required(ADMINS)
@@ -86,27 +97,37 @@ def submit_create_intervention_point(request, experiment_id):
     course_id = get_lti_param(request, "custom_canvas_course_id")
     name = validate_name(post_param(request, "name"))
     notes = post_param(request, "notes")
-    # validate_format_url validates URLs using backend rules before InterventionPointUrl object creation
-    intervention_pointurls = [(k,validate_format_url(v)) for (k,v) in request.POST.iteritems()
-                              if INTERVENTION_POINT_URL_TAG in k and v]
+    track_urls = get_posted_track_urls(request)
     experiment = Experiment.get_or_404_check_course(experiment_id, course_id)
-    if InterventionPoint.objects.filter(name=name,
-        course_id=course_id, experiment=experiment).count() > 0:
-        raise UNIQUE_NAME_ERROR
-    intervention_point = InterventionPoint.objects.create(
-            name=name, notes=notes, course_id=course_id, experiment=experiment)
-    for (k,v) in intervention_pointurls:
-        _, track_id = k.split(INTERVENTION_POINT_URL_TAG)
-        deploy_option = post_param(request, DEPLOY_OPTION_TAG + track_id)
-        is_canvas_page = bool(deploy_option == "canvasPage")
-        open_as_tab = bool(deploy_option == "newTab")
-        InterventionPointUrl.objects.create(
-                url=v, intervention_point_id=intervention_point.id,
-                track_id=track_id, is_canvas_page=is_canvas_page, open_as_tab=open_as_tab
-        )
+    with transaction.atomic():
+        try:
+            intervention_point = InterventionPoint.objects.create(
+                    name=name, notes=notes, course_id=course_id, experiment=experiment)
+        except Renderable400:
+            # Names are unique within an experiment; rather than checking for
+            # an existing intervention point first, a duplicate name is left
+            # to the unique constraint (see TimestampedModel.save)
+            raise UNIQUE_NAME_ERROR
+        save_intervention_point_urls(intervention_point.id, track_urls)
+    invalidate_deploy_plans([intervention_point.id])
     return redirect(reverse("ab_testing_tool_index"))
 
 
+def get_posted_track_urls(request):
+    """ Returns the urls posted for each track as a dict of the form expected
+        by save_intervention_point_urls.  validate_format_url validates every
+        URL using backend rules before any InterventionPointUrl is saved. """
+    track_urls = {}
+    for (k,v) in request.POST.iteritems():
+        if INTERVENTION_POINT_URL_TAG in k and v:
+            _, track_id = k.split(INTERVENTION_POINT_URL_TAG)
+            deploy_option = post_param(request, DEPLOY_OPTION_TAG + track_id)
+            track_urls[int(track_id)] = {"url": validate_format_url(v),
+                                         "is_canvas_page": bool(deploy_option == "canvasPage"),
+                                         "open_as_tab": bool(deploy_option == "newTab")}
+    return track_urls
+
+
 @lti_role_required(ADMINS)
 def modules_page_view_intervention_point(request, intervention_point_id):
     context = intervention_point_context(request, intervention_point_id)
@@ -126,16 +147,22 @@ def intervention_point_context(request, intervention_point_id):
     intervention_point = InterventionPoint.get_or_404_check_course(
             intervention_point_id, course_id)
     all_tracks = Track.objects.filter(course_id=course_id,
-                                      experiment=intervention_point.experiment)
+                                      experiment=intervention_point.experiment_id).order_by("id")
+    # The urls of every track are read in one query rather than one per track
+    ip_urls = {ip_url.track_id: ip_url for ip_url in
+               InterventionPointUrl.objects.filter(intervention_point=intervention_point)}
     track_urls = []
+    track_url_list = []
     for track in all_tracks:
-        # This is a search for the joint unique index of InterventionPointUrl, so it
-        # should not ever return multiple objects
-        try:
-            intervention_point_url = InterventionPointUrl.objects.get(intervention_point__pk=intervention_point_id, track=track)
-            track_urls.append((track, intervention_point_url))
-        except InterventionPointUrl.DoesNotExist:
-            track_urls.append((track, None))
+        intervention_point_url = ip_urls.get(track.id)
+        track_urls.append((track, intervention_point_url))
+        ip_url = intervention_point_url or InterventionPointUrl(track=track)
+        # Avoids a query for the track when the template reads it
+        ip_url.track = track
+        track_url_list.append(ip_url)
+    # The url of each track in id order, with an unsaved InterventionPointUrl
+    # for tracks that don't have one yet
+    intervention_point.track_url_list = track_url_list
     context = {"intervention_point": intervention_point,
                "tracks": track_urls,
                "is_installed": canvas_modules.intervention_point_is_installed(intervention_point),
@@ -166,25 +193,13 @@ def edit_intervention_point_common(request, intervention_point_id):
     notes = post_param(request, "notes")
     # Checks to see if there exits another intervention point with the same name
     if new_name != intervention_point.name and InterventionPoint.objects.filter(name=new_name,
-        course_id=course_id, experiment=intervention_point.experiment).count() > 0:
+        course_id=course_id, experiment=intervention_point.experiment_id).exists():
         raise UNIQUE_NAME_ERROR
-    intervention_point.update(name=new_name, notes=notes)
-    # Validates URLs using backend rules before any InterventionPointUrl object creation
-    intervention_pointurls = [(k,validate_format_url(v)) for (k,v) in request.POST.iteritems() if INTERVENTION_POINT_URL_TAG in k and v]
-    for (k,v) in intervention_pointurls:
-        _, track_id = k.split(INTERVENTION_POINT_URL_TAG)
-        # This is a search for the joint unique index of InterventionPointUrl, so it
-        # should not ever return multiple objects
-        deploy_option = post_param(request, DEPLOY_OPTION_TAG + track_id)
-        is_canvas_page = bool(deploy_option == "canvasPage")
-        open_as_tab = bool(deploy_option == "newTab")
-        try:
-            # InterventionPointUrl creation
-            intervention_point_url = InterventionPointUrl.objects.get(intervention_point__pk=intervention_point_id, track__pk=track_id)
-            intervention_point_url.update(url=v, is_canvas_page=is_canvas_page, open_as_tab=open_as_tab)
-        except InterventionPointUrl.DoesNotExist:
-            InterventionPointUrl.objects.create(url=v, intervention_point_id=intervention_point_id, track_id=track_id,
-                                    is_canvas_page=is_canvas_page, open_as_tab=open_as_tab)
+    track_urls = get_posted_track_urls(request)
+    with transaction.atomic():
+        intervention_point.update(name=new_name, notes=notes)
+        save_intervention_point_urls(intervention_point.id, track_urls)
+    invalidate_deploy_plans([intervention_point.id])
 
 
 @require_POST
@@ -199,7 +214,8 @@ def delete_intervention_point(request, intervention_point_id):
                 intervention_point_id, course_id)
         if intervention_point.experiment.tracks_finalized:
             raise DELETING_INTERVENTION_POINT_AFTER_FINALIZED
-        canvas_modules = CanvasModules(request)
+        # The cached modules may predate an install, so Canvas is asked directly
+        canvas_modules = CanvasModules(request, use_cache=False)
         if canvas_modules.intervention_point_is_installed(intervention_point):
             raise DELETING_INSTALLED_INTERVENTION_POINT
         intervention_point.delete()
@@ -213,7 +229,7 @@ def get_ip_open_where_display_index(track_url_obj):
     """
     Maps logical combinations of track_url object properties to a user interface display object choice.
     Meant to be used for UI select menu.
-    :param track_url_obj: a track URL object as returned by InterventionPoint.track_urls()
+    :param track_url_obj: a track URL object from InterventionPoint.track_url_list
     :return an index mapping to a specific select option for an html dropdown selectmenu list
     """
 
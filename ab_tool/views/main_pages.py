@@ -9,8 +9,8 @@ from ims_lti_py.tool_config import ToolConfig
 from intervention_point_pages import get_ip_open_where_display_index
 from ab_tool.canvas import (get_lti_param, CanvasModules,
     experiments_with_unassigned_students)
-from ab_tool.controllers import post_param
-from ab_tool.models import (InterventionPoint, Experiment)
+from ab_tool.controllers import post_param, load_dashboard_experiments
+from ab_tool.models import Experiment
 from ab_tool.constants import ADMINS
 from ab_tool.spreadsheets import (get_student_list_csv,
     get_intervention_point_interactions_csv)
@@ -25,20 +25,21 @@ def not_authorized(request):
 def render_control_panel(request):
     canvas_modules = CanvasModules(request)
     course_id = get_lti_param(request, "custom_canvas_course_id")
-    intervention_points = InterventionPoint.objects.filter(course_id=course_id)
+    experiments, intervention_points = load_dashboard_experiments(course_id)
     ip_display_mappings = {track_url.id: get_ip_open_where_display_index(track_url)
-                           for ip in intervention_points for track_url in ip.track_urls()}
-    experiments = Experiment.objects.filter(course_id=course_id)
+                           for ip in intervention_points for track_url in ip.track_url_list}
+    uninstalled_intervention_points = canvas_modules.get_uninstalled_intervention_points()
     
     context = {
         "modules": canvas_modules.get_modules_with_items(),
         "intervention_points": intervention_points,
         "ip_display_mappings": ip_display_mappings,
-        "uninstalled_intervention_points": canvas_modules.get_uninstalled_intervention_points(),
+        "uninstalled_intervention_points": uninstalled_intervention_points,
+        "uninstalled_intervention_point_ids": set(ip.id for ip in uninstalled_intervention_points),
         "canvas_url": get_lti_param(request, "launch_presentation_return_url"),
         "experiments": experiments,
         "experiments_with_unassigned_students": experiments_with_unassigned_students(request, course_id),
-        "deletable_experiment_ids": canvas_modules.get_deletable_experiment_ids(),
+        "deletable_experiment_ids": set(canvas_modules.get_deletable_experiment_ids()),
     }
     return render(request, "ab_tool/experiments_dashboard.html", context)
 
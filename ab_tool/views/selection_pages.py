@@ -9,6 +9,7 @@ from ab_tool.controllers import (intervention_point_url, post_param,
     validate_name)
 from ab_tool.constants import INTERVENTION_POINT_URL_TAG, ADMINS
 from ab_tool.canvas import get_lti_param, CanvasModules
+from ab_tool.caching import invalidate_course_modules
 from ab_tool.exceptions import (MISSING_RETURN_TYPES_PARAM,
     MISSING_RETURN_URL)
 
@@ -43,6 +44,11 @@ def submit_selection(request):
     page_url = intervention_point_url(request, intervention_point_id)
     page_name = intervention_point.name
     content_return_url = post_param(request, "content_return_url")
+    # Canvas installs the intervention point once we redirect back to it, so
+    # the dashboard likely shows it sooner without the cached modules.  This
+    # is only a best effort for display; checks before a delete don't use the
+    # cache.
+    invalidate_course_modules(course_id)
     params = {"return_type": "lti_launch_url",
                "url": page_url,
                #"title": "Title",